@@ -0,0 +1,188 @@
+import base64
+import fcntl
+import hashlib
+import json
+import logging
+import os
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Optional, Protocol
+
+import attr
+import google.cloud.storage as storage
+from google.api_core.exceptions import PreconditionFailed
+
+from .export_json import (
+    SAMPLE_SIZE_PATH,
+    build_target_key_from_recipe,
+    parse_recipe_from_slug,
+    validate_target_results,
+)
+from .utils import retry_with_backoff
+
+logger = logging.getLogger(__name__)
+
+# target keys are spread over this many objects, so that concurrent merges rarely
+# conflict and each merge only rewrites a fraction of the aggregate
+NUM_PARTITIONS = 32
+
+
+def aggregate_prefix(run_date: str) -> str:
+    return f"{SAMPLE_SIZE_PATH}/aggregate_{run_date}"
+
+
+def partition_name(target_key: str) -> str:
+    digest = int(hashlib.sha256(target_key.encode()).hexdigest(), 16)
+    return f"part_{digest % NUM_PARTITIONS:02}.json"
+
+
+def results_digest(results_json: str) -> str:
+    """Returns the base64-encoded MD5 of results, as GCS reports it for the uploaded blob."""
+    return base64.b64encode(hashlib.md5(results_json.encode()).digest()).decode()
+
+
+class AggregateStore(Protocol):
+    def names(self) -> List[str]: ...
+
+    def read(self, name: str) -> Optional[bytes]: ...
+
+    def update(self, name: str, func: Callable[[Optional[bytes]], bytes]) -> None: ...
+
+
+@attr.s(auto_attribs=True)
+class GcsAggregateStore:
+    """
+    Updates partitions with a generation precondition: an update that raced
+    with another worker's fails without overwriting it and is retried on the
+    newer contents.
+    """
+
+    project_id: str
+    bucket: str
+    prefix: str
+    max_attempts: int = 10
+
+    @property
+    def client(self) -> storage.Client:
+        return storage.Client(self.project_id)
+
+    def names(self) -> List[str]:
+        return [
+            blob.name.rsplit("/", 1)[-1]
+            for blob in self.client.list_blobs(self.bucket, prefix=f"{self.prefix}/")
+        ]
+
+    def read(self, name: str) -> Optional[bytes]:
+        blob = self.client.bucket(self.bucket).get_blob(f"{self.prefix}/{name}")
+        return blob.download_as_bytes() if blob is not None else None
+
+    def _update_once(self, name: str, func: Callable[[Optional[bytes]], bytes]) -> None:
+        bucket = self.client.bucket(self.bucket)
+        blob = bucket.get_blob(f"{self.prefix}/{name}")
+        # generation 0 only matches if the partition doesn't exist yet
+        generation = 0
+        current = None
+        if blob is not None:
+            generation = blob.generation
+            current = blob.download_as_bytes(if_generation_match=generation)
+
+        bucket.blob(f"{self.prefix}/{name}").upload_from_string(
+            func(current), content_type="application/json", if_generation_match=generation
+        )
+
+    def update(self, name: str, func: Callable[[Optional[bytes]], bytes]) -> None:
+        retry_with_backoff(
+            lambda: self._update_once(name, func),
+            description=f"Merging into {self.prefix}/{name}",
+            attempts=self.max_attempts,
+            delay=1.0,
+            factor=1.5,
+            retry_on=(PreconditionFailed,),
+        )
+
+
+@attr.s(auto_attribs=True)
+class LocalAggregateStore:
+    """Updates partitions under an exclusive file lock, for runs on one machine."""
+
+    path: Path
+
+    def names(self) -> List[str]:
+        if not self.path.exists():
+            return []
+        return sorted(partition.name for partition in self.path.glob("*.json"))
+
+    def read(self, name: str) -> Optional[bytes]:
+        partition = self.path / name
+        return partition.read_bytes() if partition.exists() else None
+
+    def update(self, name: str, func: Callable[[Optional[bytes]], bytes]) -> None:
+        self.path.mkdir(parents=True, exist_ok=True)
+        with open(self.path / f"{name}.lock", "w") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                updated = func(self.read(name))
+                # readers never see a partially written partition
+                temporary = self.path / f"{name}.tmp"
+                temporary.write_bytes(updated)
+                os.replace(temporary, self.path / name)
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+@attr.s(auto_attribs=True)
+class MergedResults:
+    # validated results by target key and user type, as in the aggregate document
+    targets: Dict[str, Dict[str, Any]] = attr.Factory(dict)
+    # target key of every merged slug
+    slugs: Dict[str, str] = attr.Factory(dict)
+    # digest of the results every slug was merged from
+    digests: Dict[str, str] = attr.Factory(dict)
+
+    def is_current(self, target_slug: str, blob_digest: Optional[str]) -> bool:
+        """
+        Whether the merged results of a slug are those of its uploaded blob, and
+        not of an earlier run for the same date whose rerun failed to merge.
+        """
+        return target_slug in self.slugs and self.digests.get(target_slug) == blob_digest
+
+
+def merge_target_results(
+    store: AggregateStore,
+    target_slug: str,
+    results_json: str,
+    jobs_dict: Optional[Dict] = None,
+) -> str:
+    """
+    Validates a target's results and merges them into its partition of the
+    run's aggregate. Returns the target key the results were merged into.
+    """
+    recipe_info = parse_recipe_from_slug(target_slug, jobs_dict)
+    target_key = build_target_key_from_recipe(recipe_info)
+    value = validate_target_results(recipe_info, results_json)
+    digest = results_digest(results_json)
+
+    def merge(current: Optional[bytes]) -> bytes:
+        partition = json.loads(current) if current else {"targets": {}, "slugs": {}}
+        partition["targets"].setdefault(target_key, {})[recipe_info["new_or_existing"]] = value
+        partition["slugs"][target_slug] = target_key
+        partition.setdefault("digests", {})[target_slug] = digest
+        return json.dumps(partition).encode()
+
+    store.update(partition_name(target_key), merge)
+    logger.info(f"Merged results of {target_slug} into the aggregate for {target_key}")
+
+    return target_key
+
+
+def read_merged_results(store: AggregateStore) -> MergedResults:
+    merged = MergedResults()
+    for name in store.names():
+        contents = store.read(name)
+        if contents is None:
+            continue
+        partition = json.loads(contents)
+        merged.targets.update(partition["targets"])
+        merged.slugs.update(partition["slugs"])
+        merged.digests.update(partition.get("digests", {}))
+
+    return merged
@@ -0,0 +1,182 @@
+import logging
+import re
+import time
+from datetime import date, datetime
+from enum import Enum
+from typing import Any, Dict, Iterable, List, Optional
+
+import attr
+from google.cloud import bigquery
+
+import auto_sizing.errors as errors
+
+from .targets import SizingConfiguration
+
+logger = logging.getLogger(__name__)
+
+TABLE_REFERENCE = re.compile(r"^`?([\w-]+\.[\w-]+\.[\w-]+)`?$")
+# tables a view reads from, e.g. the table behind `mozdata.telemetry.clients_daily`
+VIEW_SOURCE = re.compile(r"\b(?:FROM|JOIN)\s+`?([\w-]+\.[\w-]+\.[\w-]+)`?", re.IGNORECASE)
+PARTITION_DATE_FORMAT = "%Y%m%d"
+
+
+class AvailabilityPolicy(str, Enum):
+    IGNORE = "ignore"
+    FAIL = "fail"
+    WAIT = "wait"
+
+
+def source_tables(config: SizingConfiguration) -> List[str]:
+    """
+    Returns the tables that a target's segments and metrics read from.
+    Data sources defined by a subquery rather than a table are left out.
+    """
+    from_exprs = [segment.data_source.from_expr_for(None) for segment in config.target_list]
+    from_exprs += [metric.data_source.from_expr_for(None) for metric in config.metric_list]
+
+    tables = []
+    for from_expr in from_exprs:
+        match = TABLE_REFERENCE.match(from_expr.strip())
+        if match and match.group(1) not in tables:
+            tables.append(match.group(1))
+
+    return tables
+
+
+@attr.s(auto_attribs=True)
+class PartitionChecker:
+    """
+    Checks that the daily partitions a run needs have landed before its queries
+    run, using INFORMATION_SCHEMA.PARTITIONS. Those queries are billed, though
+    only for the metadata they read, and results are cached so that tables
+    shared by every target of a worklist are only looked up once.
+    """
+
+    project: str
+    policy: AvailabilityPolicy = AvailabilityPolicy.FAIL
+    timeout: float = 6 * 60 * 60
+    poll_interval: float = 10 * 60
+    _partitions: Dict[str, Dict[date, int]] = attr.Factory(dict)
+    _resolved: Dict[str, Optional[str]] = attr.Factory(dict)
+
+    @property
+    def client(self) -> bigquery.Client:
+        return bigquery.Client(project=self.project)
+
+    def resolve_table(self, table: str) -> Optional[str]:
+        """
+        Returns the partitioned table behind `table`, following views that
+        select from a single table, or None if it can't be determined.
+        """
+        if table not in self._resolved:
+            bq_table = self.client.get_table(table)
+            if bq_table.table_type == "VIEW":
+                sources = set(VIEW_SOURCE.findall(bq_table.view_query or ""))
+                self._resolved[table] = (
+                    self.resolve_table(sources.pop()) if len(sources) == 1 else None
+                )
+            else:
+                self._resolved[table] = table if bq_table.time_partitioning else None
+
+        return self._resolved[table]
+
+    def partitions(self, table: str, refresh: bool = False) -> Dict[date, int]:
+        """Returns the logical bytes of each of a table's daily partitions."""
+        if table in self._partitions and not refresh:
+            return self._partitions[table]
+
+        project, dataset, table_name = table.split(".")
+        rows = self.client.query(
+            f"""
+            SELECT partition_id, total_logical_bytes
+            FROM `{project}.{dataset}.INFORMATION_SCHEMA.PARTITIONS`
+            WHERE table_name = '{table_name}' AND total_rows > 0
+            """
+        ).result()
+
+        partitions = {}
+        for row in rows:
+            if row.partition_id.isdigit():
+                partition_date = datetime.strptime(row.partition_id, PARTITION_DATE_FORMAT).date()
+                partitions[partition_date] = row.total_logical_bytes
+        self._partitions[table] = partitions
+
+        return partitions
+
+    def missing_dates(
+        self, tables: Iterable[str], first_date: date, last_date: date, refresh: bool = False
+    ) -> Dict[str, List[date]]:
+        """Returns the dates of each table that haven't landed yet."""
+        missing = {}
+        for table in tables:
+            partitioned_table = self.resolve_table(table)
+            if partitioned_table is None:
+                logger.warning(f"Partitions of {table} can't be checked")
+                continue
+
+            partitions = self.partitions(partitioned_table, refresh=refresh)
+            dates = [
+                date.fromordinal(day)
+                for day in range(first_date.toordinal(), last_date.toordinal() + 1)
+                if date.fromordinal(day) not in partitions
+            ]
+            if dates:
+                missing[table] = dates
+
+        return missing
+
+    def require(self, config: SizingConfiguration, first_date: date, last_date: date) -> None:
+        """Fails or waits, depending on the policy, until all dates of a target's tables landed."""
+        if self.policy == AvailabilityPolicy.IGNORE:
+            return
+
+        tables = source_tables(config)
+        deadline = time.monotonic() + self.timeout
+        missing = self.missing_dates(tables, first_date, last_date)
+        while missing and self.policy == AvailabilityPolicy.WAIT:
+            if time.monotonic() + self.poll_interval > deadline:
+                break
+            logger.info(f"Waiting for partitions of {', '.join(missing)} for {config.target_slug}")
+            time.sleep(self.poll_interval)
+            missing = self.missing_dates(list(missing), first_date, last_date, refresh=True)
+
+        if missing:
+            raise errors.DataNotAvailableException(
+                config.target_slug,
+                {table: [str(d) for d in dates] for table, dates in missing.items()},
+            )
+
+    def pruning_report(
+        self, stage: str, sql: str, tables: Iterable[str], first_date: date, last_date: date
+    ) -> Dict[str, Any]:
+        """
+        Dry runs a query and checks that it reads no more than the partitions
+        between `first_date` and `last_date` of the given tables. Reading every
+        column of those partitions bounds what a pruned query can bill, so a
+        query billing more must read partitions outside the dates it needs.
+        """
+        job = self.client.query(
+            sql, job_config=bigquery.QueryJobConfig(dry_run=True, use_query_cache=False)
+        )
+
+        partition_bytes = 0
+        checked_tables = []
+        for table in tables:
+            partitioned_table = self.resolve_table(table)
+            if partitioned_table is None:
+                continue
+            checked_tables.append(partitioned_table)
+            partition_bytes += sum(
+                size
+                for partition_date, size in self.partitions(partitioned_table).items()
+                if first_date <= partition_date <= last_date
+            )
+
+        return {
+            "stage": stage,
+            "bytes_processed": job.total_bytes_processed,
+            "partition_bytes": partition_bytes,
+            "tables": checked_tables,
+            # unknown when none of the tables' partitions can be looked up
+            "pruned": job.total_bytes_processed <= partition_bytes if checked_tables else None,
+        }
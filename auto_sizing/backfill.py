@@ -0,0 +1,156 @@
+import logging
+from datetime import date, timedelta
+from typing import Dict, List
+
+import attr
+from mozanalysis.bq import sanitize_table_name_for_bq
+from mozanalysis.sizing import HistoricalTarget
+from mozanalysis.utils import add_days
+from pandas import DataFrame
+
+from .rollup import build_rollup_metrics_query, is_additive, window_column
+from .size_calculation import SizeCalculation
+from .targets import ALLOWED_APPS, SizingCollection, SizingConfiguration
+from .utils import delete_bq_table
+
+logger = logging.getLogger(__name__)
+
+
+def backfill_configurations(
+    target_slug: str,
+    target_recipe: Dict[str, str],
+    jobs_dict: Dict,
+    app_id: ALLOWED_APPS,
+    run_dates: List[date],
+) -> Dict[date, SizingConfiguration]:
+    """Returns the configuration a preset target would have had on each run date."""
+    configs = {}
+    for run_date in run_dates:
+        collection = SizingCollection.from_repo(
+            target_recipe, jobs_dict, app_id=app_id, current_date=run_date
+        )
+        configs[run_date] = SizingConfiguration(
+            collection.sizing_targets,
+            target_slug=target_slug,
+            metric_list=collection.sizing_metrics,
+            start_date=collection.sizing_dates["start_date"],
+            num_dates_enrollment=collection.sizing_dates["num_dates_enrollment"],
+            analysis_length=collection.sizing_dates["analysis_length"],
+            parameters=collection.sizing_parameters,
+            analysis_lengths=collection.sizing_dates.get("analysis_lengths", []),
+        )
+
+    return configs
+
+
+def run_date_range(from_date: date, to_date: date) -> List[date]:
+    return [from_date + timedelta(days=i) for i in range((to_date - from_date).days + 1)]
+
+
+@attr.s(auto_attribs=True)
+class BackfillCalculation(SizeCalculation):
+    """
+    Computes a target's sizes for a range of run dates in one pass.
+
+    Run dates a day apart have analysis windows that overlap by all but a
+    day, so instead of scanning every window separately, per-client daily
+    metric values are computed once for the whole range and summed over
+    each run date's windows. Targeting is still evaluated for every run date,
+    but all run dates are combined into a single query over their enrollment periods.
+    """
+
+    run_configs: Dict[date, SizingConfiguration] = attr.Factory(dict)
+
+    def _table_name(self, name: str) -> str:
+        return sanitize_table_name_for_bq("_".join([name, self.config.target_slug, "backfill"]))
+
+    def _targets_query(self, current_date: date) -> str:
+        queries = []
+        for run_date, config in self.run_configs.items():
+            run_sizing = attr.evolve(self, config=config)
+            ht = HistoricalTarget(
+                experiment_name=config.target_slug,
+                start_date=config.start_date,
+                analysis_length=config.analysis_length,
+                num_dates_enrollment=config.num_dates_enrollment,
+            )
+            targets_sql = ht.build_targets_query(
+                time_limits=run_sizing._validate_requested_timelimits(current_date),
+                target_list=config.target_list,
+            )
+            queries.append(f"SELECT DATE '{run_date}' AS run_date, * FROM ({targets_sql})")
+
+        return "\nUNION ALL\n".join(queries)
+
+    def calculate_backfill_metrics(self, current_date: date) -> DataFrame:
+        targets_table = self._run_stage_query(
+            "backfill_targets", self._targets_query(current_date), self._table_name("auto-sizing")
+        )
+
+        configs = self.run_configs.values()
+        first_date = min(config.start_date for config in configs)
+        last_date = add_days(
+            max(config.start_date for config in configs),
+            self.config.num_dates_enrollment + max(self.config.window_lengths) - 1,
+        )
+
+        daily_tables = self._run_daily_stages(
+            targets_table, first_date, last_date, table_prefix="daily-backfill"
+        )
+
+        metrics_table = self._run_stage_query(
+            "backfill_metrics",
+            build_rollup_metrics_query(
+                targets_table,
+                daily_tables,
+                self.config.window_lengths,
+                keys=["run_date", "client_id"],
+            ),
+            self._table_name("metrics-table"),
+        )
+        df = self._download_table(
+            metrics_table,
+            [
+                "run_date",
+                *(
+                    window_column(m.name, analysis_length)
+                    for m in self.config.metric_list
+                    for analysis_length in self.config.window_lengths
+                ),
+            ],
+        )
+
+        for table in [targets_table, *daily_tables]:
+            delete_bq_table(table, self.project)
+
+        return df
+
+    def run(self, current_date: date) -> None:
+        if not is_additive(self.config.metric_list):
+            # metrics that can't be combined from per-day values are sized date by date
+            logger.warning(
+                f"Metrics of {self.config.target_slug} aren't additive across days; "
+                + "backfilling each run date separately"
+            )
+            for run_date, config in self.run_configs.items():
+                run_sizing = attr.evolve(self, config=config, run_configs={})
+                metrics_table = run_sizing.calculate_target_metrics(current_date)
+                if len(metrics_table) == 0:
+                    logger.warning(f"No clients satisfied targeting on {run_date}")
+                    continue
+
+                run_sizing.publish_results(
+                    run_sizing.calculate_results(metrics_table), run_date.strftime("%Y-%m-%d")
+                )
+            return
+
+        df = self.calculate_backfill_metrics(current_date)
+        for run_date in self.run_configs:
+            metrics_table = df[df["run_date"] == run_date]
+            if len(metrics_table) == 0:
+                logger.warning(f"No clients satisfied targeting on {run_date}")
+                continue
+
+            self.publish_results(
+                self.calculate_window_sizes(metrics_table), run_date.strftime("%Y-%m-%d")
+            )
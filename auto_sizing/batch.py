@@ -0,0 +1,193 @@
+import glob
+import json
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+
+import attr
+
+from .cancellation import interrupt_on_signals
+from .errors import PopulationTooSmallException, RunInterruptedException
+from .size_calculation import SizeCalculation
+from .targets import SizingCollection, SizingConfiguration
+
+logger = logging.getLogger(__name__)
+
+BATCH_REPORT_FILE = "batch_report.json"
+
+
+def expand_config_paths(pattern: str) -> List[Path]:
+    """Returns the config files in a directory, matching a glob, or the single file given."""
+    path = Path(pattern)
+    if path.is_dir():
+        return sorted(path.glob("*.toml"))
+    if path.is_file():
+        return [path]
+    return sorted(Path(p) for p in glob.glob(pattern, recursive=True) if Path(p).is_file())
+
+
+def load_configurations(paths: List[Path]) -> List[SizingConfiguration]:
+    """
+    Loads a sizing configuration per file. Each target is named after its
+    file, and metric-hub definitions are only resolved once for all files.
+    """
+    configs = []
+    slugs: Dict[str, int] = {}
+    for path in paths:
+        # files with the same name in different directories still need distinct tables
+        slugs[path.stem] = slugs.get(path.stem, 0) + 1
+        target_slug = path.stem if slugs[path.stem] == 1 else f"{path.stem}_{slugs[path.stem]}"
+        with open(path) as config_file:
+            collection = SizingCollection.from_file(config_file)
+            configs.append(
+                SizingConfiguration(
+                    collection.sizing_targets,
+                    target_slug=target_slug,
+                    metric_list=collection.sizing_metrics,
+                    start_date=collection.sizing_dates["start_date"],
+                    num_dates_enrollment=collection.sizing_dates["num_dates_enrollment"],
+                    analysis_length=collection.sizing_dates["analysis_length"],
+                    parameters=collection.sizing_parameters,
+                    config_file=config_file,
+                    analysis_lengths=collection.sizing_dates.get("analysis_lengths", []),
+                )
+            )
+
+    return configs
+
+
+@attr.s(auto_attribs=True)
+class BatchResult:
+    target_slug: str
+    config_file: str
+    status: str
+    # slug of the configuration whose metrics table these results were computed from
+    metrics_from: str
+    wall_seconds: float = 0.0
+    error: Optional[str] = None
+    sample_sizes: Dict[str, Any] = attr.Factory(dict)
+
+
+@attr.s(auto_attribs=True)
+class BatchRunner:
+    """
+    Sizes many configurations concurrently. Configurations that only differ
+    in their parameters share one metrics table, which is queried once.
+    """
+
+    project_id: str
+    dataset_id: str
+    bucket: str
+    max_workers: int = 4
+    sizing_options: Dict[str, Any] = attr.Factory(dict)
+    # sizings whose jobs may still be running, so they can be cancelled when interrupted
+    _sizings: List[SizeCalculation] = attr.Factory(list)
+
+    @staticmethod
+    def group_by_metrics(
+        configs: List[SizingConfiguration],
+    ) -> List[List[SizingConfiguration]]:
+        groups: Dict[str, List[SizingConfiguration]] = {}
+        for config in configs:
+            groups.setdefault(config.fingerprint(include_parameters=False), []).append(config)
+        return list(groups.values())
+
+    def _sizing(self, config: SizingConfiguration) -> SizeCalculation:
+        sizing = SizeCalculation(
+            self.project_id, self.dataset_id, self.bucket, config, **self.sizing_options
+        )
+        self._sizings.append(sizing)
+        return sizing
+
+    def _run_group(self, group: List[SizingConfiguration], current_date: date) -> List[BatchResult]:
+        canonical = group[0].target_slug
+        start = time.perf_counter()
+        try:
+            metrics_table = self._sizing(group[0]).calculate_target_metrics(current_date)
+        except Exception as e:
+            if isinstance(e, PopulationTooSmallException):
+                status = "skipped"
+                logger.warning(str(e), extra={"target": canonical})
+                try:
+                    for config in group:
+                        self._sizing(config).publish_skipped(e, current_date.strftime("%Y-%m-%d"))
+                except Exception as publish_error:
+                    logger.exception(
+                        f"Failed to publish skipped markers: {publish_error}",
+                        exc_info=publish_error,
+                        extra={"target": canonical},
+                    )
+            else:
+                status = "failed"
+                logger.exception(str(e), exc_info=e, extra={"target": canonical})
+            return [
+                BatchResult(
+                    config.target_slug,
+                    config.config_file.name if config.config_file else "",
+                    status,
+                    canonical,
+                    time.perf_counter() - start,
+                    str(e),
+                )
+                for config in group
+            ]
+
+        results = []
+        for config in group:
+            result = BatchResult(
+                config.target_slug,
+                config.config_file.name if config.config_file else "",
+                "done",
+                canonical,
+            )
+            try:
+                if len(metrics_table) == 0:
+                    result.status = "no_clients"
+                else:
+                    sizing = self._sizing(config)
+                    result.sample_sizes = sizing.calculate_results(metrics_table)
+                    sizing.publish_results(result.sample_sizes, current_date.strftime("%Y-%m-%d"))
+            except Exception as e:
+                logger.exception(str(e), exc_info=e, extra={"target": config.target_slug})
+                result.status = "failed"
+                result.error = str(e)
+            result.wall_seconds = time.perf_counter() - start
+            results.append(result)
+
+        return results
+
+    def run(self, configs: List[SizingConfiguration], current_date: date) -> List[BatchResult]:
+        groups = self.group_by_metrics(configs)
+        logger.info(
+            f"Sizing {len(configs)} configurations with {len(groups)} distinct metrics tables"
+        )
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            try:
+                with interrupt_on_signals():
+                    group_results = executor.map(
+                        lambda group: self._run_group(group, current_date), groups
+                    )
+                    results = [result for group in group_results for result in group]
+            except RunInterruptedException:
+                # workers waiting on cancelled jobs fail, so the pool can shut down quickly
+                executor.shutdown(wait=False, cancel_futures=True)
+                for sizing in self._sizings:
+                    sizing.cancel_jobs()
+                raise
+
+        order = {config.target_slug: i for i, config in enumerate(configs)}
+        return sorted(results, key=lambda result: order[result.target_slug])
+
+
+def write_batch_report(results: List[BatchResult], path: Path) -> None:
+    report = {
+        "succeeded": sum(result.status == "done" for result in results),
+        "failed": sum(result.status == "failed" for result in results),
+        "skipped": sum(result.status == "skipped" for result in results),
+        "targets": [attr.asdict(result) for result in results],
+    }
+    path.write_text(json.dumps(report, indent=2))
+    logger.info(f"Batch report saved at {path}")
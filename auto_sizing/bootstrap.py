@@ -0,0 +1,101 @@
+import math
+import warnings
+from typing import Dict, List, Optional
+
+import numpy as np
+from pandas import DataFrame
+
+OUTLIER_PERCENTILE = 99.5
+CONFIDENCE_LEVEL = 0.95
+# memory the resampling weights may take up at once, in bytes
+MAX_BOOTSTRAP_MEMORY = 256 * 1024 * 1024
+
+
+def _poisson_weights_table(resolution: int = 2**16) -> np.ndarray:
+    """
+    Returns Poisson(1) quantiles at `resolution` evenly spaced probabilities, so
+    that indexing it with uniform random integers draws Poisson(1) weights.
+    This is several times faster than `Generator.poisson`, which dominates the
+    bootstrap's runtime otherwise.
+    """
+    cdf = np.cumsum([math.exp(-1) / math.factorial(k) for k in range(20)])
+    return np.searchsorted(cdf, (np.arange(resolution) + 0.5) / resolution).astype(np.float64)
+
+
+POISSON_WEIGHTS = _poisson_weights_table()
+
+
+def bootstrap_variance_ratios(
+    df: DataFrame,
+    metric_names: List[str],
+    num_samples: int,
+    outlier_percentile: float = OUTLIER_PERCENTILE,
+    max_memory: int = MAX_BOOTSTRAP_MEMORY,
+    seed: Optional[int] = None,
+) -> Dict[str, np.ndarray]:
+    """
+    Returns, for every metric, how much its squared coefficient of variation
+    changes in each of `num_samples` Poisson bootstrap resamples of the clients.
+
+    Sample sizes scale with the squared coefficient of variation of the metric,
+    so multiplying a point estimate by these ratios gives its bootstrap
+    distribution for any power and effect size. Values above the outlier
+    percentile are trimmed like in the point estimate, with the thresholds
+    computed once on the full data. Clients with a null value are left out of
+    the metric, as they are from the point estimate.
+
+    Every resample draws a Poisson(1) weight per client, and the weighted sums
+    of all resamples and metrics are computed as one matrix product per chunk
+    of clients. Chunks are sized so the weights fit in `max_memory`.
+    """
+    values = df[metric_names].to_numpy(dtype=np.float64)
+    with warnings.catch_warnings():
+        # metrics without any values get a NaN threshold, which excludes every client
+        warnings.simplefilter("ignore", RuntimeWarning)
+        thresholds = np.nanpercentile(values, outlier_percentile, axis=0)
+    # NaN compares as greater, so nulls are excluded with the outliers
+    included = (values <= thresholds).astype(np.float64)
+    values = np.where(included > 0, values, 0.0)
+
+    def squared_cv(count, total, total_sq):
+        with np.errstate(divide="ignore", invalid="ignore"):
+            mean = total / count
+            variance = (total_sq - total * mean) / (count - 1)
+            return variance / mean**2
+
+    point = squared_cv(included.sum(axis=0), values.sum(axis=0), (values**2).sum(axis=0))
+
+    rng = np.random.default_rng(seed)
+    count = np.zeros((num_samples, len(metric_names)))
+    total = np.zeros_like(count)
+    total_sq = np.zeros_like(count)
+    # the random indices and the weights take 10 bytes per resample and client
+    chunk_size = max(1, max_memory // (10 * num_samples))
+    for start in range(0, len(values), chunk_size):
+        chunk = slice(start, start + chunk_size)
+        draws = rng.integers(0, len(POISSON_WEIGHTS), (num_samples, len(values[chunk])), np.uint16)
+        weights = POISSON_WEIGHTS[draws]
+        count += weights @ included[chunk]
+        total += weights @ values[chunk]
+        total_sq += weights @ values[chunk] ** 2
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        ratios = squared_cv(count, total, total_sq) / point
+
+    return {name: ratios[:, i] for i, name in enumerate(metric_names)}
+
+
+def confidence_interval(
+    sample_size: float, ratios: np.ndarray, confidence_level: float = CONFIDENCE_LEVEL
+) -> Optional[List[float]]:
+    """
+    Returns the percentile bootstrap interval of a sample size, or None if it
+    isn't defined, e.g. for a metric without any non-null values.
+    """
+    if np.isnan(ratios).all():
+        return None
+    tail = (1 - confidence_level) / 2
+    lower, upper = np.nanquantile(ratios, [tail, 1 - tail])
+    interval = [float(sample_size * lower), float(sample_size * upper)]
+    # NaN isn't valid JSON
+    return interval if all(math.isfinite(bound) for bound in interval) else None
@@ -0,0 +1,39 @@
+import contextlib
+import logging
+import signal
+import threading
+from typing import Iterator, Sequence
+
+import auto_sizing.errors as errors
+
+logger = logging.getLogger(__name__)
+
+INTERRUPT_SIGNALS = (signal.SIGTERM, signal.SIGINT)
+
+
+@contextlib.contextmanager
+def interrupt_on_signals(signals: Sequence[signal.Signals] = INTERRUPT_SIGNALS) -> Iterator[None]:
+    """
+    Raises RunInterruptedException in the main thread when the process receives
+    one of `signals`, e.g. when Kubernetes stops a pod, so that callers can cancel
+    their BigQuery jobs before exiting. Repeated signals are ignored while they do.
+    """
+    if threading.current_thread() is not threading.main_thread():
+        yield
+        return
+
+    interrupted = threading.Event()
+
+    def handler(signum, frame):
+        if interrupted.is_set():
+            return
+        interrupted.set()
+        logger.warning(f"Received {signal.Signals(signum).name}, stopping")
+        raise errors.RunInterruptedException(signal.Signals(signum).name)
+
+    previous = {sig: signal.signal(sig, handler) for sig in signals}
+    try:
+        yield
+    finally:
+        for sig, previous_handler in previous.items():
+            signal.signal(sig, previous_handler)
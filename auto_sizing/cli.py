@@ -1,9 +1,25 @@
+import contextlib
 import json
 import logging
+import os
 import sys
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
 from pathlib import Path
-from typing import Callable, Iterable, List, Mapping, Optional, Protocol, TextIO, Type
+from typing import (
+    IO,
+    Any,
+    Callable,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    Mapping,
+    Optional,
+    Protocol,
+    TextIO,
+    Type,
+)
 
 import attr
 import click
@@ -12,12 +28,50 @@ import toml
 from jetstream.argo import submit_workflow
 from jetstream.logging import LOG_SOURCE
 
-from .errors import NoConfigFileException
+from .aggregate import GcsAggregateStore, aggregate_prefix, read_merged_results
+from .availability import AvailabilityPolicy, PartitionChecker, source_tables
+from .backfill import BackfillCalculation, backfill_configurations, run_date_range
+from .batch import (
+    BATCH_REPORT_FILE,
+    BatchRunner,
+    expand_config_paths,
+    load_configurations,
+    write_batch_report,
+)
+from .cancellation import interrupt_on_signals
+from .cube import (
+    CUBE_SOURCES,
+    CubeCalculation,
+    StatisticsCube,
+    cube_configuration,
+    load_cube,
+)
+from .errors import (
+    NoConfigFileException,
+    PopulationTooSmallException,
+    RunInterruptedException,
+)
 from .export_json import aggregate_and_reupload
+from .history import HistoryStore, default_history_uri
+from .ledger import RunLedger, TargetState
+from .limiter import limiter_from_uri
 from .logging import LogConfiguration
+from .manifest import write_manifest
+from .profiling import Profiler
+from .serve import GcsResultsSource, LocalResultsSource, SizingService, serve
 from .size_calculation import SizeCalculation
-from .targets import SizingCollection, SizingConfiguration
+from .sketches import RELATIVE_ERROR
+from .targets import SizingCollection, SizingConfiguration, deduplicate_worklist
 from .utils import dict_combinations
+from .validation import (
+    SCHEMA_SNAPSHOT,
+    load_schemas,
+    snapshot_schemas,
+    validate_worklist,
+    write_schemas,
+)
+from .work_queue import WorkItem, WorkQueue, default_queue_uri, queue_from_uri
+from .worker import Worker
 
 logger = logging.getLogger(__name__)
 
@@ -32,6 +86,17 @@ All = AllType()
 DATA_DIR = Path(__file__).parent / "data"
 RUN_MANIFEST = DATA_DIR / "manifest.toml"
 TARGET_SETTINGS = DATA_DIR / "target_lists.toml"
+# Argo keeps parameters in the workflow object, whose size is limited,
+# so large target lists are split across several workflows
+ARGO_SHARD_SIZE = 1000
+HISTORY_COLUMNS = [
+    "run_date",
+    "target_key",
+    "new_or_existing",
+    "sizing_key",
+    "metric",
+    "sample_size_per_branch",
+]
 
 
 class ExecutorStrategy(Protocol):
@@ -46,6 +111,36 @@ class ExecutorStrategy(Protocol):
     ) -> bool: ...
 
 
+def unfinished_targets(
+    worklist: Iterable[SizingConfiguration],
+    ledger: Optional[RunLedger],
+    rerun_completed: bool = False,
+    min_population: int = 0,
+) -> List[SizingConfiguration]:
+    """Returns the targets to submit, leaving out those the run ledger shows are complete."""
+    if ledger is None:
+        return list(worklist)
+
+    entries = ledger.entries()
+    unfinished = []
+    for config in worklist:
+        complete = ledger.is_complete(entries.get(config.target_slug), config, min_population)
+        if complete and not rerun_completed:
+            logger.info(f"Skipping {config.target_slug}: already completed for this run")
+        else:
+            # completed targets are reset to pending so that target pods don't skip them;
+            # pods run all other targets anyway, which saves a write per target
+            if complete:
+                ledger.mark(config, TargetState.PENDING)
+            unfinished.append(config)
+
+    return unfinished
+
+
+def work_items(worklist: Iterable[SizingConfiguration]) -> List[WorkItem]:
+    return [WorkItem(config.target_slug, ",".join(config.duplicate_slugs)) for config in worklist]
+
+
 @attr.s(auto_attribs=True)
 class ArgoExecutorStrategy:
     project_id: str
@@ -57,33 +152,144 @@ class ArgoExecutorStrategy:
     cluster_ip: Optional[str] = None
     cluster_cert: Optional[str] = None
     experiment_getter: Callable = SizingCollection.from_repo
+    ledger: Optional[RunLedger] = None
+    rerun_completed: bool = False
+    max_concurrent_queries: int = 10
+    min_population: int = 0
+    bootstrap_samples: int = 0
+    data_availability: str = AvailabilityPolicy.FAIL.value
+    availability_timeout: int = 360
+    shard_size: int = ARGO_SHARD_SIZE
+    # each shard's workflow runs up to 5 pods, so this caps the pods of the whole run
+    max_parallel_shards: int = 1
+    # number of worker pods that claim targets from a queue, instead of one pod per target
+    workers: int = 0
+    queue_uri: Optional[str] = None
 
     WORKFLOW_DIR = Path(__file__).parent / "workflows"
     RUN_WORKFLOW = WORKFLOW_DIR / "run.yaml"
+    WORKERS_WORKFLOW = WORKFLOW_DIR / "workers.yaml"
+    EXPORT_WORKFLOW = WORKFLOW_DIR / "export.yaml"
 
     def execute(
         self,
         worklist: Iterable[SizingConfiguration],
     ):
-        targets_list = [{"slug": config.target_slug} for config in worklist]
+        unfinished = unfinished_targets(
+            worklist, self.ledger, self.rerun_completed, self.min_population
+        )
+        if not unfinished:
+            logger.info("All targets already completed for this run")
+            return True
+
+        if self.workers:
+            return self._execute_workers(unfinished)
+
+        targets_list = [
+            {"slug": config.target_slug, "duplicates": ",".join(config.duplicate_slugs)}
+            for config in unfinished
+        ]
         logger.debug(f"TARGETS LIST: {targets_list}")
 
+        bounds = [*range(0, len(targets_list), self.shard_size), len(targets_list)]
+        shards = [targets_list[start:end] for start, end in zip(bounds, bounds[1:])]
+        if len(shards) == 1:
+            return self._submit(
+                self.RUN_WORKFLOW,
+                {"targets": shards[0], **self._sizing_parameters()},
+                self.monitor_status,
+            )
+
+        # shards run side by side and skip their export step, so that the results of all
+        # shards are exported and finalized once, after every shard has finished
+        logger.info(
+            f"Submitting {len(targets_list)} targets in {len(shards)} workflows, "
+            + f"{self.max_parallel_shards} at a time"
+        )
+
+        def submit_shard(shard: List[Dict[str, str]]) -> bool:
+            try:
+                return self._submit(
+                    self.RUN_WORKFLOW,
+                    {"targets": shard, "export": "false", **self._sizing_parameters()},
+                    monitor_status=True,
+                )
+            except Exception as e:
+                # a failed shard doesn't stop the results of the others from being exported
+                logger.exception(f"Workflow of {len(shard)} targets failed: {e}", exc_info=e)
+                return False
+
+        with ThreadPoolExecutor(max_workers=min(len(shards), self.max_parallel_shards)) as executor:
+            succeeded = list(executor.map(submit_shard, shards))
+
+        exported = self._submit(
+            self.EXPORT_WORKFLOW,
+            {"project_id": self.project_id, "bucket": self.bucket},
+            self.monitor_status,
+        )
+        return all(succeeded) and exported
+
+    def _sizing_parameters(self) -> Dict[str, Any]:
+        return {
+            "project_id": self.project_id,
+            "dataset_id": self.dataset_id,
+            "bucket": self.bucket,
+            "max_concurrent_queries": self.max_concurrent_queries,
+            "min_population": self.min_population,
+            "bootstrap_samples": self.bootstrap_samples,
+            "data_availability": self.data_availability,
+            "availability_timeout": self.availability_timeout,
+        }
+
+    def _submit(
+        self, workflow_file: Path, parameters: Dict[str, Any], monitor_status: bool
+    ) -> bool:
         return submit_workflow(
             project_id=self.project_id,
             zone=self.zone,
             cluster_id=self.cluster_id,
-            workflow_file=self.RUN_WORKFLOW,
-            parameters={
-                "targets": targets_list,
-                "project_id": self.project_id,
-                "dataset_id": self.dataset_id,
-                "bucket": self.bucket,
-            },
-            monitor_status=self.monitor_status,
+            workflow_file=workflow_file,
+            parameters=parameters,
+            monitor_status=monitor_status,
             cluster_ip=self.cluster_ip,
             cluster_cert=self.cluster_cert,
         )
 
+    def _execute_workers(self, unfinished: List[SizingConfiguration]) -> bool:
+        queue_uri = self.queue_uri or default_queue_uri(
+            self.bucket, datetime.now(tz=pytz.utc).date().strftime("%Y-%m-%d")
+        )
+        num_items = queue_from_uri(queue_uri, self.project_id).enqueue(work_items(unfinished))
+        logger.info(f"Queued {num_items} targets for {self.workers} workers at {queue_uri}")
+
+        return self._submit(
+            self.WORKERS_WORKFLOW,
+            {
+                "workers": list(range(self.workers)),
+                "queue_uri": queue_uri,
+                **self._sizing_parameters(),
+            },
+            self.monitor_status,
+        )
+
+
+@attr.s(auto_attribs=True)
+class QueueExecutorStrategy:
+    """Adds the targets to a queue that `worker` processes claim them from."""
+
+    project_id: str
+    dataset_id: str
+    queue: WorkQueue
+    ledger: Optional[RunLedger] = None
+    rerun_completed: bool = False
+
+    def execute(self, worklist: Iterable[SizingConfiguration]) -> bool:
+        num_items = self.queue.enqueue(
+            work_items(unfinished_targets(worklist, self.ledger, self.rerun_completed))
+        )
+        logger.info(f"Queued {num_items} targets")
+        return True
+
 
 @attr.s(auto_attribs=True)
 class SerialExecutorStrategy:
@@ -92,16 +298,72 @@ class SerialExecutorStrategy:
     bucket: str
     sizing_class: Type = SizeCalculation
     experiment_getter: Callable = SizingCollection.from_repo
+    ledger: Optional[RunLedger] = None
+    sizing_options: Dict[str, Any] = attr.Factory(dict)
+    profile: bool = False
+    cprofile_dir: Optional[Path] = None
+
+    def _run_profiled(self, sizing: Any, profiler: Profiler) -> None:
+        current_date = datetime.now(tz=pytz.utc).date()
+        profiler.start()
+        try:
+            sizing.run(current_date)
+        finally:
+            profiler.stop()
+            # profiles of failed targets are kept too, e.g. to diagnose running out of memory
+            try:
+                sizing.publish_profile(current_date.strftime("%Y-%m-%d"))
+            except Exception as e:
+                logger.exception(f"Failed to publish profile: {e}", exc_info=e)
 
     def execute(self, worklist: List[SizingConfiguration]):
+        with interrupt_on_signals():
+            return self._execute(worklist)
+
+    def _execute(self, worklist: List[SizingConfiguration]):
         failed = False
+        min_population = self.sizing_options.get("min_population") or 0
         for config in worklist:
+            if self.ledger is not None:
+                if not self.ledger.needs_run(config, min_population):
+                    logger.info(f"Skipping {config.target_slug}: already completed for this run")
+                    continue
+                self.ledger.mark(config, TargetState.RUNNING)
+
+            sizing = None
             try:
-                sizing = self.sizing_class(self.project_id, self.dataset_id, self.bucket, config)
-                sizing.run(datetime.now(tz=pytz.utc).date())
+                sizing_options = dict(self.sizing_options)
+                if self.profile:
+                    sizing_options["profiler"] = Profiler(config.target_slug, self.cprofile_dir)
+
+                sizing = self.sizing_class(
+                    self.project_id, self.dataset_id, self.bucket, config, **sizing_options
+                )
+                if self.profile:
+                    self._run_profiled(sizing, sizing_options["profiler"])
+                else:
+                    sizing.run(datetime.now(tz=pytz.utc).date())
+
+                if self.ledger is not None:
+                    self.ledger.mark(config, TargetState.DONE)
+
+            except RunInterruptedException as e:
+                logger.warning(str(e), extra={"target": config.target_slug})
+                if sizing is not None:
+                    sizing.cancel_jobs()
+                if self.ledger is not None:
+                    self.ledger.mark(config, TargetState.INTERRUPTED)
+                raise
+
+            except PopulationTooSmallException as e:
+                logger.warning(str(e), extra={"target": config.target_slug})
+                if self.ledger is not None:
+                    self.ledger.mark(config, TargetState.SKIPPED, e.min_population)
 
             except Exception as e:
                 logger.exception(str(e), exc_info=e, extra={"target": config.target_slug})
+                if self.ledger is not None:
+                    self.ledger.mark(config, TargetState.FAILED)
                 failed = True
 
         return not failed
@@ -116,6 +378,7 @@ class AnalysisExecutor:
     target_slug: str = attr.ib(None)
     run_preset_jobs: Optional[bool] = False
     refresh_manifest: Optional[bool] = False
+    duplicate_slugs: List[str] = attr.Factory(list)
 
     @staticmethod
     def _today() -> datetime:
@@ -133,47 +396,37 @@ class AnalysisExecutor:
     ) -> bool:
         target_collection = SizingCollection()
 
-        worklist = self._target_list_to_analyze(target_collection)
+        worklist = deduplicate_worklist(self._target_list_to_analyze(target_collection))
 
         return strategy.execute(worklist)
 
     def _target_list_to_analyze(
         self, target_collection: SizingCollection
-    ) -> List[SizingConfiguration]:
+    ) -> Iterator[SizingConfiguration]:
+        """
+        Yields the configurations of the targets to size one at a time, so
+        that a manifest entry is only resolved when its target is consumed.
+        """
         if self.configuration_file:
             sizing_job = target_collection.from_file(self.configuration_file)
-            return self._target_to_sizingconfigurations_file(sizing_job)
+            yield from self._target_to_sizingconfigurations_file(sizing_job)
 
         elif self.run_preset_jobs:
             jobs_dict = toml.load(TARGET_SETTINGS)
             jobs_manifest = toml.load(RUN_MANIFEST)
             if isinstance(self.target_slug, AllType):
                 if self.refresh_manifest:
-                    target_list = dict_combinations(jobs_dict, "targets")
-                    jobs_manifest = {}
-
-                    target_num = 0
-                    for app_id in ["firefox_desktop", "firefox_ios", "fenix"]:
-                        for target in target_list:
-                            jobs_manifest[f"argo_target_{target_num}"] = {
-                                "app_id": app_id,
-                                "target_recipe": json.dumps(target),
-                            }
-                            target_num += 1
-                    with open(RUN_MANIFEST, "w") as f:
-                        toml.dump(jobs_manifest, f)
-                worklist = []
+                    refresh_manifest_file(TARGET_SETTINGS, RUN_MANIFEST)
+                    jobs_manifest = toml.load(RUN_MANIFEST)
                 for target_slug, job_target in jobs_manifest.items():
                     sizing_collections = target_collection.from_repo(
                         json.loads(job_target["target_recipe"]),
                         jobs_dict,
                         app_id=job_target["app_id"],
                     )
-                    sizing_config = self._target_to_sizingconfigurations_repo(
+                    yield from self._target_to_sizingconfigurations_repo(
                         sizing_collections, target_slug
                     )
-                    worklist.extend(sizing_config)
-                return worklist
 
             else:
                 job_target = jobs_manifest[self.target_slug]
@@ -183,7 +436,7 @@ class AnalysisExecutor:
                     app_id=job_target["app_id"],
                 )
 
-                return self._target_to_sizingconfigurations_repo(sizing_collections)
+                yield from self._target_to_sizingconfigurations_repo(sizing_collections)
 
         else:
             raise NoConfigFileException
@@ -201,6 +454,7 @@ class AnalysisExecutor:
             analysis_length=target_list.sizing_dates["analysis_length"],
             parameters=target_list.sizing_parameters,
             config_file=self.configuration_file,
+            analysis_lengths=target_list.sizing_dates.get("analysis_lengths", []),
         )
 
         return [config]
@@ -216,6 +470,8 @@ class AnalysisExecutor:
             num_dates_enrollment=target.sizing_dates["num_dates_enrollment"],
             analysis_length=target.sizing_dates["analysis_length"],
             parameters=target.sizing_parameters,
+            analysis_lengths=target.sizing_dates.get("analysis_lengths", []),
+            duplicate_slugs=[] if target_slug else list(self.duplicate_slugs),
         )
 
         return [config]
@@ -251,6 +507,18 @@ log_source = click.option(
 @log_table_id_option
 @click.option("--log_to_bigquery", "--log-to-bigquery", is_flag=True, default=False)
 @log_source
+@click.option(
+    "--profile",
+    help="Record wall time, CPU time and peak memory of each stage of every target",
+    is_flag=True,
+    default=False,
+)
+@click.option(
+    "--cprofile_dir",
+    "--cprofile-dir",
+    help="Directory to write a cProfile file per target to when profiling",
+    type=click.Path(file_okay=False, path_type=Path),
+)
 @click.pass_context
 def cli(
     ctx,
@@ -259,6 +527,8 @@ def cli(
     log_table_id,
     log_to_bigquery,
     log_source,
+    profile,
+    cprofile_dir,
 ):
     log_config = LogConfiguration(
         log_project_id,
@@ -270,6 +540,55 @@ def cli(
     log_config.setup_logger()
     ctx.ensure_object(dict)
     ctx.obj["log_config"] = log_config
+    ctx.obj["profile"] = profile
+    ctx.obj["cprofile_dir"] = cprofile_dir
+
+
+def is_config_batch(config_file: Optional[str]) -> bool:
+    """Whether --config-file names a directory or glob of config files rather than one file."""
+    return (
+        config_file is not None and config_file not in ["", "-"] and not Path(config_file).is_file()
+    )
+
+
+@contextlib.contextmanager
+def open_config_file(config_file: Optional[str]) -> Iterator[Optional[IO[Any]]]:
+    """Opens a single config file, or stdin for `-`, and closes it once sizing is done."""
+    if not config_file:
+        yield None
+        return
+    with click.open_file(config_file) as configuration_file:
+        yield configuration_file
+
+
+def availability_options(
+    project_id: str, data_availability: str, availability_timeout: int
+) -> Dict[str, Any]:
+    if data_availability == AvailabilityPolicy.IGNORE:
+        return {}
+    # shared by all targets so that each table's partitions are only looked up once
+    return {
+        "availability": PartitionChecker(
+            project_id, AvailabilityPolicy(data_availability), timeout=availability_timeout * 60
+        )
+    }
+
+
+def parse_stage_timeouts(values: Iterable[str]) -> Dict[str, Any]:
+    """Parses `--stage-timeout` values in minutes into sizing options in seconds."""
+    options: Dict[str, Any] = {}
+    for value in values:
+        prefix, _, minutes = value.rpartition("=")
+        try:
+            seconds = float(minutes) * 60
+        except ValueError:
+            raise click.BadParameter(f"Invalid stage timeout: {value}")
+        if prefix:
+            options.setdefault("stage_timeouts", {})[prefix] = seconds
+        else:
+            options["stage_timeout"] = seconds
+
+    return options
 
 
 class ClickDate(click.ParamType):
@@ -301,10 +620,17 @@ config_file_option = click.option(
     "config_file",
     "--local-config",
     "--config-file",
-    help="Path to local config TOML file that contains settings for sizing job",
-    type=click.File("rt"),
+    help="Path to local config TOML file that contains settings for sizing job, "
+    + "'-' to read it from stdin, or a directory or glob of config files to size concurrently",
 )
 bucket_option = click.option("--bucket", help="GCS bucket to write to", required=False)
+duplicate_slugs_option = click.option(
+    "--duplicate_slugs",
+    "--duplicate-slugs",
+    help="Comma-separated slugs of equivalent targets that should receive the same results",
+    default="",
+    required=False,
+)
 run_presets_option = click.option(
     "--run_presets",
     "--run-presets",
@@ -312,6 +638,87 @@ run_presets_option = click.option(
     is_flag=True,
     default=False,
 )
+run_id_option = click.option(
+    "--run_id",
+    "--run-id",
+    help="Identifier shared by retries of the same run, used to reattach to running BigQuery jobs",
+    required=False,
+)
+max_concurrent_queries_option = click.option(
+    "--max_concurrent_queries",
+    "--max-concurrent-queries",
+    help="Maximum number of BigQuery jobs that all sizing workers may run at the same time",
+    type=int,
+    required=False,
+)
+limiter_uri_option = click.option(
+    "--limiter_uri",
+    "--limiter-uri",
+    help="gs:// prefix or local directory where query slots are coordinated "
+    + "(defaults to the bucket's sample_sizes/limiter prefix)",
+    required=False,
+)
+merge_results_option = click.option(
+    "--merge_results",
+    "--merge-results",
+    help="Merge the results of preset targets into the run's aggregate as soon as they finish",
+    is_flag=True,
+    default=False,
+)
+queue_uri_option = click.option(
+    "--queue_uri",
+    "--queue-uri",
+    help="gs:// prefix or local SQLite file of the queue that workers claim targets from "
+    + "(defaults to the bucket's queue for today's run)",
+    required=False,
+)
+min_population_option = click.option(
+    "--min_population",
+    "--min-population",
+    help="Skip targets with fewer clients before querying their metrics",
+    type=int,
+    default=0,
+)
+bootstrap_samples_option = click.option(
+    "--bootstrap_samples",
+    "--bootstrap-samples",
+    help="Number of bootstrap resamples used to publish 95% intervals of sample sizes",
+    type=int,
+    default=0,
+)
+
+
+def data_availability_option(default: AvailabilityPolicy = AvailabilityPolicy.IGNORE):
+    return click.option(
+        "--data_availability",
+        "--data-availability",
+        help="Whether to fail or wait when partitions a target reads haven't landed yet",
+        type=click.Choice([policy.value for policy in AvailabilityPolicy]),
+        default=default.value,
+    )
+
+
+availability_timeout_option = click.option(
+    "--availability_timeout",
+    "--availability-timeout",
+    help="Minutes to wait for partitions to land with --data-availability=wait",
+    type=int,
+    default=360,
+)
+stage_timeout_option = click.option(
+    "--stage_timeout",
+    "--stage-timeout",
+    help="Minutes a stage's query may run before it is cancelled, either for all stages "
+    + "or for stages starting with a prefix, e.g. metrics=90. Can be given several times.",
+    multiple=True,
+)
+ignore_ledger_option = click.option(
+    "--ignore_ledger",
+    "--ignore-ledger",
+    help="Recompute targets even if the run ledger shows they were already completed today",
+    is_flag=True,
+    default=False,
+)
 refresh_manifest_option = click.option(
     "--refresh_manifest",
     "--refresh-manifest",
@@ -349,6 +756,12 @@ cluster_cert_option = click.option(
     "--cluster-cert",
     help="Kubernetes cluster certificate used for authenticating to the cluster",
 )
+history_uri_option = click.option(
+    "--history_uri",
+    "--history-uri",
+    help="gs:// prefix or local directory of the results history "
+    + "(defaults to the bucket's sample_sizes/history prefix)",
+)
 run_date_option = click.option(
     "--run-date",
     type=ClickDate(),
@@ -365,6 +778,37 @@ run_date_option = click.option(
 @bucket_option
 @config_file_option
 @run_presets_option
+@duplicate_slugs_option
+@ignore_ledger_option
+@run_id_option
+@max_concurrent_queries_option
+@limiter_uri_option
+@min_population_option
+@click.option(
+    "--split_data_sources",
+    "--split-data-sources",
+    help="Query the metrics of each data source separately and concurrently",
+    is_flag=True,
+    default=False,
+)
+@bootstrap_samples_option
+@merge_results_option
+@data_availability_option()
+@availability_timeout_option
+@stage_timeout_option
+@click.option(
+    "--max_workers",
+    "--max-workers",
+    help="Number of config files to size concurrently when given a directory or glob",
+    type=int,
+    default=4,
+)
+@click.option(
+    "--report",
+    help="Path of the combined report when sizing a directory or glob of config files "
+    + f"(defaults to {BATCH_REPORT_FILE} next to the config files)",
+    type=click.Path(dir_okay=False, path_type=Path),
+)
 @click.pass_context
 def run(
     ctx,
@@ -374,23 +818,90 @@ def run(
     bucket,
     config_file,
     run_presets,
+    duplicate_slugs,
+    ignore_ledger,
+    run_id,
+    max_concurrent_queries,
+    limiter_uri,
+    min_population,
+    split_data_sources,
+    bootstrap_samples,
+    merge_results,
+    data_availability,
+    availability_timeout,
+    stage_timeout,
+    max_workers,
+    report,
 ):
     """Runs analysis for the provided date."""
     if not run_presets and not config_file:
         raise Exception("Either provide a config file or run auto sizing presets.")
 
-    analysis_executor = AnalysisExecutor(
-        target_slug=target_slug,
-        project_id=project_id,
-        dataset_id=dataset_id,
-        bucket=bucket,
-        configuration_file=config_file if config_file else None,
-        run_preset_jobs=run_presets,
-    )
+    # only preset targets have stable slugs that can be tracked across reruns
+    ledger = None
+    if run_presets and bucket and not ignore_ledger:
+        ledger = RunLedger.for_run(
+            project_id, bucket, datetime.now(tz=pytz.utc).date().strftime("%Y-%m-%d")
+        )
 
-    success = analysis_executor.execute(
-        strategy=SerialExecutorStrategy(project_id, dataset_id, bucket),
-    )
+    sizing_options = {
+        "min_population": min_population,
+        "split_data_sources": split_data_sources,
+        "bootstrap_samples": bootstrap_samples,
+    }
+    sizing_options.update(parse_stage_timeouts(stage_timeout))
+    sizing_options.update(availability_options(project_id, data_availability, availability_timeout))
+    if run_id:
+        sizing_options["run_id"] = run_id
+    if merge_results and run_presets and bucket:
+        sizing_options["aggregate"] = GcsAggregateStore(
+            project_id,
+            bucket,
+            aggregate_prefix(datetime.now(tz=pytz.utc).date().strftime("%Y-%m-%d")),
+        )
+    if max_concurrent_queries:
+        if not limiter_uri and not bucket:
+            raise Exception("Limiting concurrent queries requires a --limiter-uri or a bucket.")
+        sizing_options["limiter"] = limiter_from_uri(
+            limiter_uri or f"gs://{bucket}/sample_sizes/limiter",
+            project_id,
+            max_concurrent_queries,
+        )
+
+    if is_config_batch(config_file):
+        config_paths = expand_config_paths(config_file)
+        if not config_paths:
+            raise NoConfigFileException(f"No config files found at {config_file}.")
+
+        results = BatchRunner(
+            project_id, dataset_id, bucket, max_workers, sizing_options=sizing_options
+        ).run(load_configurations(config_paths), datetime.now(tz=pytz.utc).date())
+        report_dir = Path(os.path.commonpath([path.parent for path in config_paths]))
+        write_batch_report(results, report or report_dir / BATCH_REPORT_FILE)
+        sys.exit(0 if all(result.status != "failed" for result in results) else 1)
+
+    with open_config_file(config_file) as configuration_file:
+        analysis_executor = AnalysisExecutor(
+            target_slug=target_slug,
+            project_id=project_id,
+            dataset_id=dataset_id,
+            bucket=bucket,
+            configuration_file=configuration_file,
+            run_preset_jobs=run_presets,
+            duplicate_slugs=[slug for slug in duplicate_slugs.split(",") if slug],
+        )
+
+        success = analysis_executor.execute(
+            strategy=SerialExecutorStrategy(
+                project_id,
+                dataset_id,
+                bucket,
+                ledger=ledger,
+                sizing_options=sizing_options,
+                profile=ctx.obj.get("profile", False),
+                cprofile_dir=ctx.obj.get("cprofile_dir"),
+            ),
+        )
 
     sys.exit(0 if success else 1)
 
@@ -406,6 +917,34 @@ def run(
 @cluster_ip_option
 @cluster_cert_option
 @refresh_manifest_option
+@ignore_ledger_option
+@max_concurrent_queries_option
+@min_population_option
+@bootstrap_samples_option
+@data_availability_option(AvailabilityPolicy.FAIL)
+@availability_timeout_option
+@click.option(
+    "--shard_size",
+    "--shard-size",
+    default=ARGO_SHARD_SIZE,
+    help="Maximum number of targets submitted in a single Argo workflow",
+    type=click.IntRange(min=1),
+)
+@click.option(
+    "--max_parallel_shards",
+    "--max-parallel-shards",
+    default=1,
+    help="Number of shard workflows that run at the same time, each with up to 5 pods",
+    type=click.IntRange(min=1),
+)
+@click.option(
+    "--workers",
+    help="Size the targets with this many worker pods that claim them from a queue, "
+    + "instead of one pod per target",
+    type=click.IntRange(min=0),
+    default=0,
+)
+@queue_uri_option
 def run_argo(
     project_id,
     dataset_id,
@@ -417,6 +956,16 @@ def run_argo(
     cluster_ip,
     cluster_cert,
     refresh_manifest,
+    ignore_ledger,
+    max_concurrent_queries,
+    min_population,
+    bootstrap_samples,
+    data_availability,
+    availability_timeout,
+    shard_size,
+    max_parallel_shards,
+    workers,
+    queue_uri,
 ):
     """Runs analysis for the provided date using Argo."""
     if not bucket:
@@ -431,7 +980,21 @@ def run_argo(
         monitor_status=monitor_status,
         cluster_ip=cluster_ip,
         cluster_cert=cluster_cert,
+        ledger=RunLedger.for_run(
+            project_id, bucket, datetime.now(tz=pytz.utc).date().strftime("%Y-%m-%d")
+        ),
+        rerun_completed=ignore_ledger,
+        min_population=min_population,
+        bootstrap_samples=bootstrap_samples,
+        data_availability=data_availability,
+        availability_timeout=availability_timeout,
+        shard_size=shard_size,
+        max_parallel_shards=max_parallel_shards,
+        workers=workers,
+        queue_uri=queue_uri,
     )
+    if max_concurrent_queries:
+        strategy.max_concurrent_queries = max_concurrent_queries
 
     AnalysisExecutor(
         project_id=project_id,
@@ -443,14 +1006,308 @@ def run_argo(
     ).execute(strategy=strategy)
 
 
+@cli.command()
+@project_id_option
+@dataset_id_option
+@target_slug_option
+@bucket_option
+@queue_uri_option
+@refresh_manifest_option
+@ignore_ledger_option
+def enqueue(
+    project_id, dataset_id, target_slug, bucket, queue_uri, refresh_manifest, ignore_ledger
+):
+    """Adds the preset targets that aren't complete yet to the queue that workers claim from."""
+    if not queue_uri and not bucket:
+        raise Exception("A queue requires a --queue-uri or a bucket.")
+
+    run_date = datetime.now(tz=pytz.utc).date().strftime("%Y-%m-%d")
+    AnalysisExecutor(
+        project_id=project_id,
+        dataset_id=dataset_id,
+        bucket=bucket,
+        target_slug=target_slug if target_slug else All,
+        run_preset_jobs=True,
+        refresh_manifest=refresh_manifest,
+    ).execute(
+        strategy=QueueExecutorStrategy(
+            project_id,
+            dataset_id,
+            queue_from_uri(queue_uri or default_queue_uri(bucket, run_date), project_id),
+            ledger=RunLedger.for_run(project_id, bucket, run_date) if bucket else None,
+            rerun_completed=ignore_ledger,
+        )
+    )
+
+
+@cli.command()
+@project_id_option
+@dataset_id_option
+@bucket_option
+@queue_uri_option
+@run_id_option
+@max_concurrent_queries_option
+@limiter_uri_option
+@min_population_option
+@bootstrap_samples_option
+@data_availability_option(AvailabilityPolicy.FAIL)
+@availability_timeout_option
+@merge_results_option
+@ignore_ledger_option
+@click.option(
+    "--poll_interval",
+    "--poll-interval",
+    help="Seconds to wait for targets claimed by other workers before checking the queue again",
+    type=float,
+    default=60.0,
+)
+@click.option(
+    "--max_attempts",
+    "--max-attempts",
+    help="Number of times a failed target is sized before the worker gives up on it",
+    type=int,
+    default=3,
+)
+def worker(
+    project_id,
+    dataset_id,
+    bucket,
+    queue_uri,
+    run_id,
+    max_concurrent_queries,
+    limiter_uri,
+    min_population,
+    bootstrap_samples,
+    data_availability,
+    availability_timeout,
+    merge_results,
+    ignore_ledger,
+    poll_interval,
+    max_attempts,
+):
+    """
+    Claims preset targets from a queue and sizes them until the queue is
+    drained. Clients and metric-hub definitions are reused across targets.
+    """
+    if not bucket:
+        raise Exception("A GCS bucket must be provided to save results of queued targets.")
+
+    run_date = datetime.now(tz=pytz.utc).date().strftime("%Y-%m-%d")
+    sizing_options = {"min_population": min_population, "bootstrap_samples": bootstrap_samples}
+    sizing_options.update(availability_options(project_id, data_availability, availability_timeout))
+    if run_id:
+        sizing_options["run_id"] = run_id
+    if merge_results:
+        sizing_options["aggregate"] = GcsAggregateStore(
+            project_id, bucket, aggregate_prefix(run_date)
+        )
+    if max_concurrent_queries:
+        sizing_options["limiter"] = limiter_from_uri(
+            limiter_uri or f"gs://{bucket}/sample_sizes/limiter",
+            project_id,
+            max_concurrent_queries,
+        )
+
+    strategy = SerialExecutorStrategy(
+        project_id,
+        dataset_id,
+        bucket,
+        ledger=None if ignore_ledger else RunLedger.for_run(project_id, bucket, run_date),
+        sizing_options=sizing_options,
+    )
+
+    def run_target(item: WorkItem) -> bool:
+        return AnalysisExecutor(
+            project_id=project_id,
+            dataset_id=dataset_id,
+            bucket=bucket,
+            target_slug=item.slug,
+            run_preset_jobs=True,
+            duplicate_slugs=[slug for slug in item.duplicates.split(",") if slug],
+        ).execute(strategy=strategy)
+
+    queue = queue_from_uri(queue_uri or default_queue_uri(bucket, run_date), project_id)
+    success = Worker(
+        queue, run_target, poll_interval=poll_interval, max_attempts=max_attempts
+    ).run()
+
+    sys.exit(0 if success else 1)
+
+
+@cli.command()
+@project_id_option
+@dataset_id_option
+@target_slug_option
+@config_file_option
+@click.option(
+    "--report",
+    help="Path to write the report to instead of printing it",
+    type=click.Path(dir_okay=False, path_type=Path),
+)
+def preflight(project_id, dataset_id, target_slug, config_file, report):
+    """
+    Checks that the partitions every target reads have landed and that its
+    queries only scan the partitions they need, without running them.
+    """
+    with open_config_file(config_file) as configuration_file:
+        executor = AnalysisExecutor(
+            project_id=project_id,
+            dataset_id=dataset_id,
+            bucket=None,
+            configuration_file=configuration_file,
+            target_slug=target_slug if target_slug or config_file else All,
+            run_preset_jobs=not config_file,
+        )
+        worklist = deduplicate_worklist(executor._target_list_to_analyze(SizingCollection()))
+
+    checker = PartitionChecker(project_id)
+    current_date = datetime.now(tz=pytz.utc).date()
+    results = {}
+    for config in worklist:
+        sizing = SizeCalculation(project_id, dataset_id, None, config, availability=checker)
+        try:
+            time_limits = sizing._validate_requested_timelimits(current_date)
+            missing = checker.missing_dates(source_tables(config), *sizing._data_dates(time_limits))
+            results[config.target_slug] = {
+                "missing_partitions": {
+                    table: [str(d) for d in dates] for table, dates in missing.items()
+                },
+                "queries": sizing.pruning_report(current_date),
+            }
+        except Exception as e:
+            logger.exception(str(e), exc_info=e, extra={"target": config.target_slug})
+            results[config.target_slug] = {"error": str(e)}
+
+    report_json = json.dumps(results, indent=2)
+    if report:
+        report.write_text(report_json)
+    else:
+        print(report_json)
+
+    ready = all(
+        "error" not in result
+        and not result["missing_partitions"]
+        and all(query["pruned"] is not False for query in result["queries"])
+        for result in results.values()
+    )
+    sys.exit(0 if ready else 1)
+
+
+@cli.command()
+@project_id_option
+@dataset_id_option
+@target_slug_option
+@config_file_option
+@click.option(
+    "--schemas",
+    "schemas_file",
+    help="Schema snapshot to check the columns that queries read against",
+    type=click.Path(dir_okay=False, path_type=Path),
+    default=SCHEMA_SNAPSHOT,
+)
+@click.option(
+    "--update_schemas",
+    "--update-schemas",
+    help="Path to write a schema snapshot of the tables the worklist reads in BigQuery to",
+    type=click.Path(dir_okay=False, path_type=Path),
+)
+@click.option(
+    "--max_workers",
+    "--max-workers",
+    help="Number of processes that validate targets, by default one per CPU",
+    type=int,
+)
+@click.option(
+    "--report",
+    help="Path to write the report to instead of printing it",
+    type=click.Path(dir_okay=False, path_type=Path),
+)
+def validate(
+    project_id,
+    dataset_id,
+    target_slug,
+    config_file,
+    schemas_file,
+    update_schemas,
+    max_workers,
+    report,
+):
+    """
+    Renders the queries of every target and parses them offline, reporting
+    syntax errors and columns the schema snapshot doesn't have, so broken
+    targets are caught before they are launched.
+    """
+    current_date = datetime.now(tz=pytz.utc).date()
+    if is_config_batch(config_file):
+        config_paths = expand_config_paths(config_file)
+        if not config_paths:
+            raise NoConfigFileException(f"No config files found at {config_file}.")
+        worklist = load_configurations(config_paths)
+    else:
+        with open_config_file(config_file) as configuration_file:
+            executor = AnalysisExecutor(
+                project_id=project_id,
+                dataset_id=dataset_id,
+                bucket=None,
+                configuration_file=configuration_file,
+                target_slug=target_slug if target_slug or config_file else All,
+                run_preset_jobs=not config_file,
+            )
+            worklist = deduplicate_worklist(executor._target_list_to_analyze(SizingCollection()))
+
+    schemas = load_schemas(schemas_file)
+    results = validate_worklist(
+        worklist, current_date, schemas, project_id, dataset_id, max_workers=max_workers
+    )
+    if update_schemas:
+        tables = [table for result in results.values() for table in result["tables"]]
+        write_schemas(snapshot_schemas(project_id, tables), update_schemas)
+        logger.info(f"Wrote the schemas of {len(set(tables))} tables to {update_schemas}")
+        schemas = load_schemas(update_schemas)
+        results = validate_worklist(
+            worklist, current_date, schemas, project_id, dataset_id, max_workers=max_workers
+        )
+
+    report_json = json.dumps(results, indent=2)
+    if report:
+        report.write_text(report_json)
+    else:
+        print(report_json)
+
+    invalid = [slug for slug, result in results.items() if result["errors"]]
+    logger.info(f"{len(results) - len(invalid)} of {len(results)} targets are valid")
+    sys.exit(1 if invalid else 0)
+
+
 @cli.command()
 @project_id_option
 @bucket_option
 @run_date_option
-def export_aggregate_results(project_id, bucket, run_date):
+@click.option(
+    "--parquet",
+    help="Also export the aggregated results as a Parquet file",
+    is_flag=True,
+    default=False,
+)
+@click.option(
+    "--history",
+    help="Also append the results to the partitioned Parquet history",
+    is_flag=True,
+    default=False,
+)
+@history_uri_option
+@click.option(
+    "--finalize",
+    help="Publish the aggregate that targets merged their results into, "
+    + "only downloading the results that weren't merged",
+    is_flag=True,
+    default=False,
+)
+def export_aggregate_results(project_id, bucket, run_date, parquet, history, history_uri, finalize):
     """
     Retrieves all results from an auto_sizing Argo run from a GCS bucket.
-    Aggregates those results into one JSON file and reuploads to that bucket.
+    Aggregates those results into one JSON file and reuploads to that bucket,
+    along with per-app shards and an index of the target keys they contain.
     """
     if bucket is None:
         raise ValueError("A GCS bucket must be provided to export aggregate results.")
@@ -461,25 +1318,152 @@ def export_aggregate_results(project_id, bucket, run_date):
     else:
         run_date_str = run_date.strftime("%Y-%m-%d")
 
-    aggregate_and_reupload(project_id=project_id, bucket_name=bucket, run_date=run_date_str)
+    aggregate_and_reupload(
+        project_id=project_id,
+        bucket_name=bucket,
+        run_date=run_date_str,
+        write_parquet=parquet,
+        history=(
+            HistoryStore.from_uri(history_uri or default_history_uri(bucket)) if history else None
+        ),
+        merged=(
+            read_merged_results(
+                GcsAggregateStore(project_id, bucket, aggregate_prefix(run_date_str))
+            )
+            if finalize
+            else None
+        ),
+    )
+
+
+@cli.command()
+@bucket_option
+@history_uri_option
+@click.option("--app_id", "--app-id", help="App to return results of")
+@click.option("--target_key", "--target-key", help="Target key, e.g. firefox_desktop:release:US")
+@click.option("--metric", help="Metric to return results of")
+@click.option("--sizing_key", "--sizing-key", help="Sizing key, e.g. Power0.8EffectSize0.01")
+@click.option("--from", "from_date", type=ClickDate(), help="First run date", metavar="YYYY-MM-DD")
+@click.option("--to", "to_date", type=ClickDate(), help="Last run date", metavar="YYYY-MM-DD")
+@click.option(
+    "--columns",
+    help="Comma-separated columns to return",
+    default=",".join(HISTORY_COLUMNS),
+    show_default=True,
+)
+@click.option(
+    "--output",
+    help="CSV file to write the results to instead of printing them",
+    type=click.Path(dir_okay=False, path_type=Path),
+)
+def history(
+    bucket, history_uri, app_id, target_key, metric, sizing_key, from_date, to_date, columns, output
+):
+    """
+    Returns results of past runs from the sizing history, e.g. to follow how a
+    target's sample sizes drifted. Only the partitions of the requested app and
+    dates and the requested columns are read.
+    """
+    if not history_uri and not bucket:
+        raise ValueError("Either a history URI or a bucket must be provided.")
+
+    equals = {
+        column: value
+        for column, value in [
+            ("app_id", app_id),
+            ("target_key", target_key),
+            ("metric", metric),
+            ("sizing_key", sizing_key),
+        ]
+        if value
+    }
+    table = HistoryStore.from_uri(history_uri or default_history_uri(bucket)).query(
+        columns=columns.split(","),
+        from_date=from_date.date() if from_date else None,
+        to_date=to_date.date() if to_date else None,
+        equals=equals,
+    )
+    df = table.to_pandas().sort_values(columns.split(","))
+    if output:
+        df.to_csv(output, index=False)
+    else:
+        print(df.to_csv(index=False), end="")
+
+
+@cli.command()
+@project_id_option
+@dataset_id_option
+@click.option("--bucket", help="GCS bucket to write results to", required=True)
+@click.option(
+    "--from",
+    "from_date",
+    type=ClickDate(),
+    help="First run date to backfill",
+    metavar="YYYY-MM-DD",
+    required=True,
+)
+@click.option(
+    "--to",
+    "to_date",
+    type=ClickDate(),
+    help="Last run date to backfill",
+    metavar="YYYY-MM-DD",
+    required=True,
+)
+@click.option(
+    "--target_slug",
+    "--target-slug",
+    help="Preset target to backfill (defaults to every target in the manifest)",
+    required=False,
+)
+@run_id_option
+def backfill(project_id, dataset_id, bucket, from_date, to_date, target_slug, run_id):
+    """
+    Computes preset target sizes for every run date in a range, sharing scans
+    across the overlapping analysis windows of consecutive run dates.
+    Results are written to each run date's ind_target_results directory.
+    """
+    if to_date < from_date:
+        raise ValueError("--to must not be before --from.")
+
+    jobs_dict = toml.load(TARGET_SETTINGS)
+    jobs_manifest = toml.load(RUN_MANIFEST)
+    if target_slug:
+        jobs_manifest = {target_slug: jobs_manifest[target_slug]}
+
+    run_dates = run_date_range(from_date.date(), to_date.date())
+    sizing_options = {"run_id": run_id} if run_id else {}
+
+    failed = False
+    for slug, job_target in jobs_manifest.items():
+        run_configs = backfill_configurations(
+            slug,
+            json.loads(job_target["target_recipe"]),
+            jobs_dict,
+            job_target["app_id"],
+            run_dates,
+        )
+        try:
+            BackfillCalculation(
+                project_id,
+                dataset_id,
+                bucket,
+                run_configs[run_dates[0]],
+                run_configs=run_configs,
+                **sizing_options,
+            ).run(datetime.now(tz=pytz.utc).date())
+        except Exception as e:
+            logger.exception(str(e), exc_info=e, extra={"target": slug})
+            failed = True
+
+    sys.exit(1 if failed else 0)
 
 
 def refresh_manifest_file(target_lists_file=TARGET_SETTINGS, manifest_file=RUN_MANIFEST):
-    jobs_dict = toml.load(target_lists_file)
-    target_list = dict_combinations(jobs_dict, "targets")
-    jobs_manifest = {}
-
-    target_num = 0
-    for app_id in ["firefox_desktop", "firefox_ios", "fenix"]:
-        for target in target_list:
-            jobs_manifest[f"argo_target_{target_num}"] = {
-                "app_id": app_id,
-                "target_recipe": json.dumps(target),
-            }
-            target_num += 1
-    with open(manifest_file, "w") as f:
-        logger.info(f"Exporting manifest to {manifest_file}")
-        toml.dump(jobs_manifest, f)
+    name = getattr(manifest_file, "name", manifest_file)
+    logger.info(f"Exporting manifest to {name}")
+    num_targets = write_manifest(target_lists_file, manifest_file)
+    logger.info(f"Exported {num_targets} targets to {name}")
 
 
 @cli.command()
@@ -502,4 +1486,132 @@ def refresh_manifest(target_lists_file, manifest_file):
     Retrieves the target_lists.toml file and generates a new manifest.toml.
     """
 
-    refresh_manifest_file()
+    refresh_manifest_file(target_lists_file, manifest_file)
+
+
+@cli.command()
+@project_id_option
+@dataset_id_option
+@click.option("--bucket", help="GCS bucket to write cubes to", required=True)
+@click.option(
+    "--app_id",
+    "--app-id",
+    "app_ids",
+    help="Apps to compute statistics cubes for (defaults to all apps)",
+    type=click.Choice(list(CUBE_SOURCES)),
+    multiple=True,
+)
+@run_id_option
+def run_cube(project_id, dataset_id, bucket, app_ids, run_id):
+    """
+    Computes mergeable per-metric statistics for every channel, locale, country
+    and user type of each app, so that any combination can be sized locally.
+    """
+    jobs_dict = toml.load(TARGET_SETTINGS)
+    sizing_options = {"run_id": run_id} if run_id else {}
+
+    failed = False
+    for app_id in app_ids or CUBE_SOURCES:
+        try:
+            CubeCalculation(
+                project_id,
+                dataset_id,
+                bucket,
+                cube_configuration(app_id, jobs_dict),
+                app_id=app_id,
+                **sizing_options,
+            ).run(datetime.now(tz=pytz.utc).date())
+        except Exception as e:
+            logger.exception(str(e), exc_info=e, extra={"target": f"cube_{app_id}"})
+            failed = True
+
+    sys.exit(1 if failed else 0)
+
+
+@cli.command()
+@project_id_option
+@bucket_option
+@click.option(
+    "--cube_file",
+    "--cube-file",
+    help="Local statistics cube JSON to size from instead of the bucket's latest cube",
+    type=click.File("rt"),
+)
+@click.option("--app_id", "--app-id", type=click.Choice(list(CUBE_SOURCES)))
+@click.option("--release_channel", "--release-channel", "--channel", default="all")
+@click.option(
+    "--locale",
+    default="all",
+    help="Locales to combine, e.g. \"('EN-US', 'EN-CA')\"",
+)
+@click.option("--country", default="all", help="Countries to combine, e.g. \"('US', 'CA')\"")
+@click.option(
+    "--user_type", "--user-type", type=click.Choice(["new", "existing", "all"]), default="all"
+)
+def size_from_cube(
+    project_id, bucket, cube_file, app_id, release_channel, locale, country, user_type
+):
+    """Sizes an arbitrary target recipe by merging the cells of a statistics cube."""
+    if cube_file:
+        cube = StatisticsCube.from_json(cube_file.read())
+    elif bucket and app_id:
+        cube = load_cube(project_id, bucket, app_id)
+    else:
+        raise ValueError("Either a cube file or a GCS bucket and app ID must be provided.")
+
+    recipe = {
+        "release_channel": release_channel,
+        "locale": locale,
+        "country": country,
+        "user_type": user_type,
+    }
+    parameters = dict_combinations(toml.load(TARGET_SETTINGS), "parameters")
+    click.echo(json.dumps(cube.sample_sizes(recipe, parameters), indent=2))
+
+    estimated_clients = cube.estimate_clients(recipe)
+    if estimated_clients is not None:
+        click.echo(
+            f"Estimated {estimated_clients:.0f} targeted clients "
+            + f"(relative standard error {RELATIVE_ERROR:.2%})",
+            err=True,
+        )
+
+
+@cli.command("serve")
+@project_id_option
+@bucket_option
+@click.option(
+    "--results-dir",
+    "--results_dir",
+    help="Local directory with auto_sizing_results files to serve instead of a GCS bucket",
+    type=click.Path(exists=True, file_okay=False),
+)
+@click.option("--host", default="127.0.0.1", help="Address to listen on")
+@click.option("--port", default=8080, type=int, help="Port to listen on")
+@click.option(
+    "--cache-size",
+    "--cache_size",
+    default=1024,
+    type=int,
+    help="Number of recently requested targets to keep in the lookup cache",
+)
+@click.option(
+    "--reload-interval",
+    "--reload_interval",
+    default=300,
+    type=int,
+    help="Seconds between checks for newer results",
+)
+def serve_command(project_id, bucket, results_dir, host, port, cache_size, reload_interval):
+    """
+    Serves sizing lookups over HTTP from the latest aggregated results,
+    e.g. /sizes?app_id=firefox_desktop&channel=release&locale=EN-US&country=US&user_type=new
+    """
+    if results_dir:
+        source = LocalResultsSource(results_dir)
+    elif bucket:
+        source = GcsResultsSource(project_id, bucket)
+    else:
+        raise ValueError("Either a GCS bucket or a results directory must be provided.")
+
+    serve(SizingService(source, cache_size), host, port, reload_interval)
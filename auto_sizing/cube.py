@@ -0,0 +1,501 @@
+import json
+import logging
+import re
+from datetime import date, datetime
+from typing import Any, Dict, Iterable, List, Optional, Protocol, Set, TypeVar
+
+import attr
+import google.cloud.storage as storage
+import numpy as np
+from mozanalysis.experiment import TimeLimits
+from mozanalysis.sizing import HistoricalTarget
+from mozanalysis.utils import add_days
+from statsmodels.stats.power import zt_ind_solve_power
+
+from .export_json import SAMPLE_SIZE_PATH, _upload_to_gcs
+from .size_calculation import SizeCalculation
+from .sketches import HllSketch, estimate, register_sql
+from .targets import ALLOWED_APPS, MetricsLists, SizingConfiguration
+from .utils import default_dates_dict, dict_combinations
+
+logger = logging.getLogger(__name__)
+
+CUBE_DIMENSIONS = ["channel", "locale", "country", "user_type"]
+
+# sources of the finest grain dimensions, matching the tables used by SegmentsList
+CUBE_SOURCES = {
+    "firefox_desktop": {
+        "clients_daily": "mozdata.telemetry.clients_daily",
+        "clients_last_seen": "`moz-fx-data-shared-prod.telemetry.clients_last_seen`",
+    },
+    "firefox_ios": {
+        "clients_daily": "mozdata.org_mozilla_ios_firefox.baseline_clients_daily",
+        "clients_last_seen": "`moz-fx-data-shared-prod.org_mozilla_ios_firefox.baseline_clients_last_seen`",  # noqa: E501
+    },
+    "fenix": {
+        "clients_daily": "mozdata.org_mozilla_firefox.baseline_clients_daily",
+        "clients_last_seen": "`moz-fx-data-shared-prod.org_mozilla_firefox.baseline_clients_last_seen`",  # noqa: E501
+    },
+}
+OUTLIER_PERCENTILE = 99.5
+
+
+@attr.s(auto_attribs=True)
+class MetricStatistics:
+    """
+    Mergeable summary of a metric's values with outliers excluded. The sum
+    of squared deviations from the mean is kept instead of the sum of squares,
+    which loses precision to cancellation over millions of clients.
+    """
+
+    count: int = 0
+    mean: float = 0.0
+    # sum of squared deviations from the mean
+    m2: float = 0.0
+
+    @classmethod
+    def from_sums(cls, count: int, total: float, total_sq: float) -> "MetricStatistics":
+        if count == 0:
+            return cls()
+        return cls(count, total / count, max(total_sq - total**2 / count, 0.0))
+
+    def merge(self, other: "MetricStatistics") -> "MetricStatistics":
+        # Chan et al.'s parallel algorithm
+        count = self.count + other.count
+        if count == 0:
+            return MetricStatistics()
+        delta = other.mean - self.mean
+        return MetricStatistics(
+            count,
+            self.mean + delta * other.count / count,
+            self.m2 + other.m2 + delta**2 * self.count * other.count / count,
+        )
+
+    @property
+    def std(self) -> float:
+        """Sample standard deviation as computed by pandas, or NaN for fewer than 2 values."""
+        if self.count <= 1:
+            return float("nan")
+        return (self.m2 / (self.count - 1)) ** 0.5
+
+
+@attr.s(auto_attribs=True)
+class CubeCell:
+    channel: Optional[str]
+    locale: Optional[str]
+    country: Optional[str]
+    user_type: str
+    clients: int
+    metrics: Dict[str, MetricStatistics] = attr.Factory(dict)
+
+
+@attr.s(auto_attribs=True)
+class CubeSketch:
+    """HyperLogLog sketch of the clients seen with a cell's dimensions on any enrollment day."""
+
+    channel: Optional[str]
+    locale: Optional[str]
+    country: Optional[str]
+    user_type: str
+    # encoded with `HllSketch.encode`
+    sketch: str
+
+
+class _Cell(Protocol):
+    channel: Optional[str]
+    locale: Optional[str]
+    country: Optional[str]
+    user_type: str
+
+
+C = TypeVar("C", bound=_Cell)
+
+
+def _recipe_values(value: Optional[str]) -> Optional[Set[str]]:
+    """
+    Parses a target list value such as `"('EN-US', 'EN-CA')"` or `"US"`
+    into upper-cased values; `'all'` matches every value and returns None.
+    """
+    if value is None or value == "all":
+        return None
+    values = re.findall(r"'([^']+)'", value) or [value]
+    return {v.upper() for v in values}
+
+
+@attr.s(auto_attribs=True)
+class StatisticsCube:
+    """
+    Per-metric statistics for every app x channel x locale x country x user type
+    cell. Statistics for any union of cells are computed by merging cells,
+    so new locale or country combinations can be sized without a query.
+
+    Every client is counted in the cell of the first day it was seen during
+    enrollment and outliers are excluded using thresholds over the whole app,
+    so sizes differ slightly from sizes computed for a single target.
+    """
+
+    app_id: str
+    metric_names: List[str]
+    cells: List[CubeCell] = attr.Factory(list)
+    sketches: List[CubeSketch] = attr.Factory(list)
+
+    @classmethod
+    def from_rows(
+        cls,
+        app_id: str,
+        metric_names: List[str],
+        rows: Iterable[Dict[str, Any]],
+        sketch_rows: Iterable[Dict[str, Any]] = (),
+    ) -> "StatisticsCube":
+        cells = [
+            CubeCell(
+                channel=row["channel"],
+                locale=row["locale"],
+                country=row["country"],
+                user_type=row["user_type"],
+                clients=row["clients"],
+                metrics={
+                    metric: MetricStatistics(
+                        row[f"{metric}_count"], row[f"{metric}_mean"], row[f"{metric}_m2"]
+                    )
+                    for metric in metric_names
+                },
+            )
+            for row in rows
+        ]
+        sketches = [
+            CubeSketch(
+                channel=row["channel"],
+                locale=row["locale"],
+                country=row["country"],
+                user_type=row["user_type"],
+                sketch=HllSketch(
+                    np.array([r["register"] for r in row["registers"]], dtype=np.uint16),
+                    np.array([r["register_rank"] for r in row["registers"]], dtype=np.uint8),
+                ).encode(),
+            )
+            for row in sketch_rows
+        ]
+        return cls(app_id, metric_names, cells, sketches)
+
+    def to_json(self) -> str:
+        return json.dumps(attr.asdict(self))
+
+    @classmethod
+    def from_json(cls, data: str) -> "StatisticsCube":
+        cube = json.loads(data)
+        cells = [
+            CubeCell(
+                **{
+                    **cell,
+                    "metrics": {
+                        metric: (
+                            # cubes computed before deviations were stored have sums of squares
+                            MetricStatistics.from_sums(**statistics)
+                            if "total_sq" in statistics
+                            else MetricStatistics(**statistics)
+                        )
+                        for metric, statistics in cell["metrics"].items()
+                    },
+                }
+            )
+            for cell in cube["cells"]
+        ]
+        # cubes computed before sketches were added don't have them
+        sketches = [CubeSketch(**sketch) for sketch in cube.get("sketches", [])]
+        return cls(cube["app_id"], cube["metric_names"], cells, sketches)
+
+    @staticmethod
+    def _select(cells: List[C], recipe: Dict[str, str]) -> List[C]:
+        channels = _recipe_values(recipe.get("release_channel"))
+        locales = _recipe_values(recipe.get("locale"))
+        countries = _recipe_values(recipe.get("country"))
+        user_type = recipe.get("user_type", "all")
+
+        return [
+            cell
+            for cell in cells
+            if (channels is None or cell.channel in channels)
+            and (locales is None or cell.locale in locales)
+            and (countries is None or cell.country in countries)
+            and (user_type == "all" or cell.user_type == user_type)
+        ]
+
+    def select(self, recipe: Dict[str, str]) -> List[CubeCell]:
+        """Returns the cells that make up a target recipe from the target lists."""
+        return self._select(self.cells, recipe)
+
+    def estimate_clients(self, recipe: Dict[str, str]) -> Optional[float]:
+        """
+        Estimates the clients a target recipe selects by merging the sketches
+        of its cells, within `sketches.RELATIVE_ERROR`. Like the targeting of
+        a single target, a client counts if it matched the recipe on any day.
+        Returns None for cubes without sketches.
+        """
+        if not self.sketches:
+            return None
+        sketches = self._select(self.sketches, recipe)
+        return estimate(HllSketch.merge(HllSketch.decode(s.sketch) for s in sketches))
+
+    def sample_sizes(self, recipe: Dict[str, str], parameters: List[Dict]) -> Dict[str, Any]:
+        """Computes sizes for a recipe, in the same format as SizeCalculation's results."""
+        cells = self.select(recipe)
+        clients = sum(cell.clients for cell in cells)
+        estimated_clients = self.estimate_clients(recipe)
+        if estimated_clients is not None:
+            clients = round(estimated_clients)
+        if not cells or clients == 0:
+            return {}
+
+        statistics = {}
+        for metric in self.metric_names:
+            merged = MetricStatistics()
+            for cell in cells:
+                merged = merged.merge(cell.metrics[metric])
+            statistics[metric] = merged
+
+        # metrics without a spread to size against, e.g. with all clients excluded as outliers
+        for metric, merged in list(statistics.items()):
+            if not merged.std > 0 or merged.mean == 0:
+                logger.warning(
+                    f"Skipping {metric}: {merged.count} values with mean {merged.mean} "
+                    + f"and standard deviation {merged.std}"
+                )
+                del statistics[metric]
+
+        results = {}
+        for params in parameters:
+            metrics_results = {}
+            for metric, merged in statistics.items():
+                es = (params["effect_size"] * merged.mean) / merged.std
+                sample_size = zt_ind_solve_power(
+                    effect_size=es, alpha=0.05, power=params["power"], nobs1=None
+                )
+                metrics_results[metric] = {
+                    "number_of_clients_targeted": clients,
+                    "sample_size_per_branch": sample_size,
+                    "population_percent_per_branch": 100.0 * sample_size / clients,
+                }
+            results[f"Power{str(params['power'])}EffectSize{str(params['effect_size'])}"] = {
+                "parameters": params,
+                "metrics": metrics_results,
+            }
+
+        return results
+
+
+def build_dimensions_query(app_id: str, time_limits: TimeLimits, start_date: str) -> str:
+    """
+    Returns one row per client active during enrollment with the dimensions
+    of the first day it was seen and its user type.
+    """
+    sources = CUBE_SOURCES[app_id]
+    return f"""
+    WITH first_day AS (
+        SELECT
+            client_id,
+            ARRAY_AGG(
+                STRUCT(
+                    submission_date AS enrollment_date,
+                    UPPER(normalized_channel) AS channel,
+                    UPPER(locale) AS locale,
+                    UPPER(country) AS country
+                )
+                ORDER BY submission_date
+                LIMIT 1
+            )[OFFSET(0)] AS dimensions
+        FROM {sources["clients_daily"]}
+        WHERE submission_date
+            BETWEEN '{time_limits.first_enrollment_date}' AND '{time_limits.last_enrollment_date}'
+        GROUP BY client_id
+    ),
+    first_seen AS (
+        SELECT client_id, MIN(first_seen_date) AS first_seen_date
+        FROM {sources["clients_last_seen"]}
+        WHERE submission_date
+            BETWEEN '{time_limits.first_enrollment_date}' AND '{time_limits.last_enrollment_date}'
+        GROUP BY client_id
+    )
+    SELECT
+        client_id,
+        dimensions.enrollment_date,
+        dimensions.channel,
+        dimensions.locale,
+        dimensions.country,
+        CASE
+            WHEN first_seen_date >= '{start_date}' THEN 'new'
+            WHEN first_seen_date <= '{add_days(start_date, -28)}' THEN 'existing'
+            ELSE 'other'
+        END AS user_type
+    FROM first_day
+    LEFT JOIN first_seen USING (client_id)
+    """
+
+
+def build_sketch_query(app_id: str, time_limits: TimeLimits, dimensions_table: str) -> str:
+    """
+    Returns the HyperLogLog registers of every cell, counting a client in the
+    cell of each distinct combination of dimensions it was seen with during
+    enrollment and in the user type of its row in the dimensions table.
+    """
+    sources = CUBE_SOURCES[app_id]
+    return f"""
+    WITH days AS (
+        SELECT DISTINCT
+            client_id,
+            UPPER(normalized_channel) AS channel,
+            UPPER(locale) AS locale,
+            UPPER(country) AS country
+        FROM {sources["clients_daily"]}
+        WHERE submission_date
+            BETWEEN '{time_limits.first_enrollment_date}' AND '{time_limits.last_enrollment_date}'
+    ),
+    hashed AS (
+        SELECT
+            days.channel,
+            days.locale,
+            days.country,
+            dimensions.user_type,
+            FARM_FINGERPRINT(days.client_id) AS client_hash
+        FROM days
+        JOIN `{dimensions_table}` AS dimensions USING (client_id)
+    ),
+    registers AS (
+        SELECT
+            channel,
+            locale,
+            country,
+            user_type,{register_sql("client_hash")}
+        FROM hashed
+    )
+    SELECT
+        {", ".join(CUBE_DIMENSIONS)},
+        ARRAY_AGG(STRUCT(register, register_rank) ORDER BY register) AS registers
+    FROM (
+        SELECT {", ".join(CUBE_DIMENSIONS)}, register, MAX(register_rank) AS register_rank
+        FROM registers
+        GROUP BY {", ".join(CUBE_DIMENSIONS)}, register
+    )
+    GROUP BY {", ".join(CUBE_DIMENSIONS)}
+    """
+
+
+def build_cube_query(metrics_table: str, metric_names: List[str]) -> str:
+    """Aggregates per-client metrics into mergeable statistics per cell."""
+    threshold_offset = int(OUTLIER_PERCENTILE * 10)
+    thresholds = ",\n        ".join(
+        f"APPROX_QUANTILES({m}, 1000)[OFFSET({threshold_offset})] AS {m}_threshold"
+        for m in metric_names
+    )
+    statistics = []
+    for m in metric_names:
+        included = f"{m} IS NOT NULL AND {m} <= thresholds.{m}_threshold"
+        statistics += [
+            f"COUNTIF({included}) AS {m}_count",
+            f"COALESCE(AVG(IF({included}, CAST({m} AS FLOAT64), NULL)), 0) AS {m}_mean",
+            # VAR_POP is computed from deviations from the mean, unlike sums of squares
+            f"COALESCE(VAR_POP(IF({included}, CAST({m} AS FLOAT64), NULL)), 0) "
+            + f"* COUNTIF({included}) AS {m}_m2",
+        ]
+
+    statistics_sql = ",\n        ".join(statistics)
+    return f"""
+    WITH thresholds AS (
+        SELECT
+        {thresholds}
+        FROM `{metrics_table}`
+    )
+    SELECT
+        {", ".join(CUBE_DIMENSIONS)},
+        COUNT(*) AS clients,
+        {statistics_sql}
+    FROM `{metrics_table}`
+    CROSS JOIN thresholds
+    GROUP BY {", ".join(CUBE_DIMENSIONS)}
+    """
+
+
+@attr.s(auto_attribs=True)
+class CubeCalculation(SizeCalculation):
+    """Computes the statistics cube for an app; `config.target_list` is unused."""
+
+    app_id: str = "firefox_desktop"
+
+    def build_cube(self, current_date: date) -> StatisticsCube:
+        time_limits = self._validate_requested_timelimits(current_date)
+        slug = self.config.target_slug
+
+        dimensions_table = self._run_stage_query(
+            "dimensions",
+            build_dimensions_query(self.app_id, time_limits, self.config.start_date),
+            f"auto_sizing_cube_dimensions_{slug}",
+        )
+
+        ht = HistoricalTarget(
+            experiment_name=slug,
+            start_date=self.config.start_date,
+            analysis_length=self.config.analysis_length,
+            num_dates_enrollment=self.config.num_dates_enrollment,
+        )
+        metrics_table = self._run_stage_query(
+            "metrics",
+            ht.build_metrics_query(
+                metric_list=self.config.metric_list,
+                time_limits=time_limits,
+                targets_table=dimensions_table,
+            ),
+            f"auto_sizing_cube_metrics_{slug}",
+        )
+
+        metric_names = [metric.name for metric in self.config.metric_list]
+        cube_table = self._run_stage_query(
+            "cube",
+            build_cube_query(metrics_table, metric_names),
+            f"auto_sizing_cube_{slug}",
+        )
+
+        sketch_table = self._run_stage_query(
+            "sketches",
+            build_sketch_query(self.app_id, time_limits, dimensions_table),
+            f"auto_sizing_cube_sketches_{slug}",
+        )
+
+        client = self.bigquerycontext.client
+        return StatisticsCube.from_rows(
+            self.app_id,
+            metric_names,
+            (dict(row) for row in client.list_rows(cube_table)),
+            (dict(row) for row in client.list_rows(sketch_table)),
+        )
+
+    def run(self, current_date: date) -> None:
+        cube = self.build_cube(current_date)
+        cube_json = cube.to_json()
+        logger.info(f"Computed statistics cube for {self.app_id} with {len(cube.cells)} cells")
+        for run_date in [current_date.strftime("%Y-%m-%d"), "latest"]:
+            _upload_to_gcs(self.project, self.bucket, cube_path(self.app_id, run_date), cube_json)
+
+
+def cube_path(app_id: str, run_date: str = "latest") -> str:
+    return f"{SAMPLE_SIZE_PATH}/cube_{run_date}/{app_id}.json"
+
+
+def cube_configuration(app_id: ALLOWED_APPS, jobs_dict: Dict) -> SizingConfiguration:
+    """Returns the configuration of an app's cube with the metrics and dates of preset targets."""
+    dates_dict = default_dates_dict(datetime.today())
+    return SizingConfiguration(
+        [],
+        target_slug=f"cube_{app_id}",
+        metric_list=MetricsLists().from_repo(jobs_dict, app_id),
+        start_date=dates_dict["start_date"],  # type: ignore[arg-type]
+        num_dates_enrollment=dates_dict["num_dates_enrollment"],  # type: ignore[arg-type]
+        analysis_length=dates_dict["analysis_length"],  # type: ignore[arg-type]
+        parameters=dict_combinations(jobs_dict, "parameters"),
+    )
+
+
+def load_cube(
+    project_id: str, bucket: str, app_id: str, run_date: str = "latest"
+) -> StatisticsCube:
+    blob = storage.Client(project_id).bucket(bucket).blob(cube_path(app_id, run_date))
+    return StatisticsCube.from_json(blob.download_as_string())
@@ -33,3 +33,37 @@ class SegmentDataSourcesTagNotFoundException(ValidationException):
 class NoConfigFileException(ValidationException):
     def __init__(self, message="Provide a TOML config file."):
         super().__init__(f"{message}")
+
+
+class PopulationTooSmallException(ValidationException):
+    def __init__(self, target_slug, num_clients, min_population):
+        self.num_clients = num_clients
+        self.min_population = min_population
+        super().__init__(
+            f"{target_slug} -> Only {num_clients} clients satisfied targeting "
+            + f"(minimum population is {min_population})."
+        )
+
+
+class DataNotAvailableException(ValidationException):
+    def __init__(self, target_slug, missing_dates):
+        self.missing_dates = missing_dates
+        missing = "; ".join(
+            f"{table}: {', '.join(dates)}" for table, dates in missing_dates.items()
+        )
+        super().__init__(f"{target_slug} -> Partitions haven't landed yet ({missing}).")
+
+
+class StageDeadlineExceededException(Exception):
+    def __init__(self, target_slug, stage, timeout):
+        super().__init__(f"{target_slug} -> {stage} query didn't finish within {timeout:.0f}s.")
+
+
+class RunInterruptedException(BaseException):
+    """
+    Raised when the process is asked to stop. Like KeyboardInterrupt, it isn't
+    an Exception, so handlers of failed targets don't swallow it.
+    """
+
+    def __init__(self, signal_name):
+        super().__init__(f"Interrupted by {signal_name}.")
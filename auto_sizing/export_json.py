@@ -1,24 +1,108 @@
 import json
 import logging
 import re
+import tempfile
+from datetime import date
 from pathlib import Path
-from typing import Any
-
+from typing import (
+    IO,
+    TYPE_CHECKING,
+    Any,
+    Dict,
+    Iterator,
+    List,
+    Optional,
+    Set,
+    Tuple,
+    Union,
+)
+
+import attr
 import google.cloud.storage as storage
+import pyarrow as pa
+import pyarrow.parquet as pq
 import toml
-from mozilla_nimbus_schemas.jetstream import SampleSizes, SizingRecipe
+from mozilla_nimbus_schemas.jetstream import SizingRecipe, SizingTarget
+
+from .utils import retry_with_backoff
+
+if TYPE_CHECKING:
+    from .aggregate import MergedResults
+    from .history import HistoryStore
 
 logger = logging.getLogger(__name__)
 SAMPLE_SIZE_PATH = "sample_sizes"
 DATA_DIR = Path(__file__).parent / "data"
 RUN_MANIFEST = DATA_DIR / "manifest.toml"
 ARGO_PREFIX = "argo_target"
+SHARD_INDEX_FILE = "index.json"
+RESULTS_SCHEMA = pa.schema(
+    [
+        ("target_key", pa.string()),
+        ("app_id", pa.string()),
+        ("channel", pa.string()),
+        ("locale", pa.string()),
+        ("country", pa.string()),
+        ("new_or_existing", pa.string()),
+        ("sizing_key", pa.string()),
+        ("power", pa.float64()),
+        ("effect_size", pa.float64()),
+        ("analysis_length", pa.int64()),
+        ("metric", pa.string()),
+        ("number_of_clients_targeted", pa.int64()),
+        ("sample_size_per_branch", pa.float64()),
+        ("population_percent_per_branch", pa.float64()),
+        ("sample_size_per_branch_ci_lower", pa.float64()),
+        ("sample_size_per_branch_ci_upper", pa.float64()),
+    ]
+)
+# history files are partitioned by app, so rows don't repeat it
+HISTORY_SCHEMA = pa.schema([field for field in RESULTS_SCHEMA if field.name != "app_id"])
+# fields of the results that SizingTarget doesn't define, which validation would otherwise drop
+EXTRA_PARAMETER_FIELDS: Dict[str, type] = {"analysis_length": int}
+EXTRA_METRIC_FIELDS: Dict[str, type] = {"sample_size_per_branch_ci": list}
 
 
 def bq_normalize_name(name: str) -> str:
     return re.sub(r"[^a-zA-Z0-9_]", "_", name)
 
 
+def _upload_to_gcs(
+    project_id: str,
+    bucket_name: str,
+    path: str,
+    data: Union[str, bytes],
+    content_type: str = "application/json",
+) -> None:
+    storage_client = storage.Client(project_id)
+    bucket = storage_client.get_bucket(bucket_name)
+    blob = bucket.blob(path)
+
+    logger.info(f"Uploading {path} to {bucket_name}")
+
+    blob.upload_from_string(
+        data=data,
+        content_type=content_type,
+    )
+
+
+def _upload_file_to_gcs(
+    project_id: str,
+    bucket_name: str,
+    path: str,
+    file_obj: IO[bytes],
+    content_type: str = "application/json",
+) -> None:
+    storage_client = storage.Client(project_id)
+    bucket = storage_client.get_bucket(bucket_name)
+    blob = bucket.blob(path)
+
+    logger.info(f"Uploading {path} to {bucket_name}")
+
+    file_obj.seek(0)
+    blob.upload_from_file(file_obj, content_type=content_type)
+
+
 def _upload_str_to_gcs(
     project_id: str,
     bucket_name: str,
@@ -26,19 +110,11 @@ def _upload_str_to_gcs(
     base_name: str,
     str_to_upload: str,
 ) -> None:
-    storage_client = storage.Client(project_id)
-    bucket = storage_client.get_bucket(bucket_name)
     target_file_prefix = base_name.split("/")[0]
     target_file = f"{target_file_prefix}_{bq_normalize_name(target_slug)}"
     target_path = base_name
-    blob = bucket.blob(f"{target_path}/{target_file}.json")
 
-    logger.info(f"Uploading {target_file} to {bucket_name}/{target_path}")
-
-    blob.upload_from_string(
-        data=str_to_upload,
-        content_type="application/json",
-    )
+    _upload_to_gcs(project_id, bucket_name, f"{target_path}/{target_file}.json", str_to_upload)
 
 
 def export_sample_size_json(
@@ -47,31 +123,63 @@ def export_sample_size_json(
     target_slug: str,
     sample_size_result: str,
     current_date: str,
+    max_attempts: int = 3,
 ) -> None:
     """Export sample sizes to GCS bucket."""
 
     if ARGO_PREFIX in target_slug:
-        _upload_str_to_gcs(
-            project_id,
-            bucket_name,
-            target_slug,
-            f"{SAMPLE_SIZE_PATH}/ind_target_results_{current_date}",
-            sample_size_result,
-        )
+        base_name = f"{SAMPLE_SIZE_PATH}/ind_target_results_{current_date}"
     else:
-        _upload_str_to_gcs(
+        base_name = SAMPLE_SIZE_PATH
+
+    retry_with_backoff(
+        lambda: _upload_str_to_gcs(
             project_id,
             bucket_name,
             target_slug,
-            SAMPLE_SIZE_PATH,
+            base_name,
             sample_size_result,
-        )
+        ),
+        description=f"Uploading results for {target_slug}",
+        attempts=max_attempts,
+    )
 
 
-def parse_recipe_from_slug(target_slug: str) -> SizingRecipe:
-    jobs_dict = toml.load(RUN_MANIFEST)
-    print(jobs_dict)
-    # assert False
+def export_profile_json(
+    project_id: str,
+    bucket_name: str,
+    target_slug: str,
+    profile: str,
+    current_date: str,
+) -> None:
+    """Export a target's profile to a `profiles` directory next to its sample sizes."""
+    if ARGO_PREFIX in target_slug:
+        base_name = f"{SAMPLE_SIZE_PATH}/ind_target_results_{current_date}/profiles"
+    else:
+        base_name = f"{SAMPLE_SIZE_PATH}/profiles"
+
+    _upload_to_gcs(project_id, bucket_name, f"{base_name}/{target_slug}.json", profile)
+
+
+def export_skipped_json(
+    project_id: str,
+    bucket_name: str,
+    target_slug: str,
+    marker: str,
+    current_date: str,
+) -> None:
+    """Export a marker for a target that wasn't sized to a `skipped` directory next to results."""
+    if ARGO_PREFIX in target_slug:
+        base_name = f"{SAMPLE_SIZE_PATH}/ind_target_results_{current_date}/skipped"
+    else:
+        base_name = f"{SAMPLE_SIZE_PATH}/skipped"
+
+    _upload_to_gcs(project_id, bucket_name, f"{base_name}/{target_slug}.json", marker)
+
+
+def parse_recipe_from_slug(target_slug: str, jobs_dict: Optional[Dict] = None) -> SizingRecipe:
+    if jobs_dict is None:
+        jobs_dict = toml.load(RUN_MANIFEST)
 
     # parse out recipe fields
     target_recipe = jobs_dict[target_slug]
@@ -116,69 +224,361 @@ def build_target_key_from_recipe(recipe_info: SizingRecipe) -> str:
     return target_key
 
 
+def _copy_extra_fields(
+    validated: Dict[str, Any], results: Dict[str, Any], fields: Dict[str, type], description: str
+) -> None:
+    for field, field_type in fields.items():
+        if field not in results:
+            continue
+        if not isinstance(results[field], field_type) or isinstance(results[field], bool):
+            raise ValueError(f"{description}.{field} isn't of type {field_type.__name__}")
+        validated[field] = results[field]
+
+
+def validate_target_results(recipe_info: SizingRecipe, results_json: Union[str, bytes]) -> Any:
+    """Returns a target's results in the aggregate's format, raising if they are invalid."""
+    sample_sizes = json.loads(results_json)
+    results = SizingTarget.parse_obj({"target_recipe": recipe_info, "sample_sizes": sample_sizes})
+    validated = json.loads(results.json())
+
+    for sizing_key, details in validated["sample_sizes"].items():
+        _copy_extra_fields(
+            details["parameters"],
+            sample_sizes[sizing_key]["parameters"],
+            EXTRA_PARAMETER_FIELDS,
+            f"{sizing_key}.parameters",
+        )
+        for metric, values in details["metrics"].items():
+            _copy_extra_fields(
+                values,
+                sample_sizes[sizing_key]["metrics"][metric],
+                EXTRA_METRIC_FIELDS,
+                f"{sizing_key}.metrics.{metric}",
+            )
+            interval = values.get("sample_size_per_branch_ci")
+            if interval is not None and (
+                len(interval) != 2 or not all(isinstance(v, (int, float)) for v in interval)
+            ):
+                raise ValueError(f"{sizing_key}.metrics.{metric} has an invalid interval")
+
+    return validated
+
+
+class JsonObjectWriter:
+    """Serializes a JSON object incrementally, one member at a time."""
+
+    def __init__(self, file_obj: IO[bytes]):
+        self.file_obj = file_obj
+        self.size = 0
+        self.num_members = 0
+        self._write(b"{")
+
+    def _write(self, data: bytes) -> None:
+        self.file_obj.write(data)
+        self.size += len(data)
+
+    def write(self, key: str, value: Any) -> Tuple[int, int]:
+        """Writes a member and returns the byte offset and length of its value."""
+        separator = b"," if self.num_members else b""
+        self._write(separator + json.dumps(key).encode() + b":")
+        offset = self.size
+        body = json.dumps(value).encode()
+        self._write(body)
+        self.num_members += 1
+
+        return offset, len(body)
+
+    def close(self) -> None:
+        self._write(b"}")
+
+
+def _spooled_file() -> IO[bytes]:
+    return tempfile.SpooledTemporaryFile(max_size=16 * 1024 * 1024)  # type: ignore[return-value]
+
+
+def flatten_results(results: Dict[str, Any]) -> Iterator[Dict[str, Any]]:
+    """Yields one row per target, user type, sizing parameters and metric."""
+    for target_key, user_types in results.items():
+        for new_or_existing, target in user_types.items():
+            recipe = target["target_recipe"]
+            for sizing_key, details in target["sample_sizes"].items():
+                for metric, values in details["metrics"].items():
+                    interval = values.get("sample_size_per_branch_ci") or [None, None]
+                    yield {
+                        "target_key": target_key,
+                        "app_id": recipe.get("app_id"),
+                        "channel": recipe.get("channel"),
+                        "locale": recipe.get("locale"),
+                        "country": recipe.get("country"),
+                        "new_or_existing": new_or_existing,
+                        "sizing_key": sizing_key,
+                        "power": details["parameters"]["power"],
+                        "effect_size": details["parameters"]["effect_size"],
+                        "analysis_length": details["parameters"].get("analysis_length"),
+                        "metric": metric,
+                        "number_of_clients_targeted": values["number_of_clients_targeted"],
+                        "sample_size_per_branch": values["sample_size_per_branch"],
+                        "population_percent_per_branch": values["population_percent_per_branch"],
+                        "sample_size_per_branch_ci_lower": interval[0],
+                        "sample_size_per_branch_ci_upper": interval[1],
+                    }
+
+
+@attr.s(auto_attribs=True)
+class QuarantinedTarget:
+    target_slug: str
+    blob_name: str
+    error: str
+
+
+class AggregateResultsWriter:
+    """
+    Streams validated targets into the aggregate document, the per-app
+    shards and, optionally, a Parquet file and per-app Parquet files for the
+    results history, all backed by temporary files. Targets that were skipped
+    for their population size are collected in `skipped`.
+    """
+
+    def __init__(self, write_parquet: bool = False, write_history: bool = False):
+        self.results_file = _spooled_file()
+        self.results = JsonObjectWriter(self.results_file)
+        self.shard_files: Dict[str, IO[bytes]] = {}
+        self.shards: Dict[str, JsonObjectWriter] = {}
+        self.index: Dict[str, Dict[str, Any]] = {}
+        self.parquet_file: Optional[IO[bytes]] = None
+        self.parquet: Optional[pq.ParquetWriter] = None
+        if write_parquet:
+            self.parquet_file = _spooled_file()
+            self.parquet = pq.ParquetWriter(self.parquet_file, RESULTS_SCHEMA)
+        self.write_history = write_history
+        self.history_files: Dict[str, IO[bytes]] = {}
+        self.history: Dict[str, pq.ParquetWriter] = {}
+        self.skipped: Dict[str, Dict[str, Any]] = {}
+
+    def skip(self, target_key: str, new_or_existing: str, marker: Dict[str, Any]) -> None:
+        self.skipped.setdefault(target_key, {})[new_or_existing] = marker
+
+    def write(self, target_key: str, value: Dict[str, Any]) -> None:
+        self.results.write(target_key, value)
+
+        shard = f"{target_key.split(':')[0]}.json"
+        if shard not in self.shards:
+            self.shard_files[shard] = _spooled_file()
+            self.shards[shard] = JsonObjectWriter(self.shard_files[shard])
+        offset, length = self.shards[shard].write(target_key, value)
+        self.index[target_key] = {"shard": shard, "offset": offset, "length": length}
+
+        if self.parquet is None and not self.write_history:
+            return
+
+        rows = list(flatten_results({target_key: value}))
+        if self.parquet is not None:
+            self.parquet.write_table(pa.Table.from_pylist(rows, schema=RESULTS_SCHEMA))
+
+        if self.write_history and rows:
+            app_id = rows[0]["app_id"]
+            if app_id not in self.history:
+                self.history_files[app_id] = _spooled_file()
+                self.history[app_id] = pq.ParquetWriter(self.history_files[app_id], HISTORY_SCHEMA)
+            self.history[app_id].write_table(pa.Table.from_pylist(rows, schema=HISTORY_SCHEMA))
+
+    def close(self) -> None:
+        self.results.close()
+        for shard in self.shards.values():
+            shard.close()
+        if self.parquet is not None:
+            self.parquet.close()
+        for history in self.history.values():
+            history.close()
+
+
 def aggregate_results(
     project_id: str,
     bucket_name: str,
     today,
-) -> SampleSizes:
+    writer: AggregateResultsWriter,
+    merged: Optional["MergedResults"] = None,
+) -> List[QuarantinedTarget]:
+    """
+    Validates every target result of a run and streams it into `writer`.
+
+    Results are grouped by target key before being downloaded, so only the
+    results for one target key are held in memory at a time. Results that
+    fail validation are skipped and returned instead of aborting the export.
+    Results that target pods already merged into the aggregate are taken from
+    `merged` instead of being downloaded again, as long as the merged results
+    are those of the uploaded blob. Markers of targets that were
+    too small to size are passed to the writer's `skipped` unless the target
+    has results.
+    """
     storage_client = storage.Client(project_id)
+    jobs_dict = toml.load(RUN_MANIFEST)
 
-    agg_json: dict[str, dict[str, Any]] = {}
-    target_results_filename_pattern = rf"[\S*]({ARGO_PREFIX}_\d*).json"
+    target_blobs: Dict[str, List[Tuple[str, str, SizingRecipe, Any]]] = {}
+    # profiles in the same prefix are named after the target slug alone, so they don't match
+    target_results_filename_pattern = rf"/{SAMPLE_SIZE_PATH}_({ARGO_PREFIX}_[0-9a-f]+)\.json$"
+    skipped_filename_pattern = rf"/skipped/({ARGO_PREFIX}_[0-9a-f]+)\.json$"
+    skipped_blobs = []
+    num_merged = 0
     for blob in storage_client.list_blobs(
         bucket_name, prefix=f"{SAMPLE_SIZE_PATH}/ind_target_results_{today}"
     ):
-        # For files in the bucket, check if file name matches `target_\d.json` pattern
+        skipped_result = re.search(skipped_filename_pattern, blob.name)
+        if skipped_result:
+            skipped_blobs.append((skipped_result.group(1), blob))
+            continue
+
+        # For files in the bucket, check if file name matches `sample_sizes_argo_target_<hash>.json`
         regexp_result = re.search(target_results_filename_pattern, blob.name)
         if regexp_result:
             target_slug = regexp_result.group(1)
-            data = blob.download_as_string()
-
-            recipe_info = parse_recipe_from_slug(target_slug)
-
-            results = {
-                "target_recipe": recipe_info,
-                "sample_sizes": json.loads(data),
-            }
-
+            if merged is not None and merged.is_current(target_slug, blob.md5_hash):
+                target_blobs.setdefault(merged.slugs[target_slug], [])
+                num_merged += 1
+                continue
+            recipe_info = parse_recipe_from_slug(target_slug, jobs_dict)
             target_key = build_target_key_from_recipe(recipe_info)
             new_or_existing = recipe_info.get("new_or_existing")
+            target_blobs.setdefault(target_key, []).append(
+                (target_slug, new_or_existing, recipe_info, blob)
+            )
+
+    if merged is not None:
+        num_unmerged = sum(len(blobs) for blobs in target_blobs.values())
+        logger.info(f"{num_merged} results were merged, downloading {num_unmerged} others")
+
+    quarantined = []
+    sized: Dict[str, Set[str]] = {}
+    for target_key, blobs in target_blobs.items():
+        target_results = dict(merged.targets.get(target_key, {})) if merged is not None else {}
+        for target_slug, new_or_existing, recipe_info, blob in blobs:
+            # merged results of an earlier run are stale, even if these turn out invalid
+            target_results.pop(new_or_existing, None)
+            try:
+                # validate each target before it is added to the export
+                target_results[new_or_existing] = validate_target_results(
+                    recipe_info, blob.download_as_string()
+                )
+            except Exception as e:
+                logger.error(
+                    f"Invalid results for {target_slug}: {e}",
+                    extra={"target": target_slug},
+                )
+                quarantined.append(QuarantinedTarget(target_slug, blob.name, str(e)))
+
+        if target_results:
+            writer.write(target_key, target_results)
+            sized[target_key] = set(target_results)
+
+    for target_slug, blob in skipped_blobs:
+        recipe_info = parse_recipe_from_slug(target_slug, jobs_dict)
+        target_key = build_target_key_from_recipe(recipe_info)
+        new_or_existing = recipe_info.get("new_or_existing")
+        # results of a rerun with a lower minimum population take precedence
+        if new_or_existing in sized.get(target_key, set()):
+            continue
+        marker = json.loads(blob.download_as_string())
+        writer.skip(target_key, new_or_existing, {"target_slug": target_slug, **marker})
+
+    writer.close()
+
+    return quarantined
+
+
+def quarantine_results(
+    project_id: str,
+    bucket_name: str,
+    quarantined: List[QuarantinedTarget],
+    today: str,
+) -> None:
+    """Copies invalid target results aside and uploads a report describing them."""
+    storage_client = storage.Client(project_id)
+    bucket = storage_client.get_bucket(bucket_name)
+    quarantine_path = f"{SAMPLE_SIZE_PATH}/quarantine_{today}"
 
-            if target_key not in agg_json:
-                agg_json[target_key] = {}
-            agg_json[target_key][new_or_existing] = results
-
-    # validate json before export
-    sizing_results = SampleSizes.parse_obj(agg_json) if agg_json is not None else {}
+    for target in quarantined:
+        bucket.copy_blob(
+            bucket.blob(target.blob_name),
+            bucket,
+            f"{quarantine_path}/{target.blob_name.split('/')[-1]}",
+        )
 
-    return sizing_results
+    _upload_to_gcs(
+        project_id,
+        bucket_name,
+        f"{quarantine_path}/report.json",
+        json.dumps([attr.asdict(target) for target in quarantined]),
+    )
 
 
 def upload_aggregate_json(
     project_id: str,
     bucket_name: str,
-    results: SampleSizes,
+    writer: AggregateResultsWriter,
     today: str,
 ):
     file_name = f"auto_sizing_results_{today}"
-    sizing_json = results.json()
-    _upload_str_to_gcs(project_id, bucket_name, file_name, SAMPLE_SIZE_PATH, sizing_json)
-
     file_name_latest = "auto_sizing_results_latest"
-    _upload_str_to_gcs(
-        project_id,
-        bucket_name,
-        file_name_latest,
-        SAMPLE_SIZE_PATH,
-        sizing_json,
-    )
+    for name in [file_name, file_name_latest]:
+        _upload_file_to_gcs(
+            project_id,
+            bucket_name,
+            f"{SAMPLE_SIZE_PATH}/{SAMPLE_SIZE_PATH}_{bq_normalize_name(name)}.json",
+            writer.results_file,
+        )
+
+    for name in [f"auto_sizing_skipped_{today}", "auto_sizing_skipped_latest"]:
+        _upload_to_gcs(
+            project_id,
+            bucket_name,
+            f"{SAMPLE_SIZE_PATH}/{SAMPLE_SIZE_PATH}_{bq_normalize_name(name)}.json",
+            json.dumps(writer.skipped),
+        )
+
+    index_json = json.dumps(writer.index)
+    for shards_path in [f"shards_{today}", "shards_latest"]:
+        for shard, shard_file in writer.shard_files.items():
+            _upload_file_to_gcs(
+                project_id, bucket_name, f"{SAMPLE_SIZE_PATH}/{shards_path}/{shard}", shard_file
+            )
+        _upload_to_gcs(
+            project_id,
+            bucket_name,
+            f"{SAMPLE_SIZE_PATH}/{shards_path}/{SHARD_INDEX_FILE}",
+            index_json,
+        )
+
+    if writer.parquet_file is not None:
+        _upload_file_to_gcs(
+            project_id,
+            bucket_name,
+            f"{SAMPLE_SIZE_PATH}/{file_name}.parquet",
+            writer.parquet_file,
+            content_type="application/octet-stream",
+        )
 
 
 def aggregate_and_reupload(
     project_id: str,
     bucket_name: str,
     run_date: str,
+    write_parquet: bool = False,
+    history: Optional["HistoryStore"] = None,
+    merged: Optional["MergedResults"] = None,
 ) -> None:
-    sizing_results = aggregate_results(project_id, bucket_name, run_date)
+    writer = AggregateResultsWriter(write_parquet, write_history=history is not None)
+    quarantined = aggregate_results(project_id, bucket_name, run_date, writer, merged)
+
+    if writer.skipped:
+        num_skipped = sum(len(markers) for markers in writer.skipped.values())
+        logger.info(f"{num_skipped} targets were skipped for their population size")
+
+    if quarantined:
+        logger.error(f"{len(quarantined)} target results failed validation and were quarantined")
+        quarantine_results(project_id, bucket_name, quarantined, run_date)
+
+    upload_aggregate_json(project_id, bucket_name, writer, run_date)
 
-    upload_aggregate_json(project_id, bucket_name, sizing_results, run_date)
+    if history is not None:
+        for app_id, history_file in writer.history_files.items():
+            history.append(app_id, date.fromisoformat(run_date), history_file)
@@ -0,0 +1,63 @@
+from typing import Any, List
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+
+INTEGER_TYPES: List[Any] = [
+    np.iinfo(np.int8),
+    np.iinfo(np.int16),
+    np.iinfo(np.int32),
+    np.iinfo(np.int64),
+]
+# floats up to 2^53 are whole numbers exactly when they equal their truncation
+MAX_EXACT_FLOAT = 2**53
+
+
+def _smallest_integer_dtype(values: np.ndarray) -> Any:
+    """Returns the smallest signed integer dtype that holds every value."""
+    low, high = values.min(), values.max()
+    for info in INTEGER_TYPES:
+        if info.min <= low and high <= info.max:
+            return info.dtype
+    return np.int64
+
+
+def compact_column(column: pa.ChunkedArray) -> Any:
+    """
+    Converts a column downloaded from BigQuery to the smallest type that keeps
+    every value exactly. Numbers that are all whole, like sums and counts, are
+    downcast to the smallest signed integer type, which sample size
+    calculations upcast to float64 anyway. Other numbers become float64,
+    with NaN for nulls. Strings stay in Arrow's contiguous buffers instead of
+    becoming a Python object per value.
+    """
+    if pa.types.is_boolean(column.type) and column.null_count == 0:
+        return column.to_numpy()
+
+    if pa.types.is_integer(column.type) or pa.types.is_floating(column.type):
+        values = column.to_numpy()
+        if len(values) == 0 or column.null_count:
+            return values.astype(np.float64)
+        if pa.types.is_floating(column.type):
+            if np.abs(values).max() > MAX_EXACT_FLOAT or not np.array_equal(
+                values, np.trunc(values)
+            ):
+                return values.astype(np.float64)
+            values = values.astype(np.int64)
+        return values.astype(_smallest_integer_dtype(values))
+
+    if pa.types.is_string(column.type) or pa.types.is_large_string(column.type):
+        return pd.Series(column.to_pandas(types_mapper=lambda _: pd.StringDtype("pyarrow")))
+
+    return pd.Series(column.to_pandas(types_mapper=pd.ArrowDtype))
+
+
+def compact_frame(table: pa.Table) -> pd.DataFrame:
+    """Converts a downloaded table to a DataFrame of compact columns."""
+    return pd.DataFrame({name: compact_column(table.column(name)) for name in table.column_names})
+
+
+def frame_memory(df: pd.DataFrame) -> int:
+    """Returns the bytes a DataFrame takes up, including the values of string columns."""
+    return int(df.memory_usage(deep=True).sum())
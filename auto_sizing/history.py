@@ -0,0 +1,85 @@
+import logging
+from datetime import date
+from typing import IO, Dict, List, Optional
+
+import attr
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.fs as pafs
+
+from .export_json import HISTORY_SCHEMA, SAMPLE_SIZE_PATH
+
+logger = logging.getLogger(__name__)
+
+# rows are partitioned by app and run date, which are only stored in the directory names
+PARTITIONING_SCHEMA = pa.schema([("app_id", pa.string()), ("run_date", pa.date32())])
+HISTORY_FILE = "results.parquet"
+
+
+def default_history_uri(bucket: str) -> str:
+    return f"gs://{bucket}/{SAMPLE_SIZE_PATH}/history"
+
+
+@attr.s(auto_attribs=True)
+class HistoryStore:
+    """
+    Append-only history of sizing results as Parquet files partitioned by app
+    and run date, e.g. `<root>/app_id=firefox_desktop/run_date=2024-01-01/`.
+    Rerunning a date replaces that date's files, so appends are idempotent.
+    """
+
+    filesystem: pafs.FileSystem
+    root: str
+
+    @classmethod
+    def from_uri(cls, uri: str) -> "HistoryStore":
+        """Returns a store on GCS for gs:// URIs and on the local disk for paths."""
+        filesystem, root = pafs.FileSystem.from_uri(uri)
+        return cls(filesystem, root.rstrip("/"))
+
+    def _partition_dir(self, app_id: str, run_date: date) -> str:
+        return f"{self.root}/app_id={app_id}/run_date={run_date.isoformat()}"
+
+    def append(self, app_id: str, run_date: date, parquet_file: IO[bytes]) -> None:
+        """Stores a run's results of one app, written with `HISTORY_SCHEMA`."""
+        partition_dir = self._partition_dir(app_id, run_date)
+        self.filesystem.create_dir(partition_dir, recursive=True)
+        parquet_file.seek(0)
+        with self.filesystem.open_output_stream(f"{partition_dir}/{HISTORY_FILE}") as stream:
+            stream.write(parquet_file.read())
+        logger.info(f"Appended {app_id} results of {run_date} to {partition_dir}")
+
+    def dataset(self) -> ds.Dataset:
+        return ds.dataset(
+            self.root,
+            filesystem=self.filesystem,
+            format="parquet",
+            schema=pa.unify_schemas([HISTORY_SCHEMA, PARTITIONING_SCHEMA]),
+            partitioning=ds.partitioning(PARTITIONING_SCHEMA, flavor="hive"),
+        )
+
+    def query(
+        self,
+        columns: Optional[List[str]] = None,
+        from_date: Optional[date] = None,
+        to_date: Optional[date] = None,
+        equals: Optional[Dict[str, str]] = None,
+    ) -> pa.Table:
+        """
+        Returns the requested columns of the rows between two run dates whose
+        columns match `equals`. Partitions outside the app and dates asked for
+        aren't read, and only the requested columns of the others are.
+        """
+        conditions = [ds.field(column) == value for column, value in (equals or {}).items()]
+        if from_date:
+            conditions.append(ds.field("run_date") >= from_date)
+        if to_date:
+            conditions.append(ds.field("run_date") <= to_date)
+
+        filter_expression = None
+        for condition in conditions:
+            filter_expression = (
+                condition if filter_expression is None else filter_expression & condition
+            )
+
+        return self.dataset().to_table(columns=columns, filter=filter_expression)
@@ -0,0 +1,174 @@
+import json
+import logging
+from datetime import datetime
+from enum import Enum
+from pathlib import Path
+from typing import Dict, Optional, Protocol
+
+import attr
+import google.cloud.storage as storage
+import pytz
+
+from .export_json import SAMPLE_SIZE_PATH
+from .targets import SizingConfiguration
+
+logger = logging.getLogger(__name__)
+
+
+class TargetState(str, Enum):
+    PENDING = "pending"
+    RUNNING = "running"
+    DONE = "done"
+    FAILED = "failed"
+    # fewer clients than the minimum population satisfied targeting
+    SKIPPED = "skipped"
+    # the process was stopped while the target ran, and its jobs were cancelled
+    INTERRUPTED = "interrupted"
+
+
+@attr.s(auto_attribs=True)
+class LedgerEntry:
+    target_slug: str
+    state: TargetState
+    fingerprint: str
+    updated_at: str
+    # the minimum population a SKIPPED target was too small for
+    min_population: int = 0
+
+    def to_dict(self) -> Dict[str, str]:
+        return {
+            "target_slug": self.target_slug,
+            "state": self.state.value,
+            "fingerprint": self.fingerprint,
+            "updated_at": self.updated_at,
+            "min_population": str(self.min_population),
+        }
+
+    @classmethod
+    def from_dict(cls, entry: Dict[str, str]) -> "LedgerEntry":
+        return cls(
+            target_slug=entry["target_slug"],
+            state=TargetState(entry["state"]),
+            fingerprint=entry["fingerprint"],
+            updated_at=entry["updated_at"],
+            min_population=int(entry.get("min_population", 0)),
+        )
+
+
+class LedgerBackend(Protocol):
+    def read(self, target_slug: str) -> Optional[Dict[str, str]]: ...
+
+    def read_all(self) -> Dict[str, Dict[str, str]]: ...
+
+    def write(self, target_slug: str, entry: Dict[str, str]) -> None: ...
+
+
+@attr.s(auto_attribs=True)
+class GcsLedgerBackend:
+    """
+    Stores one object per target so that concurrently running target pods
+    never write to the same object. The entry is duplicated into the object
+    metadata, which lets the whole ledger be read with a single listing.
+    """
+
+    project_id: str
+    bucket: str
+    prefix: str
+
+    @property
+    def client(self) -> storage.Client:
+        return storage.Client(self.project_id)
+
+    def _path(self, target_slug: str) -> str:
+        return f"{self.prefix}/{target_slug}.json"
+
+    def read(self, target_slug: str) -> Optional[Dict[str, str]]:
+        blob = self.client.bucket(self.bucket).get_blob(self._path(target_slug))
+        if blob is None:
+            return None
+        return json.loads(blob.download_as_string())
+
+    def read_all(self) -> Dict[str, Dict[str, str]]:
+        entries = {}
+        for blob in self.client.list_blobs(self.bucket, prefix=f"{self.prefix}/"):
+            if blob.metadata and "target_slug" in blob.metadata:
+                entries[blob.metadata["target_slug"]] = dict(blob.metadata)
+        return entries
+
+    def write(self, target_slug: str, entry: Dict[str, str]) -> None:
+        blob = self.client.bucket(self.bucket).blob(self._path(target_slug))
+        blob.metadata = entry
+        blob.upload_from_string(json.dumps(entry), content_type="application/json")
+
+
+@attr.s(auto_attribs=True)
+class LocalLedgerBackend:
+    path: Path
+
+    def read(self, target_slug: str) -> Optional[Dict[str, str]]:
+        entry_file = self.path / f"{target_slug}.json"
+        if not entry_file.exists():
+            return None
+        return json.loads(entry_file.read_text())
+
+    def read_all(self) -> Dict[str, Dict[str, str]]:
+        if not self.path.exists():
+            return {}
+        return {
+            entry_file.stem: json.loads(entry_file.read_text())
+            for entry_file in self.path.glob("*.json")
+        }
+
+    def write(self, target_slug: str, entry: Dict[str, str]) -> None:
+        self.path.mkdir(parents=True, exist_ok=True)
+        (self.path / f"{target_slug}.json").write_text(json.dumps(entry))
+
+
+@attr.s(auto_attribs=True)
+class RunLedger:
+    """
+    Tracks the state of every target of a run so that reruns on the same day
+    only compute targets that are unfinished or whose configuration changed.
+    """
+
+    backend: LedgerBackend
+
+    @classmethod
+    def for_run(cls, project_id: str, bucket: str, run_date: str) -> "RunLedger":
+        return cls(GcsLedgerBackend(project_id, bucket, f"{SAMPLE_SIZE_PATH}/ledger_{run_date}"))
+
+    def get(self, target_slug: str) -> Optional[LedgerEntry]:
+        entry = self.backend.read(target_slug)
+        return LedgerEntry.from_dict(entry) if entry else None
+
+    def entries(self) -> Dict[str, LedgerEntry]:
+        return {
+            target_slug: LedgerEntry.from_dict(entry)
+            for target_slug, entry in self.backend.read_all().items()
+        }
+
+    def mark(
+        self, config: SizingConfiguration, state: TargetState, min_population: int = 0
+    ) -> None:
+        updated_at = datetime.now(tz=pytz.utc).isoformat()
+        fingerprint = config.fingerprint()
+        for target_slug in [config.target_slug, *config.duplicate_slugs]:
+            entry = LedgerEntry(target_slug, state, fingerprint, updated_at, min_population)
+            self.backend.write(target_slug, entry.to_dict())
+
+    @staticmethod
+    def is_complete(
+        entry: Optional[LedgerEntry], config: SizingConfiguration, min_population: int = 0
+    ) -> bool:
+        """
+        Whether a target needn't run again. Skipped targets are rerun if the
+        minimum population was lowered below the one they were too small for.
+        """
+        if entry is None or entry.fingerprint != config.fingerprint():
+            return False
+        if entry.state == TargetState.SKIPPED:
+            return min_population >= entry.min_population
+        return entry.state == TargetState.DONE
+
+    def needs_run(self, config: SizingConfiguration, min_population: int = 0) -> bool:
+        return not self.is_complete(self.get(config.target_slug), config, min_population)
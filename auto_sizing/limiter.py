@@ -0,0 +1,299 @@
+import abc
+import contextlib
+import fcntl
+import json
+import logging
+import os
+import random
+import threading
+import time
+import uuid
+from datetime import datetime, timedelta
+from pathlib import Path
+from typing import IO, Callable, Iterator, Optional, Protocol, Tuple
+
+import attr
+import google.cloud.storage as storage
+import pytz
+from google.api_core.exceptions import (
+    Forbidden,
+    NotFound,
+    PreconditionFailed,
+    TooManyRequests,
+)
+
+from .utils import retry_with_backoff
+
+logger = logging.getLogger(__name__)
+
+
+class ConcurrencyLimiter(Protocol):
+    def lease(self) -> contextlib.AbstractContextManager: ...
+
+    def record_success(self, queued_seconds: float) -> None: ...
+
+    def record_quota_error(self) -> None: ...
+
+
+@attr.s(auto_attribs=True)
+class AdaptiveLimit:
+    """
+    Additive-increase/multiplicative-decrease policy for the number of
+    concurrent queries: the limit halves when queries queue for too long or
+    hit quota errors and grows by one after each query that ran promptly.
+    """
+
+    max_limit: int
+    min_limit: int = 1
+    queueing_threshold: float = 60.0
+
+    def after_success(self, current: int, queued_seconds: float) -> int:
+        if queued_seconds > self.queueing_threshold:
+            return self.after_quota_error(current)
+        return min(self.max_limit, current + 1)
+
+    def after_quota_error(self, current: int) -> int:
+        return max(self.min_limit, current // 2)
+
+
+class _SlotLimiter(abc.ABC):
+    """
+    Hands out a bounded number of numbered slots; subclasses implement how a
+    slot is claimed and released and where the current limit is stored.
+    """
+
+    policy: AdaptiveLimit
+    poll_interval: float
+
+    @abc.abstractmethod
+    def _read_limit(self) -> int: ...
+
+    @abc.abstractmethod
+    def _update_limit(self, update: Callable[[int], int]) -> Tuple[int, int]:
+        """
+        Replaces the stored limit with `update` of it, without losing concurrent
+        updates of other workers. Returns the limit before and after the update.
+        """
+
+    @abc.abstractmethod
+    def _claim(self, slot: int) -> Optional[object]: ...
+
+    @abc.abstractmethod
+    def _release(self, slot: int, claim: object) -> None: ...
+
+    @contextlib.contextmanager
+    def lease(self) -> Iterator[None]:
+        waited = 0.0
+        while True:
+            slots = list(range(self._read_limit()))
+            random.shuffle(slots)
+            for slot in slots:
+                claim = self._claim(slot)
+                if claim is not None:
+                    logger.debug(f"Acquired query slot {slot} after {waited:.0f}s")
+                    try:
+                        yield
+                    finally:
+                        self._release(slot, claim)
+                    return
+
+            time.sleep(self.poll_interval)
+            waited += self.poll_interval
+
+    def record_success(self, queued_seconds: float) -> None:
+        current, updated = self._update_limit(
+            lambda limit: self.policy.after_success(limit, queued_seconds)
+        )
+        if updated != current:
+            logger.info(f"Adjusted concurrent query limit from {current} to {updated}")
+
+    def record_quota_error(self) -> None:
+        current, updated = self._update_limit(self.policy.after_quota_error)
+        if updated != current:
+            logger.warning(f"Lowered concurrent query limit from {current} to {updated}")
+
+
+class FileLockLimiter(_SlotLimiter):
+    """Limits concurrent queries across processes on one machine using file locks."""
+
+    def __init__(self, path: Path, policy: AdaptiveLimit, poll_interval: float = 5.0):
+        self.path = Path(path)
+        self.path.mkdir(parents=True, exist_ok=True)
+        self.policy = policy
+        self.poll_interval = poll_interval
+
+    def _read_limit(self) -> int:
+        limit_file = self.path / "limit"
+        if not limit_file.exists():
+            return self.policy.max_limit
+        return int(limit_file.read_text())
+
+    def _update_limit(self, update: Callable[[int], int]) -> Tuple[int, int]:
+        with open(self.path / "limit.lock", "w") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                current = self._read_limit()
+                updated = update(current)
+                if updated != current:
+                    # readers never see a partially written limit
+                    temporary = self.path / f"limit.{os.getpid()}.tmp"
+                    temporary.write_text(str(updated))
+                    os.replace(temporary, self.path / "limit")
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+        return current, updated
+
+    def _claim(self, slot: int) -> Optional[IO]:
+        slot_file = open(self.path / f"slot_{slot}.lock", "w")
+        try:
+            fcntl.flock(slot_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            slot_file.close()
+            return None
+        return slot_file
+
+    def _release(self, slot: int, claim: object) -> None:
+        slot_file: IO = claim  # type: ignore[assignment]
+        fcntl.flock(slot_file, fcntl.LOCK_UN)
+        slot_file.close()
+
+
+class GcsLeaseLimiter(_SlotLimiter):
+    """
+    Limits concurrent queries across all workers by leasing slot objects in
+    a GCS bucket. A slot is claimed by creating its object with a generation
+    precondition, renewed while the query runs, and can be taken over once
+    its lease expires in case the holder died without releasing it.
+    """
+
+    def __init__(
+        self,
+        project_id: str,
+        bucket: str,
+        prefix: str,
+        policy: AdaptiveLimit,
+        lease_seconds: int = 600,
+        poll_interval: float = 15.0,
+    ):
+        self.bucket = storage.Client(project_id).bucket(bucket)
+        self.prefix = prefix
+        self.policy = policy
+        self.lease_seconds = lease_seconds
+        self.poll_interval = poll_interval
+        self.holder = f"{os.uname().nodename}-{uuid.uuid4().hex[:8]}"
+
+    def _read_limit(self) -> int:
+        blob = self.bucket.get_blob(f"{self.prefix}/limit")
+        if blob is None:
+            return self.policy.max_limit
+        return int(blob.download_as_string())
+
+    def _update_limit_once(self, update: Callable[[int], int]) -> Tuple[int, int]:
+        blob = self.bucket.get_blob(f"{self.prefix}/limit")
+        # generation 0 only matches if the limit object doesn't exist yet
+        generation = 0
+        current = self.policy.max_limit
+        if blob is not None:
+            generation = blob.generation
+            current = int(blob.download_as_string(if_generation_match=generation))
+
+        updated = update(current)
+        if updated != current:
+            self.bucket.blob(f"{self.prefix}/limit").upload_from_string(
+                str(updated), if_generation_match=generation
+            )
+        return current, updated
+
+    def _update_limit(self, update: Callable[[int], int]) -> Tuple[int, int]:
+        # an update that raced with another worker's is retried on the newer limit
+        return retry_with_backoff(
+            lambda: self._update_limit_once(update),
+            description="Updating the concurrent query limit",
+            attempts=10,
+            delay=1.0,
+            factor=1.5,
+            retry_on=(PreconditionFailed,),
+        )
+
+    def _lease_body(self) -> str:
+        expires_at = datetime.now(tz=pytz.utc) + timedelta(seconds=self.lease_seconds)
+        return json.dumps({"holder": self.holder, "expires_at": expires_at.isoformat()})
+
+    def _write_lease(self, slot: int, generation: int) -> Optional[int]:
+        """Writes this worker's lease if the slot object is still at `generation`."""
+        blob = self.bucket.blob(f"{self.prefix}/slot_{slot}")
+        try:
+            blob.upload_from_string(self._lease_body(), if_generation_match=generation)
+        except PreconditionFailed:
+            return None
+        return blob.generation
+
+    def _claim(self, slot: int) -> Optional[object]:
+        # generation 0 only matches if the slot object doesn't exist yet
+        generation = self._write_lease(slot, 0)
+        if generation is None:
+            blob = self.bucket.get_blob(f"{self.prefix}/slot_{slot}")
+            if blob is None:
+                return None
+            lease = json.loads(blob.download_as_string())
+            if datetime.fromisoformat(lease["expires_at"]) > datetime.now(tz=pytz.utc):
+                return None
+            logger.warning(f"Taking over expired query slot {slot} from {lease['holder']}")
+            generation = self._write_lease(slot, blob.generation)
+            if generation is None:
+                return None
+
+        return _LeaseRenewal(self, slot, generation)
+
+    def _release(self, slot: int, claim: object) -> None:
+        renewal: _LeaseRenewal = claim  # type: ignore[assignment]
+        generation = renewal.stop()
+        try:
+            self.bucket.blob(f"{self.prefix}/slot_{slot}").delete(if_generation_match=generation)
+        except (NotFound, PreconditionFailed):
+            logger.warning(f"Query slot {slot} was taken over before it was released")
+
+
+class _LeaseRenewal:
+    """Renews a GCS slot lease in the background while a query is running."""
+
+    def __init__(self, limiter: GcsLeaseLimiter, slot: int, generation: int):
+        self.limiter = limiter
+        self.slot = slot
+        self.generation = generation
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._renew, daemon=True)
+        self._thread.start()
+
+    def _renew(self) -> None:
+        while not self._stopped.wait(self.limiter.lease_seconds / 3):
+            generation = self.limiter._write_lease(self.slot, self.generation)
+            if generation is None:
+                logger.warning(f"Lost the lease on query slot {self.slot}")
+                return
+            self.generation = generation
+
+    def stop(self) -> int:
+        self._stopped.set()
+        self._thread.join()
+        return self.generation
+
+
+def is_quota_error(error: Exception) -> bool:
+    """Whether a BigQuery error was caused by rate limits or quotas."""
+    if isinstance(error, TooManyRequests):
+        return True
+    if isinstance(error, Forbidden):
+        reasons = {e.get("reason") for e in error.errors or []}
+        return bool(reasons & {"rateLimitExceeded", "quotaExceeded"})
+    return False
+
+
+def limiter_from_uri(uri: str, project_id: str, max_concurrent_queries: int) -> ConcurrencyLimiter:
+    """Returns a GCS lease limiter for gs:// URIs and a file lock limiter for local paths."""
+    policy = AdaptiveLimit(max_limit=max_concurrent_queries)
+    if uri.startswith("gs://"):
+        bucket, _, prefix = uri.removeprefix("gs://").partition("/")
+        return GcsLeaseLimiter(project_id, bucket, prefix.rstrip("/"), policy)
+
+    return FileLockLimiter(Path(uri), policy)
@@ -0,0 +1,110 @@
+import hashlib
+import json
+import logging
+import re
+from pathlib import Path
+from typing import Dict, Iterator, List, Optional, TextIO, Tuple, Union
+
+import toml
+
+from .export_json import ARGO_PREFIX
+from .utils import iter_combinations
+
+logger = logging.getLogger(__name__)
+
+# dimensions that are applied as case-insensitive SQL filters on clients_daily
+FILTER_DIMENSIONS = ["locale", "release_channel", "country"]
+SLUG_HASH_LENGTH = 12
+
+
+def normalize_recipe(recipe: Dict[str, str]) -> Dict[str, str]:
+    """
+    Returns a canonical form of a target recipe, so that recipes that select
+    the same clients (e.g. the same locales in another order) are equal.
+    """
+    normalized = {}
+    for dimension, value in recipe.items():
+        if dimension in FILTER_DIMENSIONS and value != "all":
+            values = re.findall(r"'([^']+)'", value) or [value]
+            value = ",".join(sorted({v.strip().upper() for v in values}))
+        normalized[dimension] = value
+
+    return normalized
+
+
+def target_slug(app_id: str, recipe: Dict[str, str]) -> str:
+    """
+    Derives a target's slug from its app and recipe, so that a target keeps
+    its slug when other targets are added to or removed from the target lists.
+    """
+    payload = json.dumps({"app_id": app_id, "recipe": normalize_recipe(recipe)}, sort_keys=True)
+    return f"{ARGO_PREFIX}_{hashlib.sha256(payload.encode()).hexdigest()[:SLUG_HASH_LENGTH]}"
+
+
+def _matches(rule: Dict[str, Union[str, List[str]]], app_id: str, recipe: Dict[str, str]) -> bool:
+    target = {"app_id": app_id, **normalize_recipe(recipe)}
+    for dimension, values in rule.items():
+        if not isinstance(values, list):
+            values = [values]
+        if dimension in FILTER_DIMENSIONS:
+            values = [normalize_recipe({dimension: v})[dimension] for v in values]
+        if target.get(dimension) not in values:
+            return False
+
+    return True
+
+
+def iter_manifest(
+    jobs_dict: Dict, exclusions: Optional[List[Dict]] = None
+) -> Iterator[Tuple[str, Dict[str, str]]]:
+    """
+    Lazily yields `(slug, manifest entry)` for every app and target combination.
+
+    Apps are the ones with metrics configured in the target lists. A target is
+    skipped if it matches every dimension of one of the `exclusions` rules,
+    which default to the `exclude` tables of the target lists, e.g.
+
+        [[exclude]]
+        app_id = ["firefox_ios", "fenix"]
+        release_channel = "nightly"
+    """
+    if exclusions is None:
+        exclusions = jobs_dict.get("exclude", [])
+
+    seen = set()
+    for app_id in jobs_dict["metrics"]:
+        for recipe in iter_combinations(jobs_dict, "targets"):
+            if any(_matches(rule, app_id, recipe) for rule in exclusions):
+                logger.debug(f"Excluding {app_id} target {recipe}")
+                continue
+
+            slug = target_slug(app_id, recipe)
+            if slug in seen:
+                continue
+            seen.add(slug)
+
+            yield slug, {"app_id": app_id, "target_recipe": json.dumps(recipe)}
+
+
+def write_manifest(
+    target_lists: Union[Path, TextIO, Dict], manifest_file: Union[Path, TextIO]
+) -> int:
+    """
+    Writes the manifest one target at a time, so that the manifest is never
+    held in memory. Returns the number of targets written.
+    """
+    jobs_dict = target_lists if isinstance(target_lists, dict) else toml.load(target_lists)
+
+    f = open(manifest_file, "w") if isinstance(manifest_file, Path) else manifest_file
+    num_targets = 0
+    try:
+        for slug, entry in iter_manifest(jobs_dict):
+            if num_targets:
+                f.write("\n")
+            f.write(toml.dumps({slug: entry}))
+            num_targets += 1
+    finally:
+        if isinstance(manifest_file, Path):
+            f.close()
+
+    return num_targets
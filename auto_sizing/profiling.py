@@ -0,0 +1,126 @@
+import contextlib
+import cProfile
+import itertools
+import json
+import logging
+import resource
+import threading
+import time
+import tracemalloc
+from pathlib import Path
+from typing import Any, Dict, Iterator, List, Optional
+
+import attr
+
+logger = logging.getLogger(__name__)
+
+
+def peak_rss_bytes() -> int:
+    """Returns the peak resident memory of the process, including memory outside Python."""
+    # Linux reports kilobytes
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+@attr.s(auto_attribs=True)
+class StageProfile:
+    name: str
+    wall_seconds: float
+    cpu_seconds: float
+    # peak memory allocated by Python while the stage ran, as traced by tracemalloc;
+    # it includes memory allocated by stages that ran at the same time
+    peak_memory_bytes: int
+
+
+@attr.s(auto_attribs=True)
+class Profiler:
+    """
+    Records wall time, CPU time and peak Python memory for each named stage
+    of a target's run and optionally collects a cProfile of the whole run.
+
+    tracemalloc only tracks a single peak, so it is read and reset whenever a
+    stage starts or ends and folded into the peaks of all running stages.
+    Nested and concurrent stages therefore each get the peak of their own run.
+    Since stages nest and overlap, the run's total wall and CPU time are
+    measured between `start()` and `stop()` rather than summed over stages.
+    """
+
+    target_slug: str
+    cprofile_dir: Optional[Path] = None
+    stages: List[StageProfile] = attr.Factory(list)
+    _cprofile: Optional[cProfile.Profile] = None
+    _started_tracing: bool = False
+    # peak memory so far of every running stage, by stage ID
+    _running_peaks: Dict[int, int] = attr.Factory(dict)
+    _stage_ids: Iterator[int] = attr.Factory(itertools.count)
+    _lock: threading.Lock = attr.Factory(threading.Lock)
+    # wall and CPU time when the run started, and its totals once it stopped
+    _wall_start: Optional[float] = None
+    _cpu_start: Optional[float] = None
+    _wall_seconds: float = 0.0
+    _cpu_seconds: float = 0.0
+
+    def _fold_peak(self) -> None:
+        peak = tracemalloc.get_traced_memory()[1]
+        for stage_id, running_peak in self._running_peaks.items():
+            self._running_peaks[stage_id] = max(running_peak, peak)
+        tracemalloc.reset_peak()
+
+    @contextlib.contextmanager
+    def stage(self, name: str) -> Iterator[None]:
+        with self._lock:
+            self._fold_peak()
+            stage_id = next(self._stage_ids)
+            self._running_peaks[stage_id] = 0
+        wall_start, cpu_start = time.perf_counter(), time.process_time()
+        try:
+            yield
+        finally:
+            with self._lock:
+                self._fold_peak()
+                peak_memory_bytes = self._running_peaks.pop(stage_id)
+            self.stages.append(
+                StageProfile(
+                    name=name,
+                    wall_seconds=time.perf_counter() - wall_start,
+                    cpu_seconds=time.process_time() - cpu_start,
+                    peak_memory_bytes=peak_memory_bytes,
+                )
+            )
+
+    def start(self) -> None:
+        self._wall_start, self._cpu_start = time.perf_counter(), time.process_time()
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self._started_tracing = True
+        if self.cprofile_dir is not None:
+            self._cprofile = cProfile.Profile()
+            self._cprofile.enable()
+
+    def stop(self) -> None:
+        if self._wall_start is not None and self._cpu_start is not None:
+            self._wall_seconds = time.perf_counter() - self._wall_start
+            self._cpu_seconds = time.process_time() - self._cpu_start
+            self._wall_start = self._cpu_start = None
+        if self._cprofile is not None:
+            self._cprofile.disable()
+            self.cprofile_dir.mkdir(parents=True, exist_ok=True)  # type: ignore[union-attr]
+            path = self.cprofile_dir / f"{self.target_slug}.prof"  # type: ignore[operator]
+            self._cprofile.dump_stats(path)
+            logger.info(f"cProfile for {self.target_slug} saved at {path}")
+            self._cprofile = None
+        if self._started_tracing:
+            tracemalloc.stop()
+            self._started_tracing = False
+
+    def summary(self) -> Dict[str, Any]:
+        return {
+            "target_slug": self.target_slug,
+            "wall_seconds": self._wall_seconds,
+            "cpu_seconds": self._cpu_seconds,
+            "peak_memory_bytes": max((stage.peak_memory_bytes for stage in self.stages), default=0),
+            "peak_rss_bytes": peak_rss_bytes(),
+            "stages": [attr.asdict(stage) for stage in self.stages],
+        }
+
+    def to_json(self) -> str:
+        return json.dumps(self.summary())
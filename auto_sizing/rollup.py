@@ -0,0 +1,159 @@
+import re
+from typing import Dict, List, Optional, Sequence
+
+from mozanalysis.metrics import DataSource, Metric
+from pandas import DataFrame
+
+from .utils import normalize_sql
+
+ADDITIVE_FUNCTIONS = {"SUM", "COUNT", "COUNTIF"}
+
+
+def _split_call(expr: str) -> Optional[List[str]]:
+    """
+    Returns `[function, arguments...]` if `expr` is a single function call,
+    e.g. `COALESCE(SUM(x), 0)` -> `["COALESCE", "SUM(x)", "0"]`.
+    """
+    match = re.match(r"^([A-Za-z_]+)\s*\(", expr)
+    if not match or not expr.endswith(")"):
+        return None
+
+    args, depth, start = [], 0, match.end()
+    for i in range(match.end() - 1, len(expr)):
+        if expr[i] == "(":
+            depth += 1
+        elif expr[i] == ")":
+            depth -= 1
+            if depth == 0 and i != len(expr) - 1:
+                # the first call closes before the end, e.g. `SUM(x) / SUM(y)`
+                return None
+        elif expr[i] == "," and depth == 1:
+            args.append(expr[start:i].strip())
+            start = i + 1
+    args.append(expr[start:-1].strip())
+
+    return [match.group(1).upper(), *args]
+
+
+def daily_rollup(metric: Metric, value: Optional[str] = None) -> Optional[str]:
+    """
+    Returns the SQL that combines a metric's per-day values (`value`, by
+    default the metric's column of the `daily` table) over an analysis window,
+    or None if the metric can't be computed from per-day values.
+
+    Sums, counts and counts of distinct submission dates are additive across
+    days, so their value over a window is the sum of their per-day values.
+    """
+    expr = normalize_sql(metric.select_expr)
+    call = _split_call(expr)
+    coalesce = False
+    if call and call[0] == "COALESCE" and len(call) == 3 and call[2] == "0":
+        coalesce = True
+        call = _split_call(call[1])
+
+    if not call or call[0] not in ADDITIVE_FUNCTIONS or len(call) != 2:
+        return None
+
+    argument = call[1]
+    if argument.upper().startswith("DISTINCT"):
+        submission_date = metric.data_source.submission_date_column or "submission_date"
+        distinct_column = argument.split(None, 1)[-1]
+        if distinct_column not in (submission_date, f"ds.{submission_date}"):
+            return None
+
+    rollup = f"SUM({value or f'daily.{metric.name}'})"
+    return f"COALESCE({rollup}, 0)" if coalesce or call[0] != "SUM" else rollup
+
+
+def is_additive(metric_list: List[Metric]) -> bool:
+    return all(daily_rollup(metric) is not None for metric in metric_list)
+
+
+def window_column(metric_name: str, analysis_length: int) -> str:
+    return f"{metric_name}_{analysis_length}d"
+
+
+def window_frame(df: DataFrame, metric_list: List[Metric], analysis_length: int) -> DataFrame:
+    """Returns the metrics of one analysis window under the metrics' own names."""
+    return df.rename(columns={window_column(m.name, analysis_length): m.name for m in metric_list})
+
+
+def build_daily_metrics_query(
+    data_source: DataSource,
+    metrics: List[Metric],
+    targets_table: str,
+    first_date: str,
+    last_date: str,
+    experiment_name: str,
+) -> str:
+    """Returns per-client, per-day values of metrics for every client in the targets table."""
+    client_id = data_source.client_id_column or "client_id"
+    submission_date = data_source.submission_date_column or "submission_date"
+    metrics_columns = ",\n        ".join(
+        f"{m.select_expr.format(experiment_name=experiment_name)} AS {m.name}" for m in metrics
+    )
+
+    return f"""
+    SELECT
+        ds.{client_id} AS client_id,
+        ds.{submission_date} AS submission_date,
+        {metrics_columns}
+    FROM {data_source.from_expr_for(None)} ds
+    WHERE ds.{submission_date} BETWEEN '{first_date}' AND '{last_date}'
+        AND ds.{client_id} IN (SELECT DISTINCT client_id FROM `{targets_table}`)
+    GROUP BY 1, 2
+    """
+
+
+def build_rollup_metrics_query(
+    targets_table: str,
+    daily_tables: Dict[str, List[Metric]],
+    analysis_lengths: List[int],
+    keys: Sequence[str] = ("client_id",),
+) -> str:
+    """
+    Sums per-day metric values over the analysis windows of every row of
+    the targets table, with one column per metric and window length.
+    """
+    longest = max(analysis_lengths)
+    group_by = ", ".join(f"t.{key}" for key in keys)
+
+    subqueries, columns = [], []
+    for i, (daily_table, metrics) in enumerate(daily_tables.items()):
+        rollups = []
+        for m in metrics:
+            for analysis_length in analysis_lengths:
+                value = f"daily.{m.name}"
+                if analysis_length != longest:
+                    value = (
+                        "IF(daily.submission_date < "
+                        + f"DATE_ADD(t.enrollment_date, INTERVAL {analysis_length} DAY), "
+                        + f"{value}, NULL)"
+                    )
+                column = window_column(m.name, analysis_length)
+                rollups.append(f"{daily_rollup(m, value)} AS {column}")
+                columns.append(f"ds_{i}.{column}")
+
+        rollups_sql = ",\n            ".join(rollups)
+        subqueries.append(
+            f"""
+    LEFT JOIN (
+        SELECT
+            {group_by},
+            {rollups_sql}
+        FROM `{targets_table}` t
+        LEFT JOIN `{daily_table}` daily
+            ON daily.client_id = t.client_id
+            AND daily.submission_date BETWEEN t.enrollment_date
+                AND DATE_ADD(t.enrollment_date, INTERVAL {longest - 1} DAY)
+        GROUP BY {group_by}
+    ) ds_{i} USING ({", ".join(keys)})"""
+        )
+
+    return f"""
+    SELECT
+        targets.*,
+        {", ".join(columns)}
+    FROM `{targets_table}` targets
+    {"".join(subqueries)}
+    """
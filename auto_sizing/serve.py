@@ -0,0 +1,203 @@
+import json
+import logging
+import re
+import threading
+from collections import OrderedDict
+from http import HTTPStatus
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from typing import Any, Dict, Optional, Protocol, Tuple
+from urllib.parse import parse_qs, urlparse
+
+import google.cloud.storage as storage
+
+from .export_json import SAMPLE_SIZE_PATH, build_target_key_from_recipe
+
+logger = logging.getLogger(__name__)
+
+RESULTS_FILE_PREFIX = f"{SAMPLE_SIZE_PATH}_auto_sizing_results_"
+# dated result files only, `latest` is a copy of the newest one
+DATED_RESULTS_PATTERN = re.compile(rf"{RESULTS_FILE_PREFIX}(\d{{4}}_\d{{2}}_\d{{2}})\.json$")
+LOCALE_PATTERN = re.compile(r"^[A-Za-z_-]+$")
+
+
+class ResultsSource(Protocol):
+    def latest_version(self) -> Optional[str]: ...
+
+    def load(self, version: str) -> Dict[str, Any]: ...
+
+
+class GcsResultsSource:
+    def __init__(self, project_id: str, bucket: str):
+        self.client = storage.Client(project_id)
+        self.bucket = bucket
+
+    def latest_version(self) -> Optional[str]:
+        names = [
+            blob.name
+            for blob in self.client.list_blobs(
+                self.bucket, prefix=f"{SAMPLE_SIZE_PATH}/{RESULTS_FILE_PREFIX}"
+            )
+            if DATED_RESULTS_PATTERN.search(blob.name)
+        ]
+        return max(names) if names else None
+
+    def load(self, version: str) -> Dict[str, Any]:
+        return json.loads(self.client.bucket(self.bucket).blob(version).download_as_string())
+
+
+class LocalResultsSource:
+    def __init__(self, path: Path):
+        self.path = Path(path)
+
+    def latest_version(self) -> Optional[str]:
+        names = [
+            file.name
+            for file in self.path.glob(f"{RESULTS_FILE_PREFIX}*.json")
+            if DATED_RESULTS_PATTERN.search(file.name)
+        ]
+        return max(names) if names else None
+
+    def load(self, version: str) -> Dict[str, Any]:
+        return json.loads((self.path / version).read_text())
+
+
+def recipe_from_query(query: Dict[str, str]) -> Tuple[Dict[str, Optional[str]], str]:
+    """
+    Converts lookup parameters into a recipe and the requested user type.
+    Locales are given as a comma-separated list, e.g. `EN-US,EN-CA`.
+    """
+    if "app_id" not in query:
+        raise ValueError("app_id is required")
+
+    locale = None
+    if query.get("locale"):
+        locales = [locale.strip() for locale in query["locale"].split(",")]
+        if not all(LOCALE_PATTERN.match(locale) for locale in locales):
+            raise ValueError(f"Invalid locale: {query['locale']}")
+        locale = "(" + ", ".join(f"'{locale}'" for locale in locales) + ")"
+
+    recipe = {
+        "app_id": query["app_id"],
+        "channel": query.get("channel"),
+        "locale": locale,
+        "country": query.get("country"),
+    }
+
+    return recipe, query.get("user_type", "all")
+
+
+class SizingService:
+    """
+    Serves lookups from an in-memory index of the newest results, keeping
+    the most recently requested targets in a bounded LRU cache.
+    """
+
+    def __init__(self, source: ResultsSource, cache_size: int = 1024):
+        self.source = source
+        self.cache_size = cache_size
+        self.version: Optional[str] = None
+        self._index: Dict[str, Any] = {}
+        self._cache: OrderedDict[Tuple[str, str], Optional[bytes]] = OrderedDict()
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+
+    def reload_if_updated(self) -> bool:
+        version = self.source.latest_version()
+        if version is None or version == self.version:
+            return False
+
+        logger.info(f"Loading sizing results from {version}")
+        index = self.source.load(version)
+        with self._lock:
+            self._index = index
+            self.version = version
+            self._cache.clear()
+
+        return True
+
+    def lookup(self, recipe: Dict[str, Optional[str]], user_type: str = "all") -> Optional[bytes]:
+        """Returns the encoded results for a recipe, or None if it wasn't sized."""
+        target_key = build_target_key_from_recipe(recipe)  # type: ignore[arg-type]
+        key = (target_key, user_type)
+        with self._lock:
+            if key in self._cache:
+                self._cache.move_to_end(key)
+                return self._cache[key]
+
+            target = self._index.get(target_key, {}).get(user_type)
+            result = json.dumps(target).encode() if target is not None else None
+
+            self._cache[key] = result
+            if len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+
+        return result
+
+    def start_reloader(self, interval: float) -> threading.Thread:
+        """Periodically checks for newer results in a background thread."""
+
+        def reload():
+            while not self._stopped.wait(interval):
+                try:
+                    self.reload_if_updated()
+                except Exception as e:
+                    logger.exception(f"Failed to reload sizing results: {e}", exc_info=e)
+
+        thread = threading.Thread(target=reload, daemon=True)
+        thread.start()
+        return thread
+
+    def stop(self) -> None:
+        self._stopped.set()
+
+
+def make_handler(service: SizingService):
+    class SizingRequestHandler(BaseHTTPRequestHandler):
+        def _respond(self, status: HTTPStatus, body: bytes) -> None:
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            url = urlparse(self.path)
+            if url.path == "/health":
+                self._respond(HTTPStatus.OK, json.dumps({"version": service.version}).encode())
+                return
+
+            if url.path != "/sizes":
+                self._respond(HTTPStatus.NOT_FOUND, b'{"error": "not found"}')
+                return
+
+            query = {key: values[-1] for key, values in parse_qs(url.query).items()}
+            try:
+                recipe, user_type = recipe_from_query(query)
+            except ValueError as e:
+                self._respond(HTTPStatus.BAD_REQUEST, json.dumps({"error": str(e)}).encode())
+                return
+
+            result = service.lookup(recipe, user_type)
+            if result is None:
+                self._respond(HTTPStatus.NOT_FOUND, b'{"error": "no sizing for this recipe"}')
+            else:
+                self._respond(HTTPStatus.OK, result)
+
+        def log_message(self, format, *args):
+            logger.debug(format % args)
+
+    return SizingRequestHandler
+
+
+def serve(service: SizingService, host: str, port: int, reload_interval: float) -> None:
+    service.reload_if_updated()
+    service.start_reloader(reload_interval)
+
+    server = ThreadingHTTPServer((host, port), make_handler(service))
+    logger.info(f"Serving sizing lookups on http://{host}:{port}/sizes")
+    try:
+        server.serve_forever()
+    finally:
+        service.stop()
+        server.server_close()
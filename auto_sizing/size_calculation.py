@@ -1,19 +1,66 @@
+import contextlib
+import functools
+import hashlib
+import itertools
 import json
-from datetime import datetime, timedelta
+import logging
+import re
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from datetime import date, datetime, timedelta
 from pathlib import Path
-from typing import Any, Dict, Optional, Tuple
+from typing import Any, Callable, Dict, List, Optional, Tuple, TypeVar
 
 import attr
+from google.api_core.exceptions import NotFound, TooManyRequests
+from google.cloud import bigquery
 from mozanalysis.bq import BigQueryContext, sanitize_table_name_for_bq
 from mozanalysis.experiment import TimeLimits
 from mozanalysis.frequentist_stats.sample_size import z_or_t_ind_sample_size_calc
+from mozanalysis.metrics import DataSource, Metric
 from mozanalysis.sizing import HistoricalTarget
 from pandas import DataFrame
 
 import auto_sizing.errors as errors
-from auto_sizing.export_json import export_sample_size_json
+from auto_sizing.aggregate import AggregateStore, merge_target_results
+from auto_sizing.availability import PartitionChecker, source_tables
+from auto_sizing.bootstrap import bootstrap_variance_ratios, confidence_interval
+from auto_sizing.export_json import (
+    export_profile_json,
+    export_sample_size_json,
+    export_skipped_json,
+)
+from auto_sizing.frames import compact_frame, frame_memory
+from auto_sizing.limiter import ConcurrencyLimiter, is_quota_error
+from auto_sizing.profiling import Profiler, peak_rss_bytes
+from auto_sizing.rollup import (
+    build_daily_metrics_query,
+    build_rollup_metrics_query,
+    is_additive,
+    window_column,
+    window_frame,
+)
 from auto_sizing.targets import SizingConfiguration
-from auto_sizing.utils import delete_bq_table
+from auto_sizing.utils import delete_bq_table, retry_with_backoff
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+
+@functools.lru_cache(maxsize=None)
+def bigquery_context(project_id: str, dataset_id: str) -> BigQueryContext:
+    # shared by every target sized in the process, so clients and connections are reused
+    return BigQueryContext(project_id=project_id, dataset_id=dataset_id)
+
+
+def metrics_by_data_source(metric_list: List[Metric]) -> Dict[DataSource, List[Metric]]:
+    data_sources: Dict[DataSource, List[Metric]] = {}
+    for metric in metric_list:
+        data_sources.setdefault(metric.data_source, []).append(metric)
+    return data_sources
 
 
 @attr.s(auto_attribs=True)
@@ -24,19 +71,165 @@ class SizeCalculation:
     dataset: str
     bucket: str
     config: SizingConfiguration
+    # identifies a run across container restarts so that retries can reattach to its jobs
+    run_id: str = attr.Factory(lambda: uuid.uuid4().hex)
+    max_attempts: int = 3
+    retry_delay: float = 30.0
+    limiter: Optional[ConcurrencyLimiter] = None
+    profiler: Optional[Profiler] = None
+    # targets with fewer clients are skipped before their metrics are queried
+    min_population: int = 0
+    # query the metrics of each data source separately and concurrently
+    split_data_sources: bool = False
+    # number of bootstrap resamples used for sample size intervals, or 0 for none
+    bootstrap_samples: int = 0
+    # checks that the partitions the target reads have landed before querying them
+    availability: Optional[PartitionChecker] = None
+    # seconds a stage's query may take before it is cancelled, by default and by stage prefix
+    stage_timeout: Optional[float] = None
+    stage_timeouts: Dict[str, float] = attr.Factory(dict)
+    # jobs of the stages currently running, so they can be cancelled when interrupted
+    _active_jobs: Dict[str, bigquery.QueryJob] = attr.Factory(dict)
+    # the run's aggregate that published results are merged into as soon as they are uploaded
+    aggregate: Optional[AggregateStore] = None
+
+    def _stage(self, name: str) -> contextlib.AbstractContextManager:
+        return self.profiler.stage(name) if self.profiler else contextlib.nullcontext()
 
     @property
-    def bigquerycontext(self):
-        return BigQueryContext(project_id=self.project, dataset_id=self.dataset)
+    def bigquerycontext(self) -> BigQueryContext:
+        return bigquery_context(self.project, self.dataset)
+
+    def _job_id_prefix(self, stage: str, sql: str) -> str:
+        sql_hash = hashlib.sha256(sql.encode()).hexdigest()[:16]
+        return re.sub(
+            r"[^a-zA-Z0-9_-]",
+            "_",
+            f"auto_sizing_{self.config.target_slug}_{stage}_{self.run_id}_{sql_hash}",
+        )
+
+    def _table_exists(self, client: bigquery.Client, table: str) -> bool:
+        try:
+            client.get_table(table)
+            return True
+        except NotFound:
+            return False
+
+    def _submit_or_reattach(self, stage: str, sql: str, destination: str) -> bigquery.QueryJob:
+        """
+        Returns the job for this stage, reusing a job with the same deterministic
+        ID if it is still running or already succeeded, and submitting a new one otherwise.
+        """
+        client = self.bigquerycontext.client
+        job_id_prefix = self._job_id_prefix(stage, sql)
+
+        for attempt in itertools.count():
+            job_id = f"{job_id_prefix}_{attempt}"
+            try:
+                job = client.get_job(job_id)
+            except NotFound:
+                logger.info(f"Submitting {stage} job {job_id}")
+                return client.query(
+                    sql,
+                    job_config=bigquery.QueryJobConfig(
+                        destination=destination,
+                        write_disposition=bigquery.WriteDisposition.WRITE_TRUNCATE,
+                    ),
+                    job_id=job_id,
+                )
+
+            if job.state != "DONE" or (
+                job.error_result is None and self._table_exists(client, destination)
+            ):
+                logger.info(f"Reattaching to {stage} job {job_id}")
+                return job
+
+            # the job failed or its results were deleted, so it is resubmitted under the next ID
+
+        raise AssertionError("unreachable")
+
+    def _run_stage_query(self, stage: str, sql: str, table_name: str) -> str:
+        """
+        Runs a stage's query into `table_name`, retrying transient failures.
+        Returns the fully qualified destination table.
+        """
+        with self._stage(f"{stage}_query"):
+            return self._run_stage_query_with_retries(stage, sql, table_name)
+
+    def _stage_timeout(self, stage: str) -> Optional[float]:
+        """Returns the timeout of the longest matching stage prefix, or the default timeout."""
+        for prefix in sorted(self.stage_timeouts, key=len, reverse=True):
+            if stage.startswith(prefix):
+                return self.stage_timeouts[prefix]
+        return self.stage_timeout
 
-    def _validate_requested_timelimits(self, current_date: datetime) -> Optional[TimeLimits]:
+    def cancel_jobs(self) -> None:
+        """Cancels the BigQuery jobs of the stages that are still running."""
+        for stage, job in list(self._active_jobs.items()):
+            logger.warning(
+                f"Cancelling {stage} job {job.job_id}",
+                extra={"target": self.config.target_slug},
+            )
+            try:
+                job.cancel()
+            except Exception as e:
+                logger.exception(f"Failed to cancel job {job.job_id}: {e}", exc_info=e)
+
+    def _run_stage_query_with_retries(self, stage: str, sql: str, table_name: str) -> str:
+        destination = self.bigquerycontext.fully_qualify_table_name(table_name)
+        timeout = self._stage_timeout(stage)
+        # the deadline covers the whole stage, including retries
+        deadline = time.monotonic() + timeout if timeout else None
+
+        def run_stage():
+            lease = self.limiter.lease() if self.limiter else contextlib.nullcontext()
+            with lease:
+                job = None
+                try:
+                    # quota and rate limit errors are raised when jobs are submitted too
+                    job = self._submit_or_reattach(stage, sql, destination)
+                    self._active_jobs[stage] = job
+                    job.result(timeout=max(0.0, deadline - time.monotonic()) if deadline else None)
+                except (FutureTimeoutError, errors.RunInterruptedException) as e:
+                    if job is not None:
+                        job.cancel()
+                    if isinstance(e, errors.RunInterruptedException):
+                        raise
+                    raise errors.StageDeadlineExceededException(
+                        self.config.target_slug, stage, timeout
+                    )
+                except Exception as e:
+                    if not is_quota_error(e):
+                        raise
+                    if self.limiter:
+                        self.limiter.record_quota_error()
+                    # quota errors are transient, so they are retried with backoff
+                    raise TooManyRequests(str(e)) from e
+                finally:
+                    self._active_jobs.pop(stage, None)
+
+            if self.limiter and job.created and job.started:
+                self.limiter.record_success((job.started - job.created).total_seconds())
+
+        retry_with_backoff(
+            run_stage,
+            description=f"{stage} query for {self.config.target_slug}",
+            attempts=self.max_attempts,
+            delay=self.retry_delay,
+        )
+
+        return destination
+
+    def _validate_requested_timelimits(self, current_date: date) -> TimeLimits:
         """
         Checks if requested dates of data are available and not in the future.
-        Returns a TimeLimits instance if possible; else, returns None.
+        Returns a TimeLimits instance if possible; else, raises.
         """
 
+        # the longest window determines when the data for every window is complete
+        analysis_length = max(self.config.window_lengths)
         last_date_full_data = datetime.strptime(self.config.start_date, "%Y-%m-%d") + timedelta(
-            days=(self.config.num_dates_enrollment + self.config.analysis_length - 1)
+            days=(self.config.num_dates_enrollment + analysis_length - 1)
         )
 
         if last_date_full_data.date() >= current_date:
@@ -46,37 +239,275 @@ class SizeCalculation:
             self.config.start_date,
             last_date_full_data.strftime("%Y-%m-%d"),
             0,
-            self.config.analysis_length,
+            analysis_length,
             self.config.num_dates_enrollment,
         )
 
-    def calculate_metrics(
-        self,
-        time_limits: TimeLimits,
-        ht: HistoricalTarget,
-    ) -> Tuple[DataFrame, str]:
+    def _targets_table_name(self) -> str:
+        return sanitize_table_name_for_bq("_".join(["auto-sizing", self.config.target_slug]))
+
+    def _run_targets_stage(self, time_limits: TimeLimits, ht: HistoricalTarget) -> str:
         targets_sql = ht.build_targets_query(
             time_limits=time_limits,
             target_list=self.config.target_list,
         )
 
-        targets_table_name = sanitize_table_name_for_bq(
-            "_".join(
-                [
-                    "auto-sizing",
-                    self.config.target_slug,
+        targets_table = self._run_stage_query("targets", targets_sql, self._targets_table_name())
+        self._check_population(targets_table)
+
+        return targets_table
+
+    def _check_population(self, targets_table: str) -> None:
+        """
+        Raises if fewer than `min_population` clients satisfied targeting.
+
+        The targets table has a row per client, so its size is read from the
+        table's metadata without scanning it.
+        """
+        if not self.min_population:
+            return
+
+        num_clients = self.bigquerycontext.client.get_table(targets_table).num_rows
+        if num_clients < self.min_population:
+            delete_bq_table(targets_table, self.project)
+            raise errors.PopulationTooSmallException(
+                self.config.target_slug, num_clients, self.min_population
+            )
+
+    def _run_daily_stages(
+        self, targets_table: str, first_date: str, last_date: str, table_prefix: str = "daily"
+    ) -> Dict[str, List[Metric]]:
+        """
+        Computes per-client daily values of the metrics of every data source for
+        the clients in `targets_table`. Returns the daily tables and their metrics.
+        """
+
+        def run_daily_stage(data_source: DataSource, metrics: List[Metric]) -> str:
+            daily_sql = build_daily_metrics_query(
+                data_source,
+                metrics,
+                targets_table,
+                first_date,
+                last_date,
+                self.config.target_slug,
+            )
+            daily_table_name = sanitize_table_name_for_bq(
+                "_".join([table_prefix, data_source.name, self.config.target_slug])
+            )
+            return self._run_stage_query(f"daily_{data_source.name}", daily_sql, daily_table_name)
+
+        data_sources = metrics_by_data_source(self.config.metric_list)
+        daily_tables = self._map_stages(run_daily_stage, list(data_sources.items()))
+
+        return dict(zip(daily_tables, data_sources.values()))
+
+    def _map_stages(self, func: Callable[..., T], args: List[Tuple]) -> List[T]:
+        """Runs `func` for every tuple of arguments, concurrently if splitting data sources."""
+        if not self.split_data_sources or len(args) < 2:
+            return [func(*arg) for arg in args]
+
+        with ThreadPoolExecutor(max_workers=len(args)) as executor:
+            return list(executor.map(lambda arg: func(*arg), args))
+
+    def _run_metrics_stages(
+        self,
+        ht: HistoricalTarget,
+        time_limits: TimeLimits,
+        targets_table: str,
+        metrics_table_name: str,
+        stage: str = "metrics",
+        keep_client_id: bool = False,
+    ) -> DataFrame:
+        """
+        Queries the metrics of every client in `targets_table`. If splitting data
+        sources, each data source's metrics are queried into their own table
+        concurrently and merged on `client_id`, instead of joining every data
+        source in one wide query. Only the metric columns are kept, and
+        `client_id` if it's needed to merge the result with other metrics.
+        """
+        client_id = ["client_id"] if keep_client_id else []
+        if not self.split_data_sources:
+            metrics_sql = ht.build_metrics_query(
+                time_limits=time_limits,
+                metric_list=self.config.metric_list,
+                targets_table=targets_table,
+            )
+            metrics_table = self._run_stage_query(stage, metrics_sql, metrics_table_name)
+            return self._download_table(
+                metrics_table, [*client_id, *(m.name for m in self.config.metric_list)]
+            )
+
+        def run_metrics_stage(data_source: DataSource, metrics: List[Metric]) -> DataFrame:
+            metrics_sql = ht.build_metrics_query(
+                time_limits=time_limits, metric_list=metrics, targets_table=targets_table
+            )
+            metrics_table = self._run_stage_query(
+                f"{stage}_{data_source.name}",
+                metrics_sql,
+                sanitize_table_name_for_bq(f"{metrics_table_name}_{data_source.name}"),
+            )
+            return self._download_table(metrics_table, ["client_id", *(m.name for m in metrics)])
+
+        data_sources = metrics_by_data_source(self.config.metric_list)
+        frames = self._map_stages(run_metrics_stage, list(data_sources.items()))
+        df = frames[0]
+        for frame, metrics in zip(frames[1:], list(data_sources.values())[1:]):
+            df = df.merge(frame[["client_id", *(m.name for m in metrics)]], on="client_id")
+
+        return df if keep_client_id else df.drop(columns="client_id")
+
+    def _download_table(self, table: str, columns: Optional[List[str]] = None) -> DataFrame:
+        """
+        Downloads the given columns of a table, or all of them, into a frame of
+        compact columns rather than the object strings and 64 bit numbers that
+        `to_dataframe` returns.
+        """
+        client = self.bigquerycontext.client
+
+        def download() -> DataFrame:
+            selected_fields = None
+            if columns is not None:
+                selected_fields = [
+                    field for field in client.get_table(table).schema if field.name in columns
                 ]
+            return compact_frame(
+                client.list_rows(table, selected_fields=selected_fields).to_arrow()
+            )
+
+        with self._stage("download"):
+            df = retry_with_backoff(
+                download,
+                description=f"Downloading metrics for {self.config.target_slug}",
+                attempts=self.max_attempts,
+                delay=self.retry_delay,
             )
+
+        logger.info(
+            f"Downloaded {len(df)} rows of {table} into {frame_memory(df) / 2**20:.1f} MiB",
+            extra={"target": self.config.target_slug},
         )
+        return df
 
-        self.bigquerycontext.run_query(targets_sql, targets_table_name, replace_tables=True)
+    def calculate_window_metrics(self, time_limits: TimeLimits) -> Tuple[DataFrame, str]:
+        """
+        Computes metrics for every analysis window length in one pass over the
+        longest window, with one column per metric and window length.
+        """
+        targets_table = self._run_targets_stage(time_limits, self._historical_target())
+        metrics_table_name = sanitize_table_name_for_bq(
+            "_".join(["metrics-table", self.config.target_slug])
+        )
 
-        metrics_sql = ht.build_metrics_query(
-            time_limits=time_limits,
-            metric_list=self.config.metric_list,
-            targets_table=self.bigquerycontext.fully_qualify_table_name(targets_table_name),
+        if is_additive(self.config.metric_list):
+            daily_tables = self._run_daily_stages(
+                targets_table,
+                time_limits.first_date_data_required,
+                time_limits.last_date_data_required,
+            )
+            metrics_sql = build_rollup_metrics_query(
+                targets_table, daily_tables, self.config.window_lengths
+            )
+            metrics_table = self._run_stage_query("metrics", metrics_sql, metrics_table_name)
+            df = self._download_table(
+                metrics_table,
+                [
+                    window_column(m.name, analysis_length)
+                    for m in self.config.metric_list
+                    for analysis_length in self.config.window_lengths
+                ],
+            )
+            for table in [targets_table, *daily_tables]:
+                delete_bq_table(table, self.project)
+
+            return df, metrics_table_name
+
+        # metrics that can't be combined from daily values are queried for each window
+        logger.warning(
+            f"Metrics of {self.config.target_slug} aren't additive across days; "
+            + "querying each analysis window separately"
+        )
+        df = None
+        for analysis_length in self.config.window_lengths:
+            window_time_limits = TimeLimits.for_single_analysis_window(
+                time_limits.first_enrollment_date,
+                time_limits.last_date_data_required,
+                0,
+                analysis_length,
+                self.config.num_dates_enrollment,
+            )
+            window_df = self._run_metrics_stages(
+                self._historical_target(analysis_length),
+                window_time_limits,
+                targets_table,
+                f"{metrics_table_name}_{analysis_length}d",
+                stage=f"metrics_{analysis_length}d",
+                keep_client_id=True,
+            ).rename(
+                columns={
+                    m.name: window_column(m.name, analysis_length) for m in self.config.metric_list
+                }
+            )
+            df = window_df if df is None else df.merge(window_df, on="client_id")
+        delete_bq_table(targets_table, self.project)
+
+        return df.drop(columns="client_id"), metrics_table_name
+
+    def calculate_window_sizes(self, metrics_table: DataFrame) -> Dict[str, Any]:
+        """Returns sizes for every window, keyed by parameters and window length."""
+        results_combined = {}
+        for analysis_length in self.config.window_lengths:
+            window_metrics = window_frame(metrics_table, self.config.metric_list, analysis_length)
+            variance_ratios = self._bootstrap(window_metrics)
+            for parameters in self.config.parameters:
+                res = self.calculate_sample_sizes(
+                    metrics_table=window_metrics, parameters=parameters
+                )
+                for metric, ratios in variance_ratios.items():
+                    sizes = res["metrics"][metric]
+                    interval = confidence_interval(sizes["sample_size_per_branch"], ratios)
+                    if interval is not None:
+                        sizes["sample_size_per_branch_ci"] = interval
+                res["parameters"] = parameters
+                if len(self.config.window_lengths) > 1:
+                    res["parameters"] = {**parameters, "analysis_length": analysis_length}
+                key = f"Power{str(parameters['power'])}EffectSize{str(parameters['effect_size'])}"
+                # the configured window keeps the usual key so existing consumers are unaffected
+                if analysis_length != self.config.analysis_length:
+                    key += f"AnalysisLength{analysis_length}"
+                results_combined[key] = res
+
+        return results_combined
+
+    def _bootstrap(self, metrics_table: DataFrame) -> Dict[str, Any]:
+        """
+        Resamples the clients once for all parameters, since bootstrapped sample
+        sizes of every parameter follow from the same resampled metric variances.
+        """
+        if not self.bootstrap_samples:
+            return {}
+
+        with self._stage("bootstrap"):
+            return bootstrap_variance_ratios(
+                metrics_table,
+                [m.name for m in self.config.metric_list],
+                self.bootstrap_samples,
+            )
+
+    def _historical_target(self, analysis_length: Optional[int] = None) -> HistoricalTarget:
+        return HistoricalTarget(
+            experiment_name=self.config.target_slug,
+            start_date=self.config.start_date,
+            analysis_length=analysis_length or self.config.analysis_length,
+            num_dates_enrollment=self.config.num_dates_enrollment,
         )
 
+    def calculate_metrics(
+        self,
+        time_limits: TimeLimits,
+        ht: HistoricalTarget,
+    ) -> Tuple[DataFrame, str]:
+        targets_table = self._run_targets_stage(time_limits, ht)
+
         metrics_table_name = sanitize_table_name_for_bq(
             "_".join(
                 [
@@ -86,12 +517,8 @@ class SizeCalculation:
             )
         )
 
-        df = self.bigquerycontext.run_query(
-            metrics_sql, metrics_table_name, replace_tables=True
-        ).to_dataframe()
-        delete_bq_table(
-            self.bigquerycontext.fully_qualify_table_name(targets_table_name), self.project
-        )
+        df = self._run_metrics_stages(ht, time_limits, targets_table, metrics_table_name)
+        delete_bq_table(targets_table, self.project)
 
         return df, metrics_table_name
 
@@ -121,44 +548,236 @@ class SizeCalculation:
         return result_dict
 
     def publish_results(self, result_dict: Dict[str, Any], current_date: str) -> None:
+        with self._stage("serialize"):
+            result_json = json.dumps(result_dict)
+
+        with self._stage("upload"):
+            self._write_results(result_json, current_date)
+
+    def _write_results(self, result_json: str, current_date: str) -> None:
         if self.config.config_file and not self.bucket:
             path = Path(self.config.config_file.name).parent / f"{self.config.target_slug}.json"
-            path.write_text(json.dumps(result_dict))
+            path.write_text(result_json)
             print(f"Results saved at {path}")
 
         else:
-            export_sample_size_json(
-                self.project,
-                self.bucket,
-                self.config.target_slug,
-                json.dumps(result_dict),
-                current_date,
+            # equivalent targets were only run once, so their results are published for every slug
+            for target_slug in [self.config.target_slug, *self.config.duplicate_slugs]:
+                export_sample_size_json(
+                    self.project,
+                    self.bucket,
+                    target_slug,
+                    result_json,
+                    current_date,
+                    max_attempts=self.max_attempts,
+                )
+                if self.aggregate is not None:
+                    self._merge_results(self.aggregate, target_slug, result_json)
+
+    @staticmethod
+    def _merge_results(aggregate: AggregateStore, target_slug: str, result_json: str) -> None:
+        # the export step falls back to downloading results that couldn't be merged
+        try:
+            merge_target_results(aggregate, target_slug, result_json)
+        except Exception as e:
+            logger.exception(
+                f"Failed to merge results of {target_slug}: {e}",
+                exc_info=e,
+                extra={"target": target_slug},
+            )
+
+    def publish_profile(self, current_date: str) -> None:
+        """Writes the profiler's summary next to the target's results."""
+        if self.profiler is None:
+            return
+
+        profile_json = self.profiler.to_json()
+        logger.info(f"Profile for {self.config.target_slug}: {profile_json}")
+        if self.config.config_file and not self.bucket:
+            path = (
+                Path(self.config.config_file.name).parent
+                / f"{self.config.target_slug}.profile.json"
+            )
+            path.write_text(profile_json)
+            print(f"Profile saved at {path}")
+        else:
+            export_profile_json(
+                self.project, self.bucket, self.config.target_slug, profile_json, current_date
             )
 
-    def run(self, current_date: datetime) -> None:
+    def publish_skipped(
+        self, exception: errors.PopulationTooSmallException, current_date: str
+    ) -> None:
+        """
+        Writes a marker next to the target's results, so the export can tell
+        targets that were too small apart from targets whose results are missing.
+        """
+        marker_json = json.dumps(
+            {
+                "reason": "population_too_small",
+                "num_clients": exception.num_clients,
+                "min_population": exception.min_population,
+            }
+        )
+        if self.config.config_file and not self.bucket:
+            path = (
+                Path(self.config.config_file.name).parent
+                / f"{self.config.target_slug}.skipped.json"
+            )
+            path.write_text(marker_json)
+        else:
+            for target_slug in [self.config.target_slug, *self.config.duplicate_slugs]:
+                export_skipped_json(
+                    self.project, self.bucket, target_slug, marker_json, current_date
+                )
+
+    def _data_dates(self, time_limits: TimeLimits) -> Tuple[date, date]:
+        return (
+            date.fromisoformat(time_limits.first_date_data_required),
+            date.fromisoformat(time_limits.last_date_data_required),
+        )
+
+    def pruning_report(self, current_date: date) -> List[Dict[str, Any]]:
+        """
+        Dry runs the target's targets and metrics queries and reports whether
+        they only read the partitions of the dates they need.
+        """
+        if self.availability is None:
+            raise ValueError("Pruning reports require a partition checker.")
+
         time_limits = self._validate_requested_timelimits(current_date)
+        ht = self._historical_target()
+        targets_sql = ht.build_targets_query(
+            time_limits=time_limits, target_list=self.config.target_list
+        )
+        targets_table = self.bigquerycontext.fully_qualify_table_name(self._targets_table_name())
+        # the targets table doesn't exist yet, so the metrics query reads the targets query inline
+        metrics_sql = ht.build_metrics_query(
+            time_limits=time_limits,
+            metric_list=self.config.metric_list,
+            targets_table=targets_table,
+        ).replace(f"`{targets_table}`", f"({targets_sql})")
 
-        ht = HistoricalTarget(
-            experiment_name=self.config.target_slug,
-            start_date=self.config.start_date,
-            analysis_length=self.config.analysis_length,
-            num_dates_enrollment=self.config.num_dates_enrollment,
+        tables = source_tables(self.config)
+        first_date, last_date = self._data_dates(time_limits)
+        return [
+            self.availability.pruning_report(stage, sql, tables, first_date, last_date)
+            for stage, sql in [("targets", targets_sql), ("metrics", metrics_sql)]
+        ]
+
+    def rendered_queries(self, current_date: date) -> List[Tuple[str, str, str]]:
+        """
+        Returns the stage, destination table and SQL of every query the target
+        would run, rendered the same way as when they are submitted but
+        without connecting to BigQuery.
+        """
+        time_limits = self._validate_requested_timelimits(current_date)
+
+        def qualify(table_name: str) -> str:
+            # like the BigQuery context does, without creating a client
+            return f"{self.project}.{self.dataset}.{sanitize_table_name_for_bq(table_name)}"
+
+        targets_table = qualify(self._targets_table_name())
+        metrics_table = qualify("_".join(["metrics-table", self.config.target_slug]))
+        targets_sql = self._historical_target().build_targets_query(
+            time_limits=time_limits, target_list=self.config.target_list
+        )
+        queries = [("targets", targets_table, targets_sql)]
+        data_sources = metrics_by_data_source(self.config.metric_list)
+
+        if len(self.config.window_lengths) > 1 and is_additive(self.config.metric_list):
+            daily_tables = {}
+            for data_source, metrics in data_sources.items():
+                daily_table = qualify(
+                    "_".join(["daily", data_source.name, self.config.target_slug])
+                )
+                daily_sql = build_daily_metrics_query(
+                    data_source,
+                    metrics,
+                    targets_table,
+                    time_limits.first_date_data_required,
+                    time_limits.last_date_data_required,
+                    self.config.target_slug,
+                )
+                queries.append((f"daily_{data_source.name}", daily_table, daily_sql))
+                daily_tables[daily_table] = metrics
+            rollup_sql = build_rollup_metrics_query(
+                targets_table, daily_tables, self.config.window_lengths
+            )
+            return queries + [("metrics", metrics_table, rollup_sql)]
+
+        metric_lists = (
+            [(f"_{ds.name}", metrics) for ds, metrics in data_sources.items()]
+            if self.split_data_sources and len(data_sources) > 1
+            else [("", self.config.metric_list)]
         )
+        windows: List[Tuple[str, Optional[int], TimeLimits]] = [("", None, time_limits)]
+        if len(self.config.window_lengths) > 1:
+            windows = [
+                (
+                    f"_{analysis_length}d",
+                    analysis_length,
+                    TimeLimits.for_single_analysis_window(
+                        time_limits.first_enrollment_date,
+                        time_limits.last_date_data_required,
+                        0,
+                        analysis_length,
+                        self.config.num_dates_enrollment,
+                    ),
+                )
+                for analysis_length in self.config.window_lengths
+            ]
+        for window, analysis_length, window_time_limits in windows:
+            ht = self._historical_target(analysis_length)
+            for suffix, metric_list in metric_lists:
+                metrics_sql = ht.build_metrics_query(
+                    time_limits=window_time_limits,
+                    metric_list=metric_list,
+                    targets_table=targets_table,
+                )
+                queries.append(
+                    (f"metrics{window}{suffix}", f"{metrics_table}{window}{suffix}", metrics_sql)
+                )
 
-        metrics_table, metrics_table_name = self.calculate_metrics(time_limits=time_limits, ht=ht)
+        return queries
+
+    def calculate_target_metrics(self, current_date: date) -> DataFrame:
+        time_limits = self._validate_requested_timelimits(current_date)
+        if self.availability is not None:
+            self.availability.require(self.config, *self._data_dates(time_limits))
+
+        if len(self.config.window_lengths) > 1:
+            metrics_table, metrics_table_name = self.calculate_window_metrics(time_limits)
+        else:
+            metrics_table, metrics_table_name = self.calculate_metrics(
+                time_limits=time_limits, ht=self._historical_target()
+            )
         print(f"Metrics table saved at {metrics_table_name}")
 
-        results_combined = {}
+        return metrics_table
 
-        if len(metrics_table) == 0:
-            print("No clients satisfied targeting.")
-            return
+    def calculate_results(self, metrics_table: DataFrame) -> Dict[str, Any]:
+        with self._stage("sample_sizes"):
+            return self.calculate_window_sizes(metrics_table)
+
+    def run(self, current_date: date) -> None:
+        try:
+            try:
+                metrics_table = self.calculate_target_metrics(current_date)
+            except errors.PopulationTooSmallException as e:
+                self.publish_skipped(e, current_date.strftime("%Y-%m-%d"))
+                raise
 
-        for parameters in self.config.parameters:
-            res = self.calculate_sample_sizes(metrics_table=metrics_table, parameters=parameters)
-            res["parameters"] = parameters
-            results_combined[
-                f"Power{str(parameters['power'])}EffectSize{str(parameters['effect_size'])}"
-            ] = res
+            if len(metrics_table) == 0:
+                print("No clients satisfied targeting.")
+                return
 
-        self.publish_results(results_combined, current_date.strftime("%Y-%m-%d"))
+            self.publish_results(
+                self.calculate_results(metrics_table), current_date.strftime("%Y-%m-%d")
+            )
+        finally:
+            logger.info(
+                f"Peak memory of the process after sizing {self.config.target_slug}: "
+                + f"{peak_rss_bytes() / 2**20:.0f} MiB",
+                extra={"target": self.config.target_slug},
+            )
@@ -0,0 +1,103 @@
+import base64
+import math
+from typing import Iterable
+
+import attr
+import numpy as np
+
+# 2^12 registers of a HyperLogLog sketch take at most 4KB and estimate distinct counts
+# with a relative standard error of 1.04 / sqrt(2^12), i.e. about 1.6%
+PRECISION = 12
+NUM_REGISTERS = 2**PRECISION
+RELATIVE_ERROR = 1.04 / math.sqrt(NUM_REGISTERS)
+# bits of the 64 bit hash left after the register index
+REMAINDER_BITS = 64 - PRECISION
+
+
+def register_sql(client_hash: str = "client_hash") -> str:
+    """
+    Returns SQL selecting a client's HyperLogLog register and its rank from
+    the FARM_FINGERPRINT of its client ID: the first bits of the hash pick
+    the register and the rank is one more than the number of leading zeros
+    of the remaining bits.
+    """
+    mask = hex(2**REMAINDER_BITS - 1)
+    return f"""
+        ({client_hash} >> {REMAINDER_BITS}) & {NUM_REGISTERS - 1} AS register,
+        {REMAINDER_BITS + 1} - (
+            SELECT COUNTIF(({client_hash} & {mask}) >= 1 << k)
+            FROM UNNEST(GENERATE_ARRAY(0, {REMAINDER_BITS - 1})) AS k
+        ) AS register_rank"""
+
+
+@attr.s(auto_attribs=True)
+class HllSketch:
+    """
+    Sparse HyperLogLog sketch of the clients in one cube cell. Sketches of
+    different cells are merged by taking the maximum rank of every register,
+    which estimates the distinct clients of a union of cells.
+    """
+
+    registers: np.ndarray
+    ranks: np.ndarray
+
+    @classmethod
+    def from_hashes(cls, hashes: np.ndarray) -> "HllSketch":
+        """Builds a sketch from 64 bit hashes, like the registers selected by `register_sql`."""
+        hashes = hashes.astype(np.uint64)
+        registers = (hashes >> np.uint64(REMAINDER_BITS)).astype(np.int64)
+        remainders = hashes & np.uint64(2**REMAINDER_BITS - 1)
+        bit_lengths = np.zeros(len(hashes), dtype=np.int64)
+        for k in range(REMAINDER_BITS):
+            bit_lengths += remainders >= np.uint64(1 << k)
+        ranks = np.zeros(NUM_REGISTERS, dtype=np.uint8)
+        np.maximum.at(ranks, registers, (REMAINDER_BITS + 1 - bit_lengths).astype(np.uint8))
+        return cls.from_dense(ranks)
+
+    @classmethod
+    def from_dense(cls, ranks: np.ndarray) -> "HllSketch":
+        (registers,) = np.nonzero(ranks)
+        return cls(registers.astype(np.uint16), ranks[registers].astype(np.uint8))
+
+    def encode(self) -> str:
+        """
+        Encodes the non-empty registers as little-endian indices followed by
+        their ranks, or every register's rank once that is shorter. Sparse
+        encodings take 3 bytes per register, so their length never equals
+        the number of registers.
+        """
+        if 3 * len(self.registers) >= NUM_REGISTERS:
+            data = HllSketch.merge([self]).tobytes()
+        else:
+            data = self.registers.astype("<u2").tobytes() + self.ranks.astype(np.uint8).tobytes()
+        return base64.b64encode(data).decode()
+
+    @classmethod
+    def decode(cls, encoded: str) -> "HllSketch":
+        data = base64.b64decode(encoded)
+        if len(data) == NUM_REGISTERS:
+            return cls.from_dense(np.frombuffer(data, dtype=np.uint8))
+        # indices take the first two thirds
+        split = 2 * len(data) // 3
+        return cls(
+            np.frombuffer(data[:split], dtype="<u2"),
+            np.frombuffer(data[split:], dtype=np.uint8),
+        )
+
+    @staticmethod
+    def merge(sketches: Iterable["HllSketch"]) -> np.ndarray:
+        """Returns the dense registers of the union of sketches."""
+        ranks = np.zeros(NUM_REGISTERS, dtype=np.uint8)
+        for sketch in sketches:
+            np.maximum.at(ranks, sketch.registers.astype(np.int64), sketch.ranks)
+        return ranks
+
+
+def estimate(ranks: np.ndarray) -> float:
+    """Estimates distinct clients from dense registers, counting empty registers for small sets."""
+    alpha = 0.7213 / (1 + 1.079 / NUM_REGISTERS)
+    raw = alpha * NUM_REGISTERS**2 / np.sum(2.0 ** -ranks.astype(np.float64))
+    empty = int(np.count_nonzero(ranks == 0))
+    if raw <= 2.5 * NUM_REGISTERS and empty:
+        return NUM_REGISTERS * math.log(NUM_REGISTERS / empty)
+    return float(raw)
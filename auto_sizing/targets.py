@@ -1,6 +1,10 @@
+import functools
+import hashlib
+import json
+import logging
 import re
-from datetime import datetime
-from typing import Dict, List, Literal, Optional, TextIO
+from datetime import date, datetime
+from typing import Any, Dict, Iterable, List, Literal, Optional, TextIO
 
 import attr
 import toml
@@ -10,11 +14,34 @@ from mozanalysis.segments import Segment, SegmentDataSource
 from mozanalysis.utils import add_days
 
 from .errors import MetricsTagNotFoundException, SegmentsTagNotFoundException
-from .utils import default_dates_dict, dict_combinations
+from .utils import default_dates_dict, dict_combinations, normalize_sql
+
+logger = logging.getLogger(__name__)
 
 ALLOWED_APPS = Literal["firefox_desktop", "firefox_ios", "fenix"]
 
 
+# metric-hub definitions are shared by every configuration loaded in the same process
+@functools.lru_cache(maxsize=None)
+def get_metric(metric: str, app_id: str) -> Metric:
+    return ConfigLoader.get_metric(metric, app_id)
+
+
+@functools.lru_cache(maxsize=None)
+def get_data_source(data_source: str, app_id: str) -> DataSource:
+    return ConfigLoader.get_data_source(data_source, app_id)
+
+
+@functools.lru_cache(maxsize=None)
+def get_segment(segment: str, app_id: str) -> Segment:
+    return ConfigLoader.get_segment(segment, app_id)
+
+
+@functools.lru_cache(maxsize=None)
+def get_segment_data_source(data_source: str, app_id: str) -> SegmentDataSource:
+    return ConfigLoader.get_segment_data_source(data_source, app_id)
+
+
 class SegmentsList:
     """Builds list of Segments from list of dictionaries"""
 
@@ -40,7 +67,7 @@ class SegmentsList:
         if "import_from_metric_hub" in segments_dict.keys():
             for app_id, segments in segments_dict["import_from_metric_hub"].items():
                 for segment in segments:
-                    segments_dict[segment] = ConfigLoader.get_segment(segment, app_id)
+                    segments_dict[segment] = get_segment(segment, app_id)
             segments_dict.pop("import_from_metric_hub")
 
         if (
@@ -51,8 +78,8 @@ class SegmentsList:
                 "import_from_metric_hub"
             ].items():
                 for segment_data_source in segment_data_sources:
-                    segments_dict["data_sources"][segment_data_source] = (
-                        ConfigLoader.get_segment_data_source(segment_data_source, app_id)
+                    segments_dict["data_sources"][segment_data_source] = get_segment_data_source(
+                        segment_data_source, app_id
                     )
             segments_dict["data_sources"].pop("import_from_metric_hub")
 
@@ -101,7 +128,7 @@ class SegmentsList:
         return clients_daily_sql
 
     def _make_desktop_targets(self, target: Dict[str, str], start_date: str = "") -> List[Segment]:
-        clients_daily = ConfigLoader.get_segment_data_source("clients_daily", "firefox_desktop")
+        clients_daily = get_segment_data_source("clients_daily", "firefox_desktop")
 
         clients_daily_sql = self._make_clients_daily_filter(target)
         Segment_list = []
@@ -242,7 +269,7 @@ class MetricsLists:
         if "import_from_metric_hub" in metrics_dict.keys():
             for app_id, metrics in metrics_dict["import_from_metric_hub"].items():
                 for metric in metrics:
-                    metrics_dict[metric] = ConfigLoader.get_metric(metric, app_id)
+                    metrics_dict[metric] = get_metric(metric, app_id)
             metrics_dict.pop("import_from_metric_hub")
 
         if (
@@ -253,9 +280,7 @@ class MetricsLists:
                 "import_from_metric_hub"
             ].items():
                 for data_source in data_sources:
-                    target_dict["data_sources"][data_source] = ConfigLoader.get_data_source(
-                        data_source, app_id
-                    )
+                    target_dict["data_sources"][data_source] = get_data_source(data_source, app_id)
 
         Metric_list = []
         for key, value in metrics_dict.items():
@@ -283,11 +308,46 @@ class MetricsLists:
         Metric_list = []
 
         for metric in metric_names:
-            Metric_list.append(ConfigLoader.get_metric(metric, app_id))
+            Metric_list.append(get_metric(metric, app_id))
 
         return Metric_list
 
 
+# segments, metrics and data sources are shared by many targets of a worklist and are
+# immutable, so their fingerprints are only computed once per process
+@functools.lru_cache(maxsize=None)
+def _data_source_fingerprint(data_source: Any) -> Dict[str, Any]:
+    # the data source name is only a label; everything else affects the generated SQL
+    return {
+        key: normalize_sql(value) if isinstance(value, str) else value
+        for key, value in attr.asdict(data_source).items()
+        if key != "name"
+    }
+
+
+@functools.lru_cache(maxsize=None)
+def _segment_fingerprint(segment: Segment) -> str:
+    return json.dumps(
+        {
+            "data_source": _data_source_fingerprint(segment.data_source),
+            "select_expr": normalize_sql(segment.select_expr),
+        },
+        sort_keys=True,
+    )
+
+
+@functools.lru_cache(maxsize=None)
+def _metric_fingerprint(metric: Metric) -> str:
+    return json.dumps(
+        {
+            "name": metric.name,
+            "data_source": _data_source_fingerprint(metric.data_source),
+            "select_expr": normalize_sql(metric.select_expr),
+        },
+        sort_keys=True,
+    )
+
+
 @attr.s(auto_attribs=True)
 class SizingConfiguration:
     target_list: List[Segment]
@@ -298,6 +358,64 @@ class SizingConfiguration:
     analysis_length: int
     parameters: List[Dict]
     config_file: Optional[TextIO] = None
+    duplicate_slugs: List[str] = attr.Factory(list)
+    # additional analysis window lengths to size, computed in the same pass
+    analysis_lengths: List[int] = attr.Factory(list)
+
+    @property
+    def window_lengths(self) -> List[int]:
+        return sorted({self.analysis_length, *self.analysis_lengths})
+
+    def fingerprint(self, include_parameters: bool = True) -> str:
+        """
+        Returns a hash of everything that determines this target's results.
+
+        Segment names are left out since they only alias columns in the targets
+        query, so targets whose normalized segment and metric SQL match share a fingerprint.
+        Without parameters, the fingerprint identifies the target's metrics table.
+        """
+        segments = sorted(_segment_fingerprint(segment) for segment in self.target_list)
+        metrics = sorted(_metric_fingerprint(metric) for metric in self.metric_list)
+        payload = {
+            "segments": segments,
+            "metrics": metrics,
+            "start_date": self.start_date,
+            "num_dates_enrollment": self.num_dates_enrollment,
+            "analysis_length": self.analysis_length,
+        }
+        if include_parameters:
+            payload["parameters"] = sorted(json.dumps(p, sort_keys=True) for p in self.parameters)
+        if self.analysis_lengths:
+            payload["analysis_lengths"] = self.window_lengths
+
+        return hashlib.sha256(json.dumps(payload, sort_keys=True).encode()).hexdigest()
+
+
+def deduplicate_worklist(worklist: Iterable[SizingConfiguration]) -> List[SizingConfiguration]:
+    """
+    Collapses targets with identical fingerprints into a single configuration.
+
+    The first configuration seen for a fingerprint is kept and the slugs of
+    the others are recorded in its `duplicate_slugs`, so results can be
+    published for every slug after running the target once.
+    """
+    unique: Dict[str, SizingConfiguration] = {}
+    num_targets = 0
+    for config in worklist:
+        num_targets += 1
+        fingerprint = config.fingerprint()
+        if fingerprint in unique:
+            canonical = unique[fingerprint]
+            canonical.duplicate_slugs.append(config.target_slug)
+            canonical.duplicate_slugs.extend(config.duplicate_slugs)
+            logger.info(f"{config.target_slug} is equivalent to {canonical.target_slug}")
+        else:
+            unique[fingerprint] = config
+
+    if len(unique) < num_targets:
+        logger.info(f"Deduplicated {num_targets} targets into {len(unique)} distinct runs")
+
+    return list(unique.values())
 
 
 @attr.s(auto_attribs=True)
@@ -315,8 +433,16 @@ class SizingCollection:
         target: Dict,
         jobs_dict: Dict,
         app_id: ALLOWED_APPS = "firefox_desktop",
+        current_date: Optional[date] = None,
     ) -> "SizingCollection":
-        dates_dict = default_dates_dict(datetime.today())
+        analysis_lengths = jobs_dict.get("dates", {}).get("analysis_lengths", [])
+        dates_dict = default_dates_dict(current_date or datetime.today())
+        if analysis_lengths:
+            # the longest window determines when the data for every window is complete
+            dates_dict = default_dates_dict(
+                current_date or datetime.today(), analysis_length=max(analysis_lengths)
+            )
+            dates_dict["analysis_lengths"] = analysis_lengths
         segments_list = cls.segments_list.from_repo(
             target,
             app_id,
@@ -338,6 +464,8 @@ class SizingCollection:
         if "parameters" in target_dict.keys():
             parameters_list = dict_combinations(target_dict["parameters"], "sizing")
             dates_dict = target_dict["parameters"]["dates"]
+            if "analysis_lengths" in dates_dict and "analysis_length" not in dates_dict:
+                dates_dict["analysis_length"] = max(dates_dict["analysis_lengths"])
         else:
             parameters_dict = {
                 "parameters": {"power": [0.8], "effect_size": [0.005, 0.01, 0.02, 0.05]}
@@ -0,0 +1,144 @@
+import json
+from concurrent.futures import ThreadPoolExecutor
+from unittest.mock import MagicMock
+
+import pytest
+
+from auto_sizing.aggregate import (
+    LocalAggregateStore,
+    merge_target_results,
+    partition_name,
+    read_merged_results,
+    results_digest,
+)
+from auto_sizing.export_json import AggregateResultsWriter, aggregate_results
+
+SAMPLE_SIZES = {
+    "Power0.8EffectSize0.01": {
+        "parameters": {"power": 0.8, "effect_size": 0.01},
+        "metrics": {
+            "active_hours": {
+                "number_of_clients_targeted": 1000,
+                "sample_size_per_branch": 100.5,
+                "population_percent_per_branch": 10.05,
+            },
+        },
+    }
+}
+
+
+def _manifest(num_targets):
+    return {
+        f"argo_target_{i}": {
+            "app_id": "firefox_desktop",
+            "target_recipe": json.dumps(
+                {
+                    "locale": f"('L{i // 2}')",
+                    "release_channel": "release",
+                    "country": "US",
+                    "user_type": ["new", "existing"][i % 2],
+                }
+            ),
+        }
+        for i in range(num_targets)
+    }
+
+
+def test_concurrent_merges(tmp_path):
+    store = LocalAggregateStore(tmp_path / "aggregate")
+    jobs_dict = _manifest(40)
+
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        list(
+            executor.map(
+                lambda slug: merge_target_results(store, slug, json.dumps(SAMPLE_SIZES), jobs_dict),
+                jobs_dict,
+            )
+        )
+
+    merged = read_merged_results(store)
+    assert set(merged.slugs) == set(jobs_dict)
+    # both user types of a target key end up in its partition
+    assert len(merged.targets) == 20
+    assert all(set(value) == {"new", "existing"} for value in merged.targets.values())
+    assert len(store.names()) == len({partition_name(key) for key in merged.targets})
+
+
+def test_merge_rejects_invalid_results(tmp_path):
+    store = LocalAggregateStore(tmp_path / "aggregate")
+
+    with pytest.raises(Exception):
+        merge_target_results(store, "argo_target_0", json.dumps({"Power0.8": {}}), _manifest(1))
+
+    assert store.names() == []
+
+
+def test_finalize_only_downloads_unmerged_results(tmp_path, monkeypatch):
+    jobs_dict = _manifest(2)
+    monkeypatch.setattr("toml.load", MagicMock(return_value=jobs_dict))
+    store = LocalAggregateStore(tmp_path / "aggregate")
+    merge_target_results(store, "argo_target_0", json.dumps(SAMPLE_SIZES), jobs_dict)
+
+    blobs = []
+    for slug in jobs_dict:
+        blob = MagicMock()
+        blob.name = f"sample_sizes/ind_target_results_2024-01-01/sample_sizes_{slug}.json"
+        blob.download_as_string.return_value = json.dumps(SAMPLE_SIZES)
+        blob.md5_hash = results_digest(json.dumps(SAMPLE_SIZES))
+        blobs.append(blob)
+    storage_client = MagicMock()
+    storage_client.list_blobs.return_value = blobs
+    monkeypatch.setattr(
+        "auto_sizing.export_json.storage.Client", MagicMock(return_value=storage_client)
+    )
+
+    writer = AggregateResultsWriter()
+    aggregate_results("project", "bucket", "2024-01-01", writer, read_merged_results(store))
+
+    blobs[0].download_as_string.assert_not_called()
+    blobs[1].download_as_string.assert_called_once()
+    writer.results_file.seek(0)
+    results = json.loads(writer.results_file.read())
+    assert set(results["firefox_desktop:release:['L0']:US"]) == {"new", "existing"}
+
+
+def test_finalize_downloads_results_of_reruns(tmp_path, monkeypatch):
+    jobs_dict = _manifest(1)
+    monkeypatch.setattr("toml.load", MagicMock(return_value=jobs_dict))
+    store = LocalAggregateStore(tmp_path / "aggregate")
+    merge_target_results(store, "argo_target_0", json.dumps(SAMPLE_SIZES), jobs_dict)
+
+    # a rerun for the same date uploaded new results but failed to merge them
+    rerun_sample_sizes = json.loads(json.dumps(SAMPLE_SIZES))
+    rerun_metrics = rerun_sample_sizes["Power0.8EffectSize0.01"]["metrics"]
+    rerun_metrics["active_hours"]["sample_size_per_branch"] = 120.0
+    blob = MagicMock()
+    blob.name = "sample_sizes/ind_target_results_2024-01-01/sample_sizes_argo_target_0.json"
+    blob.download_as_string.return_value = json.dumps(rerun_sample_sizes)
+    blob.md5_hash = results_digest(json.dumps(rerun_sample_sizes))
+    storage_client = MagicMock()
+    storage_client.list_blobs.return_value = [blob]
+    monkeypatch.setattr(
+        "auto_sizing.export_json.storage.Client", MagicMock(return_value=storage_client)
+    )
+
+    writer = AggregateResultsWriter()
+    aggregate_results("project", "bucket", "2024-01-01", writer, read_merged_results(store))
+
+    blob.download_as_string.assert_called_once()
+    writer.results_file.seek(0)
+    results = json.loads(writer.results_file.read())
+    assert results["firefox_desktop:release:['L0']:US"]["new"]["sample_sizes"] == (
+        rerun_sample_sizes
+    )
+
+    # stale merged results aren't published when the rerun's results are invalid
+    blob.download_as_string.return_value = json.dumps({"Power0.8": {}})
+    writer = AggregateResultsWriter()
+    quarantined = aggregate_results(
+        "project", "bucket", "2024-01-01", writer, read_merged_results(store)
+    )
+
+    assert [target.target_slug for target in quarantined] == ["argo_target_0"]
+    writer.results_file.seek(0)
+    assert json.loads(writer.results_file.read()) == {}
@@ -0,0 +1,122 @@
+from datetime import date
+from types import SimpleNamespace
+from unittest.mock import MagicMock
+
+import pytest
+from mozanalysis.metrics import DataSource, Metric
+from mozanalysis.segments import Segment, SegmentDataSource
+
+from auto_sizing.availability import AvailabilityPolicy, PartitionChecker, source_tables
+from auto_sizing.errors import DataNotAvailableException
+from auto_sizing.targets import SizingConfiguration
+
+
+@pytest.fixture
+def sizing_config():
+    segment_data_source = SegmentDataSource(
+        name="clients_last_seen", from_expr="mozdata.telemetry.clients_last_seen"
+    )
+    metrics = [
+        Metric(
+            name="active_hours",
+            data_source=DataSource(
+                name="clients_daily", from_expr="`mozdata.telemetry.clients_daily`"
+            ),
+            select_expr="COALESCE(SUM(active_hours_sum), 0)",
+        ),
+        Metric(
+            name="search_count",
+            data_source=DataSource(name="search", from_expr="(SELECT * FROM search_clients)"),
+            select_expr="SUM(sap)",
+        ),
+    ]
+    return SizingConfiguration(
+        [Segment(name="filter", data_source=segment_data_source, select_expr="TRUE")],
+        target_slug="argo_target_0",
+        metric_list=metrics,
+        start_date="2022-10-18",
+        num_dates_enrollment=7,
+        analysis_length=28,
+        parameters=[{"power": 0.8, "effect_size": 0.01}],
+    )
+
+
+@pytest.fixture
+def client(monkeypatch):
+    client = MagicMock()
+    tables = {
+        "mozdata.telemetry.clients_daily": SimpleNamespace(
+            table_type="VIEW",
+            view_query="SELECT * FROM `moz-fx-data-shared-prod.telemetry_derived.clients_daily_v6`",
+        ),
+        "moz-fx-data-shared-prod.telemetry_derived.clients_daily_v6": SimpleNamespace(
+            table_type="TABLE", time_partitioning=True
+        ),
+        "mozdata.telemetry.clients_last_seen": SimpleNamespace(
+            table_type="VIEW", view_query="SELECT * FROM a.b.c JOIN d.e.f USING (client_id)"
+        ),
+    }
+    client.get_table.side_effect = tables.get
+    monkeypatch.setattr(PartitionChecker, "client", property(lambda self: client))
+    return client
+
+
+def _partitions(*days):
+    return [
+        SimpleNamespace(partition_id=f"202210{day:02}", total_logical_bytes=100) for day in days
+    ]
+
+
+def test_source_tables(sizing_config):
+    assert source_tables(sizing_config) == [
+        "mozdata.telemetry.clients_last_seen",
+        "mozdata.telemetry.clients_daily",
+    ]
+
+
+def test_missing_partitions(sizing_config, client):
+    client.query.return_value.result.return_value = _partitions(1, 2, 4)
+    checker = PartitionChecker("project")
+
+    # views of several tables can't be checked and are left out
+    assert checker.missing_dates(
+        source_tables(sizing_config), date(2022, 10, 1), date(2022, 10, 5)
+    ) == {"mozdata.telemetry.clients_daily": [date(2022, 10, 3), date(2022, 10, 5)]}
+
+    with pytest.raises(DataNotAvailableException) as e:
+        checker.require(sizing_config, date(2022, 10, 1), date(2022, 10, 5))
+    assert e.value.missing_dates == {
+        "mozdata.telemetry.clients_daily": ["2022-10-03", "2022-10-05"]
+    }
+
+    # partitions are cached across targets until they are waited on
+    assert client.query.call_count == 1
+
+
+def test_wait_for_partitions(sizing_config, client, monkeypatch):
+    client.query.return_value.result.side_effect = [_partitions(1, 2), _partitions(1, 2, 3)]
+    sleep = MagicMock()
+    monkeypatch.setattr("auto_sizing.availability.time.sleep", sleep)
+    checker = PartitionChecker("project", AvailabilityPolicy.WAIT, poll_interval=60)
+
+    checker.require(sizing_config, date(2022, 10, 1), date(2022, 10, 3))
+
+    sleep.assert_called_once_with(60)
+
+
+def test_pruning_report(client):
+    client.query.return_value.result.return_value = _partitions(*range(1, 31))
+    client.query.return_value.total_bytes_processed = 500
+    checker = PartitionChecker("project")
+    tables = ["mozdata.telemetry.clients_daily"]
+
+    report = checker.pruning_report(
+        "metrics", "SELECT 1", tables, date(2022, 10, 1), date(2022, 10, 7)
+    )
+    assert report["pruned"]
+    assert report["partition_bytes"] == 700
+
+    report = checker.pruning_report(
+        "metrics", "SELECT 1", tables, date(2022, 10, 1), date(2022, 10, 3)
+    )
+    assert report["pruned"] is False
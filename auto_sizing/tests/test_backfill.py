@@ -0,0 +1,101 @@
+from datetime import date
+from unittest.mock import MagicMock
+
+import pandas as pd
+import pytest
+from mozanalysis.metrics import DataSource, Metric
+
+from auto_sizing.backfill import BackfillCalculation, backfill_configurations
+from auto_sizing.rollup import daily_rollup
+
+CLIENTS_DAILY = DataSource(name="clients_daily", from_expr="mozdata.telemetry.clients_daily")
+
+
+@pytest.mark.parametrize(
+    "select_expr,rollup",
+    [
+        ("COALESCE(SUM(active_hours_sum), 0)", "COALESCE(SUM(daily.m), 0)"),
+        ("SUM(search_count)", "SUM(daily.m)"),
+        ("COUNT(DISTINCT submission_date)", "COALESCE(SUM(daily.m), 0)"),
+        ("COUNT(DISTINCT client_id)", None),
+        ("SUM(a) / SUM(b)", None),
+        ("MAX(active_hours_sum)", None),
+    ],
+)
+def test_daily_rollup(select_expr, rollup):
+    metric = Metric(name="m", data_source=CLIENTS_DAILY, select_expr=select_expr)
+
+    assert daily_rollup(metric) == rollup
+
+
+def _run_configs(monkeypatch, select_expr, run_dates):
+    jobs_dict = {
+        "targets": {},
+        "parameters": {"power": [0.8], "effect_size": [0.05]},
+        "metrics": {"firefox_desktop": ["active_hours"]},
+    }
+    metric = Metric(name="active_hours", data_source=CLIENTS_DAILY, select_expr=select_expr)
+    monkeypatch.setattr(
+        "auto_sizing.targets.MetricsLists.from_repo", lambda self, jobs_dict, app_id: [metric]
+    )
+    monkeypatch.setattr(
+        "auto_sizing.targets.SegmentsList.from_repo", lambda self, target, app_id, start: []
+    )
+    return backfill_configurations("argo_target_0", {}, jobs_dict, "firefox_desktop", run_dates)
+
+
+def test_backfill_publishes_each_run_date(monkeypatch):
+    run_dates = [date(2024, 1, 1), date(2024, 1, 2)]
+    run_configs = _run_configs(monkeypatch, "COALESCE(SUM(active_hours_sum), 0)", run_dates)
+    assert run_configs[run_dates[1]].start_date == "2023-11-27"
+
+    sizing = BackfillCalculation(
+        "project", "dataset", "bucket", run_configs[run_dates[0]], run_configs=run_configs
+    )
+
+    df = pd.DataFrame(
+        {
+            "run_date": [run_dates[0]] * 50 + [run_dates[1]] * 30,
+            "active_hours_28d": [float(i % 7) for i in range(80)],
+        }
+    )
+    monkeypatch.setattr(sizing, "calculate_backfill_metrics", lambda current_date: df)
+    publish = MagicMock()
+    monkeypatch.setattr(sizing, "publish_results", publish)
+
+    sizing.run(date(2024, 3, 1))
+
+    published = {call.args[1]: call.args[0] for call in publish.call_args_list}
+    assert list(published) == ["2024-01-01", "2024-01-02"]
+    metrics = published["2024-01-02"]["Power0.8EffectSize0.05"]["metrics"]
+    assert metrics["active_hours"]["number_of_clients_targeted"] == 30
+
+
+def test_non_additive_backfill_publishes_each_run_date(monkeypatch):
+    run_dates = [date(2024, 1, 1), date(2024, 1, 2)]
+    run_configs = _run_configs(monkeypatch, "MAX(active_hours_sum)", run_dates)
+    sizing = BackfillCalculation(
+        "project", "dataset", "bucket", run_configs[run_dates[0]], run_configs=run_configs
+    )
+
+    sizes = {"2023-11-26": 50, "2023-11-27": 30}
+    monkeypatch.setattr(
+        BackfillCalculation,
+        "calculate_target_metrics",
+        lambda self, current_date: pd.DataFrame(
+            {"active_hours": [float(i % 7) for i in range(sizes[self.config.start_date])]}
+        ),
+    )
+    published = {}
+    monkeypatch.setattr(
+        BackfillCalculation,
+        "publish_results",
+        lambda self, result_dict, current_date: published.update({current_date: result_dict}),
+    )
+
+    sizing.run(date(2024, 3, 1))
+
+    # each run date's sizes are published under that date, not the date of the backfill
+    assert list(published) == ["2024-01-01", "2024-01-02"]
+    metrics = published["2024-01-02"]["Power0.8EffectSize0.05"]["metrics"]
+    assert metrics["active_hours"]["number_of_clients_targeted"] == 30
@@ -0,0 +1,91 @@
+from datetime import date
+
+import attr
+import pandas as pd
+from mozanalysis.metrics import DataSource, Metric
+from mozanalysis.segments import Segment, SegmentDataSource
+
+from auto_sizing.batch import BatchRunner, expand_config_paths
+from auto_sizing.size_calculation import SizeCalculation
+from auto_sizing.targets import SizingConfiguration
+
+
+def _config(target_slug, effect_size, metric_expr="COALESCE(SUM(active_hours_sum), 0)"):
+    data_source = SegmentDataSource(
+        name="clients_daily", from_expr="mozdata.telemetry.clients_daily"
+    )
+    metric = Metric(
+        name="active_hours",
+        data_source=DataSource(name="clients_daily", from_expr="mozdata.telemetry.clients_daily"),
+        select_expr=metric_expr,
+    )
+    return SizingConfiguration(
+        [Segment(name="filter", data_source=data_source, select_expr="LOGICAL_OR(TRUE)")],
+        target_slug=target_slug,
+        metric_list=[metric],
+        start_date="2022-10-18",
+        num_dates_enrollment=7,
+        analysis_length=28,
+        parameters=[{"power": 0.8, "effect_size": effect_size}],
+    )
+
+
+def test_expand_config_paths(tmp_path):
+    for name in ["b.toml", "a.toml", "notes.txt"]:
+        (tmp_path / name).write_text("")
+
+    assert expand_config_paths(str(tmp_path)) == [tmp_path / "a.toml", tmp_path / "b.toml"]
+    assert expand_config_paths(str(tmp_path / "*.t*")) == [
+        tmp_path / "a.toml",
+        tmp_path / "b.toml",
+        tmp_path / "notes.txt",
+    ]
+    assert expand_config_paths(str(tmp_path / "a.toml")) == [tmp_path / "a.toml"]
+
+
+def test_batch_shares_metrics_tables(monkeypatch):
+    configs = [
+        _config("small_effect", 0.01),
+        _config("large_effect", 0.1),
+        _config("search", 0.01, metric_expr="SUM(search_count)"),
+    ]
+    runner = BatchRunner("project", "dataset", None, max_workers=2)  # type: ignore[arg-type]
+    assert [[c.target_slug for c in group] for group in runner.group_by_metrics(configs)] == [
+        ["small_effect", "large_effect"],
+        ["search"],
+    ]
+
+    queried = []
+
+    def calculate_target_metrics(self, current_date):
+        queried.append(self.config.target_slug)
+        return pd.DataFrame({"active_hours": [float(i % 7) for i in range(100)]})
+
+    monkeypatch.setattr(SizeCalculation, "calculate_target_metrics", calculate_target_metrics)
+    monkeypatch.setattr(SizeCalculation, "publish_results", lambda self, results, date: None)
+
+    results = runner.run(configs, date(2022, 12, 1))
+
+    assert sorted(queried) == ["search", "small_effect"]
+    assert [result.target_slug for result in results] == [c.target_slug for c in configs]
+    assert [result.metrics_from for result in results] == ["small_effect"] * 2 + ["search"]
+    assert all(result.status == "done" for result in results)
+    small, large = (
+        result.sample_sizes["Power0.8EffectSize" + str(effect)]["metrics"]["active_hours"]
+        for result, effect in zip(results, [0.01, 0.1])
+    )
+    assert small["sample_size_per_branch"] > large["sample_size_per_branch"]
+
+
+def test_batch_reports_failed_groups(monkeypatch):
+    def calculate_target_metrics(self, current_date):
+        raise RuntimeError("query failed")
+
+    monkeypatch.setattr(SizeCalculation, "calculate_target_metrics", calculate_target_metrics)
+    config = _config("small_effect", 0.01)
+    runner = BatchRunner("project", "dataset", None)  # type: ignore[arg-type]
+
+    results = runner.run([config, attr.evolve(config, target_slug="copy")], date(2022, 12, 1))
+
+    assert [result.status for result in results] == ["failed", "failed"]
+    assert results[0].error == "query failed"
@@ -0,0 +1,53 @@
+import numpy as np
+import pandas as pd
+from mozanalysis.frequentist_stats.sample_size import z_or_t_ind_sample_size_calc
+from mozanalysis.metrics import DataSource, Metric
+
+from auto_sizing.bootstrap import bootstrap_variance_ratios, confidence_interval
+
+CLIENTS_DAILY = DataSource(name="clients_daily", from_expr="mozdata.telemetry.clients_daily")
+
+
+def test_bootstrap_intervals():
+    rng = np.random.default_rng(0)
+    df = pd.DataFrame(
+        {
+            "active_hours": rng.lognormal(0, 1.5, 20_000),
+            "search_count": rng.poisson(3, 20_000).astype(float),
+        }
+    )
+    metrics = [Metric(name=name, data_source=CLIENTS_DAILY, select_expr="1") for name in df]
+
+    # weights for few clients at a time still cover every client
+    ratios = bootstrap_variance_ratios(
+        df, list(df.columns), num_samples=300, max_memory=10 * 300 * 1000, seed=1
+    )
+
+    for name, metric_ratios in ratios.items():
+        assert metric_ratios.shape == (300,)
+        assert abs(np.median(metric_ratios) - 1) < 0.05
+
+        sample_size = z_or_t_ind_sample_size_calc(df, metrics, effect_size=0.05)[name][
+            "sample_size_per_branch"
+        ]
+        lower, upper = confidence_interval(sample_size, metric_ratios)
+        assert lower < sample_size < upper
+
+    # the heavy-tailed metric is less stable than the count
+    spread = {name: np.ptp(np.quantile(r, [0.025, 0.975])) for name, r in ratios.items()}
+    assert spread["active_hours"] > spread["search_count"]
+
+
+def test_null_values_are_left_out():
+    rng = np.random.default_rng(0)
+    df = pd.DataFrame({"m": rng.gamma(2.0, 1.0, 2000), "empty": np.nan})
+    df.loc[0, "m"] = np.nan
+
+    ratios = bootstrap_variance_ratios(df, ["m", "empty"], num_samples=200, seed=1)
+
+    assert not np.isnan(ratios["m"]).any()
+    assert abs(np.median(ratios["m"]) - 1) < 0.1
+    lower, upper = confidence_interval(100.0, ratios["m"])
+    assert lower < 100.0 < upper
+    # metrics without values get no interval instead of NaN
+    assert confidence_interval(100.0, ratios["empty"]) is None
@@ -0,0 +1,174 @@
+import json
+import threading
+import time
+from unittest.mock import MagicMock
+
+from click.testing import CliRunner
+from mozanalysis.metrics import DataSource, Metric
+from mozanalysis.segments import Segment, SegmentDataSource
+
+from auto_sizing.cli import ArgoExecutorStrategy, cli, is_config_batch, open_config_file
+from auto_sizing.ledger import LocalLedgerBackend, RunLedger, TargetState
+from auto_sizing.targets import SizingConfiguration
+
+
+def _sizing_config(target_slug):
+    data_source = SegmentDataSource(
+        name="clients_daily", from_expr="mozdata.telemetry.clients_daily"
+    )
+    metric = Metric(
+        name="active_hours",
+        data_source=DataSource(name="clients_daily", from_expr="mozdata.telemetry.clients_daily"),
+        select_expr="COALESCE(SUM(active_hours_sum), 0)",
+    )
+    return SizingConfiguration(
+        [Segment(name="filter", data_source=data_source, select_expr=f"'{target_slug}'")],
+        target_slug=target_slug,
+        metric_list=[metric],
+        start_date="2022-10-18",
+        num_dates_enrollment=7,
+        analysis_length=28,
+        parameters=[{"power": 0.8, "effect_size": 0.01}],
+    )
+
+
+def test_argo_shards_targets(tmp_path, monkeypatch):
+    submit_workflow = MagicMock(return_value=True)
+    monkeypatch.setattr("auto_sizing.cli.submit_workflow", submit_workflow)
+    ledger = RunLedger(LocalLedgerBackend(tmp_path / "ledger"))
+    worklist = [_sizing_config(f"argo_target_{i}") for i in range(5)]
+    ledger.mark(worklist[0], TargetState.DONE)
+    ledger.mark(worklist[1], TargetState.FAILED)
+
+    strategy = ArgoExecutorStrategy(
+        "project",
+        "dataset",
+        "bucket",
+        "zone",
+        "cluster",
+        False,
+        ledger=ledger,
+        shard_size=2,
+        bootstrap_samples=200,
+    )
+    assert strategy.execute(worklist)
+
+    *shard_calls, export_call = submit_workflow.call_args_list
+    shards = sorted(
+        (call.kwargs["parameters"]["targets"] for call in shard_calls),
+        key=lambda shard: shard[0]["slug"],
+    )
+    assert shards == [
+        [{"slug": "argo_target_1", "duplicates": ""}, {"slug": "argo_target_2", "duplicates": ""}],
+        [{"slug": "argo_target_3", "duplicates": ""}, {"slug": "argo_target_4", "duplicates": ""}],
+    ]
+    # shards are awaited and the results of all of them are exported once
+    for call in shard_calls:
+        assert call.kwargs["monitor_status"]
+        assert call.kwargs["parameters"]["export"] == "false"
+    assert export_call.kwargs["workflow_file"] == ArgoExecutorStrategy.EXPORT_WORKFLOW
+
+    parameters = shard_calls[0].kwargs["parameters"]
+    assert parameters["bootstrap_samples"] == 200
+    # target pods don't publish sizes from partitions that haven't landed
+    assert parameters["data_availability"] == "fail"
+    # only completed targets that are rerun need their ledger entry reset
+    assert set(ledger.entries()) == {"argo_target_0", "argo_target_1"}
+
+    strategy.rerun_completed = True
+    strategy.shard_size = 10
+    assert strategy.execute(worklist)
+    # a single workflow exports its own results
+    assert submit_workflow.call_args.kwargs["workflow_file"] == ArgoExecutorStrategy.RUN_WORKFLOW
+    assert len(submit_workflow.call_args.kwargs["parameters"]["targets"]) == 5
+    assert "export" not in submit_workflow.call_args.kwargs["parameters"]
+    assert ledger.get("argo_target_0").state == TargetState.PENDING
+
+
+def test_argo_caps_parallel_shards(monkeypatch):
+    running, peak = [], []
+    lock = threading.Lock()
+
+    def submit_workflow(**kwargs):
+        with lock:
+            running.append(kwargs["workflow_file"])
+            peak.append(len(running))
+        time.sleep(0.05)
+        with lock:
+            running.pop()
+        return True
+
+    monkeypatch.setattr("auto_sizing.cli.submit_workflow", submit_workflow)
+    strategy = ArgoExecutorStrategy(
+        "project", "dataset", "bucket", "zone", "cluster", False, shard_size=1
+    )
+    worklist = [_sizing_config(f"argo_target_{i}") for i in range(6)]
+
+    assert strategy.execute(worklist)
+    # shards run one at a time unless more are allowed
+    assert max(peak) == 1
+
+    peak.clear()
+    strategy.max_parallel_shards = 3
+    assert strategy.execute(worklist)
+    assert max(peak) == 3
+
+
+def test_config_files_are_closed(tmp_path):
+    path = tmp_path / "config.toml"
+    path.write_text("")
+
+    assert is_config_batch(str(tmp_path))
+    # stdin and single files are sized on their own
+    assert not is_config_batch("-")
+    assert not is_config_batch(str(path))
+
+    with open_config_file(str(path)) as configuration_file:
+        assert not configuration_file.closed
+    assert configuration_file.closed
+    with open_config_file(None) as configuration_file:
+        assert configuration_file is None
+
+
+def test_update_schemas_writes_to_given_path(tmp_path, monkeypatch):
+    (tmp_path / "configs").mkdir()
+    (tmp_path / "configs" / "config.toml").write_text("")
+    validate_worklist = MagicMock(
+        return_value={
+            "argo_target_0": {"errors": [], "tables": ["mozdata.telemetry.clients_daily"]}
+        }
+    )
+    monkeypatch.setattr(
+        "auto_sizing.cli.load_configurations", lambda paths: [_sizing_config("argo_target_0")]
+    )
+    monkeypatch.setattr("auto_sizing.cli.validate_worklist", validate_worklist)
+    monkeypatch.setattr(
+        "auto_sizing.cli.snapshot_schemas",
+        lambda project_id, tables: {table: ["client_id"] for table in tables},
+    )
+
+    snapshot = tmp_path / "schemas.json"
+    result = CliRunner().invoke(
+        cli,
+        [
+            "validate",
+            "--project-id",
+            "project",
+            "--dataset-id",
+            "dataset",
+            "--config-file",
+            str(tmp_path / "configs"),
+            "--schemas",
+            str(tmp_path / "missing.json"),
+            "--update-schemas",
+            str(snapshot),
+        ],
+    )
+
+    assert result.exit_code == 0
+    assert json.loads(snapshot.read_text()) == {"mozdata.telemetry.clients_daily": ["client_id"]}
+    # the second pass checks columns against the snapshot that was just written
+    assert validate_worklist.call_args_list[0].args[2] == {}
+    assert validate_worklist.call_args_list[1].args[2] == {
+        "mozdata.telemetry.clients_daily": {"client_id"}
+    }
@@ -0,0 +1,139 @@
+import json
+
+import numpy as np
+import pytest
+
+from auto_sizing.cube import MetricStatistics, StatisticsCube
+from auto_sizing.sketches import RELATIVE_ERROR, HllSketch
+
+
+def _row(locale, country, user_type, values):
+    return {
+        "channel": "RELEASE",
+        "locale": locale,
+        "country": country,
+        "user_type": user_type,
+        "clients": len(values),
+        "active_hours_count": len(values),
+        "active_hours_mean": float(np.mean(values)),
+        "active_hours_m2": float(np.var(values) * len(values)),
+    }
+
+
+@pytest.fixture
+def cube():
+    return StatisticsCube.from_rows(
+        "firefox_desktop",
+        ["active_hours"],
+        [
+            _row("EN-US", "US", "new", [1, 2, 3]),
+            _row("EN-US", "US", "existing", [4, 5]),
+            _row("EN-CA", "CA", "existing", [6, 7, 8, 9]),
+            _row("DE", "DE", "existing", [10, 20]),
+        ],
+    )
+
+
+def _statistics(values):
+    return MetricStatistics(
+        len(values), float(np.mean(values)), float(np.var(values) * len(values))
+    )
+
+
+def test_merged_statistics_match_pooled_values():
+    merged = _statistics([1, 2, 3]).merge(_statistics([4, 5]))
+
+    assert merged.count == 5
+    assert merged.mean == pytest.approx(3.0)
+    assert merged.std == pytest.approx(2.5**0.5)
+    assert MetricStatistics.from_sums(3, 6.0, 14.0) == _statistics([1, 2, 3])
+
+    # sums of squares of large values would cancel out the variance entirely
+    values = 1e9 + np.arange(10.0)
+    merged = MetricStatistics()
+    for chunk in np.split(values, 5):
+        merged = merged.merge(_statistics(chunk))
+    assert merged.std == pytest.approx(np.std(values, ddof=1))
+
+
+def test_metrics_without_spread_are_skipped():
+    row = _row("EN-US", "US", "new", [3, 3, 3])
+    rows = [{**row, "constant_count": 3, "constant_mean": 3.0, "constant_m2": 0.0}]
+    rows.append({**rows[0], "locale": "DE", "constant_count": 0, "constant_mean": 0.0})
+    cube = StatisticsCube.from_rows("firefox_desktop", ["constant"], rows)
+
+    assert np.isnan(MetricStatistics(1, 3.0, 0.0).std)
+    for locale in ["EN-US", "DE"]:
+        results = cube.sample_sizes({"locale": locale}, [{"power": 0.8, "effect_size": 0.05}])
+        assert results["Power0.8EffectSize0.05"]["metrics"] == {}
+
+
+def test_select_cells_for_recipe(cube):
+    recipe = {
+        "release_channel": "release",
+        "locale": "('EN-US', 'EN-CA')",
+        "country": "all",
+        "user_type": "existing",
+    }
+
+    assert [(cell.locale, cell.country) for cell in cube.select(recipe)] == [
+        ("EN-US", "US"),
+        ("EN-CA", "CA"),
+    ]
+    assert len(cube.select({"locale": "all", "country": "US", "user_type": "all"})) == 2
+
+
+def test_sample_sizes_from_cube(cube):
+    parameters = [{"power": 0.8, "effect_size": 0.05}]
+    results = cube.sample_sizes({"locale": "('EN-US', 'EN-CA')", "country": "all"}, parameters)
+
+    metric = results["Power0.8EffectSize0.05"]["metrics"]["active_hours"]
+    assert metric["number_of_clients_targeted"] == 9
+    assert metric["sample_size_per_branch"] > 0
+
+    assert cube.sample_sizes({"locale": "FR"}, parameters) == {}
+
+
+def test_cube_json_roundtrip(cube):
+    assert StatisticsCube.from_json(cube.to_json()) == cube
+
+    # cubes from before deviations were stored
+    old_cube = json.loads(cube.to_json())
+    old_cube["cells"][0]["metrics"]["active_hours"] = {"count": 3, "total": 6.0, "total_sq": 14.0}
+    assert StatisticsCube.from_json(json.dumps(old_cube)).cells[0] == cube.cells[0]
+
+
+def _sketch_row(locale, country, hashes):
+    sketch = HllSketch.from_hashes(hashes)
+    return {
+        "channel": "RELEASE",
+        "locale": locale,
+        "country": country,
+        "user_type": "existing",
+        "registers": [
+            {"register": register, "register_rank": rank}
+            for register, rank in zip(sketch.registers, sketch.ranks)
+        ],
+    }
+
+
+def test_estimate_clients_from_sketches(cube):
+    assert cube.estimate_clients({"locale": "all"}) is None
+
+    hashes = np.random.default_rng(0).integers(0, 2**63, 30000, dtype=np.uint64) * np.uint64(2)
+    # clients seen in both locales during enrollment are only counted once
+    sketched = StatisticsCube.from_rows(
+        "firefox_desktop",
+        ["active_hours"],
+        [],
+        [
+            _sketch_row("EN-US", "US", hashes[:20000]),
+            _sketch_row("EN-CA", "CA", hashes[15000:25000]),
+            _sketch_row("DE", "DE", hashes[25000:]),
+        ],
+    )
+
+    estimate = sketched.estimate_clients({"locale": "('EN-US', 'EN-CA')", "country": "all"})
+    assert estimate == pytest.approx(25000, rel=3 * RELATIVE_ERROR)
+    assert sketched.estimate_clients({"locale": "FR"}) == 0
+    assert StatisticsCube.from_json(sketched.to_json()) == sketched
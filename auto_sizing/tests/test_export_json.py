@@ -1,8 +1,24 @@
+import copy
+import io
+import json
+from datetime import date
 from unittest.mock import MagicMock
 
+import pyarrow.parquet as pq
 import pytest
+from click.testing import CliRunner
 
-from auto_sizing.export_json import build_target_key_from_recipe, parse_recipe_from_slug
+from auto_sizing.cli import cli
+from auto_sizing.export_json import (
+    AggregateResultsWriter,
+    aggregate_results,
+    build_target_key_from_recipe,
+    flatten_results,
+    parse_recipe_from_slug,
+    validate_target_results,
+)
+from auto_sizing.history import HistoryStore
+from auto_sizing.manifest import target_slug as target_slug_from_recipe
 
 
 @pytest.fixture
@@ -46,8 +62,11 @@ def test_parse_recipe_from_slug(monkeypatch, manifest_toml):
 
 
 def test_parse_recipe_from_slug_manifest():
-    # grab target 0 from actual manifest
-    target_slug = "argo_target_0"
+    # grab the first target from actual manifest
+    target_slug = target_slug_from_recipe(
+        "firefox_desktop",
+        {"locale": "('EN-US')", "release_channel": "release", "country": "US", "user_type": "new"},
+    )
 
     recipe_info = parse_recipe_from_slug(target_slug)
     assert recipe_info.get("app_id") == "firefox_desktop"
@@ -79,8 +98,11 @@ def test_build_target_key_from_recipe(monkeypatch, manifest_toml):
 
 
 def test_build_target_key_from_recipe_manifest():
-    # grab target 0 from actual manifest
-    target_slug = "argo_target_0"
+    # grab the first target from actual manifest
+    target_slug = target_slug_from_recipe(
+        "firefox_desktop",
+        {"locale": "('EN-US')", "release_channel": "release", "country": "US", "user_type": "new"},
+    )
     recipe_info = parse_recipe_from_slug(target_slug)
 
     target_key = build_target_key_from_recipe(recipe_info)
@@ -88,3 +110,250 @@ def test_build_target_key_from_recipe_manifest():
     expected_target_key = "firefox_desktop:release:['EN-US']:US"
 
     assert target_key == expected_target_key
+
+
+@pytest.fixture
+def aggregate_results_dict():
+    def target(app_id, locale, country, new_or_existing):
+        return {
+            "target_recipe": {
+                "app_id": app_id,
+                "channel": "release",
+                "locale": locale,
+                "country": country,
+                "new_or_existing": new_or_existing,
+            },
+            "sample_sizes": {
+                "Power0.8EffectSize0.01": {
+                    "parameters": {"power": 0.8, "effect_size": 0.01},
+                    "metrics": {
+                        "active_hours": {
+                            "number_of_clients_targeted": 1000,
+                            "sample_size_per_branch": 100.5,
+                            "population_percent_per_branch": 10.05,
+                        },
+                        "days_of_use": {
+                            "number_of_clients_targeted": 1000,
+                            "sample_size_per_branch": 50.0,
+                            "population_percent_per_branch": 5.0,
+                        },
+                    },
+                }
+            },
+        }
+
+    return {
+        "firefox_desktop:release:['EN-US']:US": {
+            "new": target("firefox_desktop", "('EN-US')", "US", "new"),
+            "all": target("firefox_desktop", "('EN-US')", "US", "all"),
+        },
+        "firefox_desktop:release:['EN-US']:all": {
+            "new": target("firefox_desktop", "('EN-US')", "all", "new"),
+        },
+        "fenix:release:['EN-US']:US": {
+            "existing": target("fenix", "('EN-US')", "US", "existing"),
+        },
+    }
+
+
+def _write_aggregate(results):
+    writer = AggregateResultsWriter(write_parquet=True)
+    for target_key, value in results.items():
+        writer.write(target_key, value)
+    writer.close()
+    return writer
+
+
+def _read_file(file_obj):
+    file_obj.seek(0)
+    return file_obj.read()
+
+
+def test_aggregate_shards(aggregate_results_dict):
+    writer = _write_aggregate(aggregate_results_dict)
+    shards = {shard: _read_file(file_obj) for shard, file_obj in writer.shard_files.items()}
+
+    assert json.loads(_read_file(writer.results_file)) == aggregate_results_dict
+    assert set(shards.keys()) == {"firefox_desktop.json", "fenix.json"}
+    assert set(writer.index.keys()) == set(aggregate_results_dict.keys())
+
+    for shard, data in shards.items():
+        assert json.loads(data) == {
+            key: value
+            for key, value in aggregate_results_dict.items()
+            if f"{key.split(':')[0]}.json" == shard
+        }
+
+    for target_key, location in writer.index.items():
+        start = location["offset"]
+        end = start + location["length"]
+        value = shards[location["shard"]][start:end]
+        assert json.loads(value) == aggregate_results_dict[target_key]
+
+
+def test_aggregate_parquet(aggregate_results_dict):
+    table = pq.read_table(
+        io.BytesIO(_read_file(_write_aggregate(aggregate_results_dict).parquet_file))
+    )
+
+    # 4 targets with one set of parameters and 2 metrics each
+    assert table.num_rows == 8
+    rows = table.to_pylist()
+    assert {row["metric"] for row in rows} == {"active_hours", "days_of_use"}
+    assert {row["new_or_existing"] for row in rows} == {"new", "existing", "all"}
+
+
+def test_validation_keeps_window_lengths(aggregate_results_dict):
+    target = aggregate_results_dict["firefox_desktop:release:['EN-US']:all"]["new"]
+    sample_sizes = copy.deepcopy(target["sample_sizes"])
+    window = copy.deepcopy(sample_sizes["Power0.8EffectSize0.01"])
+    window["parameters"]["analysis_length"] = 7
+    sample_sizes["Power0.8EffectSize0.01AnalysisLength7"] = window
+
+    validated = validate_target_results(target["target_recipe"], json.dumps(sample_sizes))
+
+    assert validated["sample_sizes"] == sample_sizes
+    rows = list(flatten_results({"key": {"new": validated}}))
+    assert {row["sizing_key"]: row["analysis_length"] for row in rows} == {
+        "Power0.8EffectSize0.01": None,
+        "Power0.8EffectSize0.01AnalysisLength7": 7,
+    }
+
+    window["parameters"]["analysis_length"] = "7"
+    with pytest.raises(ValueError, match="analysis_length"):
+        validate_target_results(target["target_recipe"], json.dumps(sample_sizes))
+
+
+def test_validation_keeps_intervals(aggregate_results_dict):
+    target = aggregate_results_dict["firefox_desktop:release:['EN-US']:all"]["new"]
+    sample_sizes = copy.deepcopy(target["sample_sizes"])
+    metrics = sample_sizes["Power0.8EffectSize0.01"]["metrics"]
+    metrics["active_hours"]["sample_size_per_branch_ci"] = [90.5, 120.0]
+
+    validated = validate_target_results(target["target_recipe"], json.dumps(sample_sizes))
+
+    assert validated["sample_sizes"] == sample_sizes
+    parquet_file = _write_aggregate({"fenix:release": {"new": validated}}).parquet_file
+    table = pq.read_table(io.BytesIO(_read_file(parquet_file)))
+    intervals = {
+        row["metric"]: [
+            row["sample_size_per_branch_ci_lower"],
+            row["sample_size_per_branch_ci_upper"],
+        ]
+        for row in table.to_pylist()
+    }
+    assert intervals == {"active_hours": [90.5, 120.0], "days_of_use": [None, None]}
+
+    metrics["active_hours"]["sample_size_per_branch_ci"] = [90.5]
+    with pytest.raises(ValueError, match="interval"):
+        validate_target_results(target["target_recipe"], json.dumps(sample_sizes))
+
+
+def test_aggregate_results_quarantines_invalid_targets(
+    monkeypatch, manifest_toml, aggregate_results_dict
+):
+    monkeypatch.setattr("toml.load", manifest_toml)
+    sample_sizes = aggregate_results_dict["firefox_desktop:release:['EN-US']:all"]["new"][
+        "sample_sizes"
+    ]
+
+    valid_blob = MagicMock()
+    valid_blob.name = "sample_sizes/ind_target_results_2024-01-01/sample_sizes_argo_target_0.json"
+    valid_blob.download_as_string.return_value = json.dumps(sample_sizes)
+    invalid_blob = MagicMock()
+    invalid_blob.name = "sample_sizes/ind_target_results_2024-01-01/sample_sizes_argo_target_1.json"
+    invalid_blob.download_as_string.return_value = json.dumps({"Power0.8": {"metrics": {}}})
+
+    profile_blob = MagicMock()
+    profile_blob.name = "sample_sizes/ind_target_results_2024-01-01/profiles/argo_target_0.json"
+    # the first target was sized by a rerun after being skipped
+    skipped_blobs = []
+    for target_slug in ["argo_target_0", "argo_target_1"]:
+        skipped_blob = MagicMock()
+        skipped_blob.name = f"sample_sizes/ind_target_results_2024-01-01/skipped/{target_slug}.json"
+        skipped_blob.download_as_string.return_value = json.dumps(
+            {"reason": "population_too_small", "num_clients": 42, "min_population": 100}
+        )
+        skipped_blobs.append(skipped_blob)
+
+    storage_client = MagicMock()
+    storage_client.list_blobs.return_value = [
+        valid_blob,
+        invalid_blob,
+        profile_blob,
+        *skipped_blobs,
+    ]
+    monkeypatch.setattr(
+        "auto_sizing.export_json.storage.Client", MagicMock(return_value=storage_client)
+    )
+
+    writer = AggregateResultsWriter(write_parquet=True)
+    quarantined = aggregate_results("project", "bucket", "2024-01-01", writer)
+
+    assert [target.target_slug for target in quarantined] == ["argo_target_1"]
+    profile_blob.download_as_string.assert_not_called()
+    writer.results_file.seek(0)
+    results = json.loads(writer.results_file.read())
+    assert list(results.keys()) == ["firefox_desktop:release:['EN-US']:all"]
+    assert results["firefox_desktop:release:['EN-US']:all"]["new"]["sample_sizes"] == sample_sizes
+    assert list(writer.index.keys()) == ["firefox_desktop:release:['EN-US']:all"]
+    assert writer.skipped == {
+        "firefox_desktop:release:['EN-CA','EN-GB','EN-US']:US": {
+            "new": {
+                "target_slug": "argo_target_1",
+                "reason": "population_too_small",
+                "num_clients": 42,
+                "min_population": 100,
+            }
+        }
+    }
+
+
+def test_results_history(tmp_path, aggregate_results_dict):
+    store = HistoryStore.from_uri(str(tmp_path / "history"))
+    for run_date, sample_size in [(date(2024, 1, 1), 100.0), (date(2024, 1, 2), 120.0)]:
+        writer = AggregateResultsWriter(write_history=True)
+        for target_key, value in aggregate_results_dict.items():
+            value = copy.deepcopy(value)
+            for target in value.values():
+                metrics = target["sample_sizes"]["Power0.8EffectSize0.01"]["metrics"]
+                metrics["active_hours"]["sample_size_per_branch"] = sample_size
+            writer.write(target_key, value)
+        writer.close()
+        for app_id, history_file in writer.history_files.items():
+            store.append(app_id, run_date, history_file)
+
+    assert sorted(p.name for p in (tmp_path / "history").iterdir()) == [
+        "app_id=fenix",
+        "app_id=firefox_desktop",
+    ]
+
+    table = store.query(
+        columns=["run_date", "sample_size_per_branch"],
+        from_date=date(2024, 1, 2),
+        equals={"app_id": "fenix", "metric": "active_hours"},
+    )
+    assert table.to_pylist() == [{"run_date": date(2024, 1, 2), "sample_size_per_branch": 120.0}]
+
+    result = CliRunner().invoke(
+        cli,
+        [
+            "history",
+            "--history-uri",
+            str(tmp_path / "history"),
+            "--target-key",
+            "firefox_desktop:release:['EN-US']:US",
+            "--metric",
+            "active_hours",
+            "--columns",
+            "run_date,new_or_existing,sample_size_per_branch",
+        ],
+    )
+    assert result.exit_code == 0, result.output
+    assert result.output.splitlines() == [
+        "run_date,new_or_existing,sample_size_per_branch",
+        "2024-01-01,all,100.0",
+        "2024-01-01,new,100.0",
+        "2024-01-02,all,120.0",
+        "2024-01-02,new,120.0",
+    ]
@@ -0,0 +1,40 @@
+import numpy as np
+import pyarrow as pa
+from mozanalysis.frequentist_stats.sample_size import z_or_t_ind_sample_size_calc
+from mozanalysis.metrics import DataSource, Metric
+
+from auto_sizing.frames import compact_frame, frame_memory
+
+
+def test_compact_frame_keeps_values():
+    rng = np.random.default_rng(0)
+    num_clients = 10_000
+    table = pa.table(
+        {
+            "client_id": pa.array([f"{i:036d}" for i in range(num_clients)]),
+            "days_of_use": pa.array(rng.integers(0, 28, num_clients)),
+            "uri_count": pa.array(rng.poisson(2000, num_clients).astype(np.float64)),
+            "active_hours": pa.array(rng.exponential(2, num_clients)),
+            "search_count": pa.array([None, *range(1, num_clients)], pa.int64()),
+        }
+    )
+
+    df = compact_frame(table)
+
+    assert df.dtypes.astype(str).to_dict() == {
+        "client_id": "string",
+        "days_of_use": "int8",
+        "uri_count": "int16",
+        "active_hours": "float64",
+        "search_count": "float64",
+    }
+    assert frame_memory(df) < 0.6 * frame_memory(table.to_pandas())
+
+    data_source = DataSource(name="clients_daily", from_expr="mozdata.telemetry.clients_daily")
+    metrics = [
+        Metric(name=name, data_source=data_source, select_expr="1")
+        for name in ["days_of_use", "uri_count", "active_hours"]
+    ]
+    assert z_or_t_ind_sample_size_calc(df, metrics) == z_or_t_ind_sample_size_calc(
+        table.to_pandas(), metrics
+    )
@@ -0,0 +1,94 @@
+import os
+import signal
+import time
+
+import pytest
+from mozanalysis.metrics import DataSource, Metric
+from mozanalysis.segments import Segment, SegmentDataSource
+
+from auto_sizing.cli import SerialExecutorStrategy
+from auto_sizing.errors import RunInterruptedException
+from auto_sizing.ledger import LocalLedgerBackend, RunLedger, TargetState
+from auto_sizing.targets import SizingConfiguration
+
+
+def _sizing_config(start_date="2022-10-18"):
+    data_source = SegmentDataSource(
+        name="clients_daily", from_expr="mozdata.telemetry.clients_daily"
+    )
+    metric = Metric(
+        name="active_hours",
+        data_source=DataSource(name="clients_daily", from_expr="mozdata.telemetry.clients_daily"),
+        select_expr="COALESCE(SUM(active_hours_sum), 0)",
+    )
+    return SizingConfiguration(
+        [Segment(name="filter", data_source=data_source, select_expr="LOGICAL_OR(TRUE)")],
+        target_slug="argo_target_0",
+        metric_list=[metric],
+        start_date=start_date,
+        num_dates_enrollment=7,
+        analysis_length=28,
+        parameters=[{"power": 0.8, "effect_size": 0.01}],
+        duplicate_slugs=["argo_target_1"],
+    )
+
+
+def test_run_ledger(tmp_path):
+    ledger = RunLedger(LocalLedgerBackend(tmp_path / "ledger"))
+    config = _sizing_config()
+
+    assert ledger.needs_run(config)
+    assert ledger.entries() == {}
+
+    ledger.mark(config, TargetState.RUNNING)
+    assert ledger.needs_run(config)
+
+    ledger.mark(config, TargetState.DONE)
+    assert not ledger.needs_run(config)
+
+    assert set(ledger.entries().keys()) == {"argo_target_0", "argo_target_1"}
+    assert ledger.get("argo_target_1").state == TargetState.DONE
+
+    # a changed configuration makes the completed entry stale
+    assert ledger.needs_run(_sizing_config(start_date="2022-10-19"))
+
+    ledger.mark(config, TargetState.FAILED)
+    assert ledger.needs_run(config)
+
+    # targets skipped for their population size aren't rerun with the same minimum
+    ledger.mark(config, TargetState.SKIPPED, min_population=100)
+    assert ledger.get("argo_target_1").min_population == 100
+    assert not ledger.needs_run(config, min_population=100)
+    assert not ledger.needs_run(config, min_population=200)
+    # but are with a lower one
+    assert ledger.needs_run(config, min_population=50)
+    assert ledger.needs_run(config)
+
+
+def test_interrupted_target(tmp_path):
+    ledger = RunLedger(LocalLedgerBackend(tmp_path / "ledger"))
+    config = _sizing_config()
+    cancelled = []
+
+    class InterruptedSizing:
+        def __init__(self, *args, **kwargs):
+            pass
+
+        def run(self, current_date):
+            os.kill(os.getpid(), signal.SIGTERM)
+            time.sleep(5)
+
+        def cancel_jobs(self):
+            cancelled.append(True)
+
+    strategy = SerialExecutorStrategy(
+        "project", "dataset", "bucket", sizing_class=InterruptedSizing, ledger=ledger
+    )
+    with pytest.raises(RunInterruptedException):
+        strategy.execute([config])
+
+    assert cancelled == [True]
+    assert ledger.get("argo_target_0").state == TargetState.INTERRUPTED
+    assert ledger.needs_run(config)
+    # the previous handler is restored afterwards
+    assert signal.getsignal(signal.SIGTERM) == signal.SIG_DFL
@@ -0,0 +1,55 @@
+import io
+
+import toml
+
+from auto_sizing.manifest import iter_manifest, target_slug, write_manifest
+
+
+def _jobs_dict(locales):
+    return {
+        "targets": {
+            "locale": locales,
+            "release_channel": ["release", "nightly"],
+            "country": ["US"],
+            "user_type": ["new"],
+        },
+        "metrics": {"firefox_desktop": ["active_hours"], "fenix": ["active_hours"]},
+    }
+
+
+def test_target_slug_is_stable():
+    recipe = {"locale": "('EN-US', 'EN-CA')", "release_channel": "release", "country": "US"}
+    reordered = {"country": "us", "release_channel": "release", "locale": "('EN-CA', 'EN-US')"}
+
+    assert target_slug("firefox_desktop", recipe) == target_slug("firefox_desktop", reordered)
+    assert target_slug("firefox_desktop", recipe) != target_slug("fenix", recipe)
+    assert target_slug("firefox_desktop", recipe).startswith("argo_target_")
+
+
+def test_adding_targets_keeps_existing_slugs():
+    before = dict(iter_manifest(_jobs_dict(["('EN-US')"])))
+    after = dict(iter_manifest(_jobs_dict(["('DE')", "('EN-US')"])))
+
+    assert len(before) == 4
+    assert len(after) == 8
+    assert all(after[slug] == entry for slug, entry in before.items())
+
+
+def test_manifest_exclusions():
+    jobs_dict = _jobs_dict(["('EN-US')", "('DE')"])
+    jobs_dict["exclude"] = [{"app_id": "fenix", "release_channel": "nightly"}]
+
+    manifest = dict(iter_manifest(jobs_dict))
+
+    assert len(manifest) == 6
+    assert not any(
+        entry["app_id"] == "fenix" and "nightly" in entry["target_recipe"]
+        for entry in manifest.values()
+    )
+
+
+def test_write_manifest():
+    manifest_file = io.StringIO()
+
+    assert write_manifest(_jobs_dict(["('EN-US')"]), manifest_file) == 4
+    assert toml.loads(manifest_file.getvalue()) == dict(iter_manifest(_jobs_dict(["('EN-US')"])))
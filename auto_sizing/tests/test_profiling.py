@@ -0,0 +1,43 @@
+import json
+import pstats
+
+from auto_sizing.profiling import Profiler
+
+
+def test_profiler_records_stages(tmp_path):
+    profiler = Profiler("argo_target_0", cprofile_dir=tmp_path)
+    profiler.start()
+    with profiler.stage("allocate"):
+        data = [bytes(1024) for _ in range(1024)]
+    with profiler.stage("serialize"):
+        json.dumps([len(d) for d in data])
+    profiler.stop()
+
+    summary = profiler.summary()
+    assert [stage["name"] for stage in summary["stages"]] == ["allocate", "serialize"]
+    assert summary["stages"][0]["peak_memory_bytes"] >= 1024 * 1024
+    assert summary["peak_memory_bytes"] == max(s["peak_memory_bytes"] for s in summary["stages"])
+    assert summary["wall_seconds"] >= sum(s["wall_seconds"] for s in summary["stages"])
+    assert pstats.Stats(str(tmp_path / "argo_target_0.prof")).total_calls > 0
+
+
+def test_nested_stages_keep_their_peaks():
+    profiler = Profiler("argo_target_0")
+    profiler.start()
+    with profiler.stage("outer"):
+        data = [bytes(1024) for _ in range(4096)]
+        del data
+        with profiler.stage("inner"):
+            json.dumps([bytes(1024).hex() for _ in range(256)])
+    profiler.stop()
+
+    # the inner stage's time isn't counted twice in the totals
+    summary = profiler.summary()
+    wall_seconds = {stage["name"]: stage["wall_seconds"] for stage in summary["stages"]}
+    assert wall_seconds["outer"] <= summary["wall_seconds"]
+    assert summary["wall_seconds"] < wall_seconds["outer"] + wall_seconds["inner"]
+
+    peaks = {stage.name: stage.peak_memory_bytes for stage in profiler.stages}
+    # the inner stage doesn't reset the peak of the outer one
+    assert peaks["outer"] >= 4 * 1024 * 1024
+    assert peaks["inner"] < 4 * 1024 * 1024
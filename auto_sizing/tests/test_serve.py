@@ -0,0 +1,55 @@
+import json
+
+import pytest
+
+from auto_sizing.serve import LocalResultsSource, SizingService, recipe_from_query
+
+
+def _write_results(path, date, sample_size):
+    results = {
+        "firefox_desktop:release:['EN-CA','EN-US']:US": {
+            "new": {"sample_sizes": {"Power0.8EffectSize0.01": sample_size}}
+        }
+    }
+    (path / f"sample_sizes_auto_sizing_results_{date}.json").write_text(json.dumps(results))
+
+
+def test_recipe_from_query():
+    recipe, user_type = recipe_from_query(
+        {"app_id": "firefox_desktop", "locale": "EN-US,EN-CA", "country": "US"}
+    )
+
+    assert recipe["locale"] == "('EN-US', 'EN-CA')"
+    assert user_type == "all"
+
+    with pytest.raises(ValueError):
+        recipe_from_query({"app_id": "firefox_desktop", "locale": "__import__('os')"})
+
+
+def test_sizing_service_lookup_and_reload(tmp_path):
+    _write_results(tmp_path, "2024_01_01", 100)
+    (tmp_path / "sample_sizes_auto_sizing_results_latest.json").write_text("{}")
+    service = SizingService(LocalResultsSource(tmp_path), cache_size=1)
+    recipe, _ = recipe_from_query(
+        {
+            "app_id": "firefox_desktop",
+            "channel": "release",
+            "locale": "EN-US,EN-CA",
+            "country": "US",
+        }
+    )
+
+    assert service.reload_if_updated()
+    assert service.version == "sample_sizes_auto_sizing_results_2024_01_01.json"
+    assert json.loads(service.lookup(recipe, "new"))["sample_sizes"] == {
+        "Power0.8EffectSize0.01": 100
+    }
+    assert service.lookup(recipe, "existing") is None
+    assert len(service._cache) == 1
+
+    assert not service.reload_if_updated()
+    _write_results(tmp_path, "2024_01_02", 200)
+    assert service.reload_if_updated()
+    assert json.loads(service.lookup(recipe, "new"))["sample_sizes"] == {
+        "Power0.8EffectSize0.01": 200
+    }
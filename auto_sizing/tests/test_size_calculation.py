@@ -0,0 +1,335 @@
+import json
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from datetime import date
+from unittest.mock import MagicMock
+
+import attr
+import pandas as pd
+import pytest
+from google.api_core.exceptions import (
+    Forbidden,
+    NotFound,
+    PreconditionFailed,
+    ServiceUnavailable,
+)
+from mozanalysis.metrics import DataSource, Metric
+from mozanalysis.segments import Segment, SegmentDataSource
+
+from auto_sizing.errors import (
+    PopulationTooSmallException,
+    StageDeadlineExceededException,
+)
+from auto_sizing.limiter import AdaptiveLimit, FileLockLimiter, GcsLeaseLimiter
+from auto_sizing.rollup import build_rollup_metrics_query
+from auto_sizing.size_calculation import SizeCalculation
+from auto_sizing.targets import SizingConfiguration
+from auto_sizing.utils import retry_with_backoff
+
+
+@pytest.fixture
+def sizing_config():
+    data_source = SegmentDataSource(
+        name="clients_daily", from_expr="mozdata.telemetry.clients_daily"
+    )
+    metric = Metric(
+        name="active_hours",
+        data_source=DataSource(name="clients_daily", from_expr="mozdata.telemetry.clients_daily"),
+        select_expr="COALESCE(SUM(active_hours_sum), 0)",
+    )
+    return SizingConfiguration(
+        [Segment(name="filter", data_source=data_source, select_expr="LOGICAL_OR(TRUE)")],
+        target_slug="argo_target_0",
+        metric_list=[metric],
+        start_date="2022-10-18",
+        num_dates_enrollment=7,
+        analysis_length=28,
+        parameters=[{"power": 0.8, "effect_size": 0.01}],
+    )
+
+
+@pytest.fixture
+def bigquery_client(monkeypatch):
+    client = MagicMock()
+    context = MagicMock()
+    context.client = client
+    monkeypatch.setattr(SizeCalculation, "bigquerycontext", property(lambda self: context))
+    return client
+
+
+def test_submit_new_job(sizing_config, bigquery_client):
+    bigquery_client.get_job.side_effect = NotFound("missing")
+    sizing = SizeCalculation("project", "dataset", "bucket", sizing_config, run_id="run")
+
+    sizing._submit_or_reattach("targets", "SELECT 1", "project.dataset.table")
+
+    job_id = bigquery_client.query.call_args.kwargs["job_id"]
+    assert job_id.startswith("auto_sizing_argo_target_0_targets_run_")
+    assert job_id.endswith("_0")
+    # job IDs are deterministic for the same run and query
+    assert job_id == f"{sizing._job_id_prefix('targets', 'SELECT 1')}_0"
+
+
+def test_reattach_to_running_job(sizing_config, bigquery_client):
+    running_job = MagicMock(state="RUNNING")
+    bigquery_client.get_job.return_value = running_job
+    sizing = SizeCalculation("project", "dataset", "bucket", sizing_config, run_id="run")
+
+    job = sizing._submit_or_reattach("targets", "SELECT 1", "project.dataset.table")
+
+    assert job is running_job
+    bigquery_client.query.assert_not_called()
+
+
+def test_resubmit_failed_job(sizing_config, bigquery_client):
+    failed_job = MagicMock(state="DONE", error_result={"reason": "backendError"})
+    bigquery_client.get_job.side_effect = [failed_job, NotFound("missing")]
+    sizing = SizeCalculation("project", "dataset", "bucket", sizing_config, run_id="run")
+
+    sizing._submit_or_reattach("targets", "SELECT 1", "project.dataset.table")
+
+    assert bigquery_client.query.call_args.kwargs["job_id"].endswith("_1")
+
+
+def test_retry_with_backoff():
+    func = MagicMock(side_effect=[ServiceUnavailable("unavailable"), "result"])
+
+    assert retry_with_backoff(func, description="test", delay=0) == "result"
+    assert func.call_count == 2
+
+    func = MagicMock(side_effect=ServiceUnavailable("unavailable"))
+    with pytest.raises(ServiceUnavailable):
+        retry_with_backoff(func, description="test", attempts=2, delay=0)
+    assert func.call_count == 2
+
+
+def test_adaptive_limit():
+    policy = AdaptiveLimit(max_limit=8, queueing_threshold=60)
+
+    assert policy.after_success(4, queued_seconds=1) == 5
+    assert policy.after_success(8, queued_seconds=1) == 8
+    assert policy.after_success(8, queued_seconds=120) == 4
+    assert policy.after_quota_error(4) == 2
+    assert policy.after_quota_error(1) == 1
+
+
+def test_file_lock_limiter(tmp_path):
+    limiter = FileLockLimiter(tmp_path, AdaptiveLimit(max_limit=2), poll_interval=0)
+    other_worker = FileLockLimiter(tmp_path, AdaptiveLimit(max_limit=2), poll_interval=0)
+
+    with limiter.lease():
+        with other_worker.lease():
+            # both slots are taken now
+            assert all(other_worker._claim(slot) is None for slot in range(2))
+        limiter.record_quota_error()
+
+    assert other_worker._read_limit() == 1
+
+
+class FakeLimitBucket:
+    """Bucket whose uploads honour generation preconditions."""
+
+    def __init__(self):
+        self.objects = {}
+        # called once before the next upload, to interleave another worker's update
+        self.before_upload = None
+
+    def get_blob(self, name):
+        return self.blob(name) if name in self.objects else None
+
+    def blob(self, name):
+        bucket = self
+        blob = MagicMock()
+        blob.generation = self.objects.get(name, (None, 0))[1]
+
+        def download_as_string(if_generation_match=None):
+            return bucket.objects[name][0]
+
+        def upload_from_string(data, if_generation_match=None):
+            if bucket.before_upload is not None:
+                before_upload, bucket.before_upload = bucket.before_upload, None
+                before_upload()
+            generation = bucket.objects.get(name, (None, 0))[1]
+            if if_generation_match is not None and if_generation_match != generation:
+                raise PreconditionFailed(name)
+            bucket.objects[name] = (data.encode(), generation + 1)
+
+        blob.download_as_string.side_effect = download_as_string
+        blob.upload_from_string.side_effect = upload_from_string
+        return blob
+
+
+def test_gcs_limiter_updates_are_not_lost(monkeypatch):
+    bucket = FakeLimitBucket()
+    storage_client = MagicMock()
+    storage_client.bucket.return_value = bucket
+    monkeypatch.setattr(
+        "auto_sizing.limiter.storage.Client", MagicMock(return_value=storage_client)
+    )
+    monkeypatch.setattr("auto_sizing.utils.time.sleep", lambda seconds: None)
+    limiter, other_worker = [
+        GcsLeaseLimiter("project", "bucket", "limiter", AdaptiveLimit(max_limit=8))
+        for _ in range(2)
+    ]
+
+    limiter.record_quota_error()
+    assert limiter._read_limit() == 4
+
+    # the other worker lowers the limit between this worker's read and write
+    bucket.before_upload = other_worker.record_quota_error
+    limiter.record_quota_error()
+    assert limiter._read_limit() == 1
+
+
+def test_window_sizes_keyed_by_window(sizing_config):
+    sizing_config.analysis_lengths = [7, 14]
+    sizing = SizeCalculation("project", "dataset", "bucket", sizing_config, run_id="run")
+    metrics_table = pd.DataFrame(
+        {
+            f"active_hours_{length}d": [float((i * length) % 11) for i in range(100)]
+            for length in sizing_config.window_lengths
+        }
+    )
+
+    results = sizing.calculate_window_sizes(metrics_table)
+
+    assert sorted(results) == [
+        "Power0.8EffectSize0.01",
+        "Power0.8EffectSize0.01AnalysisLength14",
+        "Power0.8EffectSize0.01AnalysisLength7",
+    ]
+    assert results["Power0.8EffectSize0.01AnalysisLength7"]["parameters"]["analysis_length"] == 7
+
+
+def test_rollup_query_sums_each_window(sizing_config):
+    query = build_rollup_metrics_query(
+        "project.dataset.targets",
+        {"project.dataset.daily": sizing_config.metric_list},
+        [7, 28],
+    )
+
+    assert "INTERVAL 7 DAY), daily.active_hours, NULL)), 0) AS active_hours_7d" in query
+    assert "COALESCE(SUM(daily.active_hours), 0) AS active_hours_28d" in query
+    assert "INTERVAL 27 DAY" in query
+
+
+def test_small_population_skips_metrics(sizing_config, bigquery_client, monkeypatch):
+    bigquery_client.get_table.return_value = MagicMock(num_rows=42)
+    deleted = []
+    monkeypatch.setattr(
+        "auto_sizing.size_calculation.delete_bq_table", lambda table, project: deleted.append(table)
+    )
+    sizing = SizeCalculation("project", "dataset", "bucket", sizing_config, min_population=100)
+    run_stage_query = MagicMock(return_value="project.dataset.targets")
+    monkeypatch.setattr(sizing, "_run_stage_query", run_stage_query)
+
+    with pytest.raises(PopulationTooSmallException) as e:
+        sizing.calculate_target_metrics(date(2023, 1, 1))
+
+    assert e.value.num_clients == 42
+    assert [call.args[0] for call in run_stage_query.call_args_list] == ["targets"]
+    assert deleted == ["project.dataset.targets"]
+
+    # the check is skipped unless a minimum population is configured
+    sizing.min_population = 0
+    sizing._check_population("project.dataset.targets")
+    bigquery_client.get_table.assert_called_once()
+
+    # a marker is published in place of the results, for every equivalent slug
+    export_skipped_json = MagicMock()
+    monkeypatch.setattr("auto_sizing.size_calculation.export_skipped_json", export_skipped_json)
+    sizing.min_population = 100
+    sizing.config.duplicate_slugs = ["argo_target_1"]
+    with pytest.raises(PopulationTooSmallException):
+        sizing.run(date(2023, 1, 1))
+    assert [call.args[2] for call in export_skipped_json.call_args_list] == [
+        "argo_target_0",
+        "argo_target_1",
+    ]
+    assert json.loads(export_skipped_json.call_args.args[3]) == {
+        "reason": "population_too_small",
+        "num_clients": 42,
+        "min_population": 100,
+    }
+
+
+def test_split_metrics_by_data_source(sizing_config, monkeypatch):
+    search_count = Metric(
+        name="search_count",
+        data_source=DataSource(name="search_clients", from_expr="mozdata.search.search_clients"),
+        select_expr="SUM(sap)",
+    )
+    config = attr.evolve(sizing_config, metric_list=[*sizing_config.metric_list, search_count])
+    sizing = SizeCalculation("project", "dataset", "bucket", config, split_data_sources=True)
+
+    queries = {}
+
+    def run_stage_query(stage, sql, table_name):
+        queries[stage] = sql
+        return table_name
+
+    frames = {
+        "metrics_table_argo_target_0_clients_daily": pd.DataFrame(
+            {"client_id": ["a", "b"], "active_hours": [1.0, 2.0]}
+        ),
+        "metrics_table_argo_target_0_search_clients": pd.DataFrame(
+            {"client_id": ["b", "a"], "search_count": [4, 3]}
+        ),
+    }
+    monkeypatch.setattr(sizing, "_run_stage_query", run_stage_query)
+    monkeypatch.setattr(sizing, "_download_table", lambda table, columns: frames[table][columns])
+    monkeypatch.setattr("auto_sizing.size_calculation.delete_bq_table", lambda table, project: None)
+
+    df, _ = sizing.calculate_metrics(
+        sizing._validate_requested_timelimits(date(2023, 1, 1)), sizing._historical_target()
+    )
+
+    assert set(queries) == {"targets", "metrics_clients_daily", "metrics_search_clients"}
+    assert "search_clients" not in queries["metrics_clients_daily"]
+    assert "clients_daily" not in queries["metrics_search_clients"]
+    # client IDs are only downloaded to merge the data sources' metrics
+    assert df.to_dict("list") == {"active_hours": [1.0, 2.0], "search_count": [3, 4]}
+
+
+def test_stage_deadline_cancels_job(sizing_config, bigquery_client):
+    job = MagicMock()
+    job.result.side_effect = FutureTimeoutError()
+    bigquery_client.get_job.side_effect = NotFound("missing")
+    bigquery_client.query.return_value = job
+    sizing = SizeCalculation(
+        "project",
+        "dataset",
+        "bucket",
+        sizing_config,
+        stage_timeout=3600,
+        stage_timeouts={"metrics": 600, "metrics_search": 60},
+    )
+
+    assert sizing._stage_timeout("targets") == 3600
+    assert sizing._stage_timeout("metrics_clients_daily") == 600
+    assert sizing._stage_timeout("metrics_search_clients") == 60
+
+    with pytest.raises(StageDeadlineExceededException):
+        sizing._run_stage_query("metrics", "SELECT 1", "table")
+
+    assert 590 < job.result.call_args.kwargs["timeout"] <= 600
+    job.cancel.assert_called_once()
+    assert sizing._active_jobs == {}
+
+
+def test_submit_quota_errors_lower_the_limit(sizing_config, bigquery_client, tmp_path):
+    job = MagicMock(created=None, started=None)
+    bigquery_client.get_job.side_effect = NotFound("missing")
+    bigquery_client.query.side_effect = [
+        Forbidden("rate limited", errors=[{"reason": "rateLimitExceeded"}]),
+        job,
+    ]
+    limiter = FileLockLimiter(tmp_path, AdaptiveLimit(max_limit=4), poll_interval=0)
+    sizing = SizeCalculation(
+        "project", "dataset", "bucket", sizing_config, limiter=limiter, retry_delay=0
+    )
+
+    sizing._run_stage_query("targets", "SELECT 1", "table")
+
+    assert bigquery_client.query.call_count == 2
+    job.result.assert_called_once()
+    assert limiter._read_limit() == 2
@@ -0,0 +1,55 @@
+from mozanalysis.metrics import DataSource, Metric
+from mozanalysis.segments import Segment, SegmentDataSource
+
+from auto_sizing.targets import SizingConfiguration, deduplicate_worklist
+
+
+def _sizing_config(target_slug, segment_name, select_expr):
+    clients_daily = SegmentDataSource(
+        name="clients_daily", from_expr="mozdata.telemetry.clients_daily"
+    )
+    metric = Metric(
+        name="active_hours",
+        data_source=DataSource(name="clients_daily", from_expr="mozdata.telemetry.clients_daily"),
+        select_expr="COALESCE(SUM(active_hours_sum), 0)",
+    )
+    return SizingConfiguration(
+        [Segment(name=segment_name, data_source=clients_daily, select_expr=select_expr)],
+        target_slug=target_slug,
+        metric_list=[metric],
+        start_date="2022-10-18",
+        num_dates_enrollment=7,
+        analysis_length=28,
+        parameters=[{"power": 0.8, "effect_size": 0.01}],
+    )
+
+
+def test_fingerprint_ignores_segment_names_and_whitespace():
+    config_a = _sizing_config(
+        "argo_target_0",
+        "clients_daily_filter",
+        "COALESCE(LOGICAL_OR(\n  (UPPER(locale) IN ('EN-US'))))",
+    )
+    config_b = _sizing_config(
+        "argo_target_1", "other_filter", "COALESCE(LOGICAL_OR( (UPPER(locale) IN ('EN-US'))))"
+    )
+    config_c = _sizing_config(
+        "argo_target_2", "clients_daily_filter", "COALESCE(LOGICAL_OR((UPPER(locale) IN ('DE'))))"
+    )
+
+    assert config_a.fingerprint() == config_b.fingerprint()
+    assert config_a.fingerprint() != config_c.fingerprint()
+
+
+def test_deduplicate_worklist():
+    worklist = [
+        _sizing_config("argo_target_0", "clients_daily_filter", "LOGICAL_OR(TRUE)"),
+        _sizing_config("argo_target_1", "clients_daily_filter", "LOGICAL_OR(FALSE)"),
+        _sizing_config("argo_target_2", "clients_daily_filter", "LOGICAL_OR(TRUE)"),
+    ]
+
+    deduplicated = deduplicate_worklist(worklist)
+
+    assert [config.target_slug for config in deduplicated] == ["argo_target_0", "argo_target_1"]
+    assert deduplicated[0].duplicate_slugs == ["argo_target_2"]
+    assert deduplicated[1].duplicate_slugs == []
@@ -0,0 +1,82 @@
+from datetime import date
+
+import pytest
+from mozanalysis.metrics import DataSource, Metric
+from mozanalysis.segments import Segment, SegmentDataSource
+
+from auto_sizing.targets import SegmentsList, SizingConfiguration
+from auto_sizing.validation import validate_target, validate_worklist
+
+SCHEMAS = {
+    "mozdata.telemetry.clients_daily": {
+        "client_id",
+        "submission_date",
+        "locale",
+        "country",
+        "normalized_channel",
+        "active_hours_sum",
+    }
+}
+
+
+def sizing_config(target_slug, target, select_expr="COALESCE(SUM(active_hours_sum), 0)", **kwargs):
+    data_source = SegmentDataSource(
+        name="clients_daily", from_expr="mozdata.telemetry.clients_daily"
+    )
+    segment = Segment(
+        name="clients_daily_filter",
+        data_source=data_source,
+        select_expr=SegmentsList()._make_clients_daily_filter(target),
+    )
+    metric = Metric(
+        name="active_hours",
+        data_source=DataSource(name="clients_daily", from_expr="`mozdata.telemetry.clients_daily`"),
+        select_expr=select_expr,
+    )
+    return SizingConfiguration(
+        [segment],
+        target_slug=target_slug,
+        metric_list=[metric],
+        start_date="2022-10-18",
+        num_dates_enrollment=7,
+        analysis_length=28,
+        parameters=[{"power": 0.8, "effect_size": 0.01}],
+        **kwargs,
+    )
+
+
+@pytest.mark.parametrize("analysis_lengths", [[], [7, 28]])
+def test_valid_target(analysis_lengths):
+    config = sizing_config(
+        "argo_target_0",
+        {"locale": "('en-US', 'de')", "country": "US"},
+        analysis_lengths=analysis_lengths,
+    )
+
+    result = validate_target(config, date(2023, 1, 1), SCHEMAS, "project", "dataset")
+
+    assert result["errors"] == []
+    assert result["queries"] == 2 + len(analysis_lengths) // 2
+    assert result["tables"] == ["mozdata.telemetry.clients_daily"]
+
+
+def test_broken_targets_are_reported():
+    worklist = [
+        sizing_config("argo_target_0", {"country": "US"}),
+        # unbalanced quotes of a malformed locale
+        sizing_config("argo_target_1", {"locale": "('en-US)"}),
+        # a metric reading a column its data source doesn't have
+        sizing_config("argo_target_2", {"country": "US"}, "SUM(active_hours)"),
+        sizing_config("argo_target_3", {"country": "US"}, "SUM({missing})"),
+    ]
+
+    results = validate_worklist(
+        worklist, date(2023, 1, 1), SCHEMAS, "project", "dataset", max_workers=2
+    )
+
+    assert results["argo_target_0"]["errors"] == []
+    assert results["argo_target_1"]["errors"][0].startswith("targets: ")
+    assert results["argo_target_2"]["errors"] == [
+        "metrics: mozdata.telemetry.clients_daily has no column active_hours"
+    ]
+    assert results["argo_target_3"]["errors"] == ["rendering: 'missing'"]
@@ -0,0 +1,201 @@
+import time
+from concurrent.futures import ThreadPoolExecutor
+from unittest.mock import MagicMock
+
+import pytest
+from google.api_core.exceptions import NotFound, PreconditionFailed
+
+from auto_sizing.errors import RunInterruptedException
+from auto_sizing.work_queue import GcsWorkQueue, SqliteWorkQueue, WorkItem
+from auto_sizing.worker import Worker
+
+
+class FakeBlob:
+    def __init__(self, bucket, name, metadata=None, metageneration=None):
+        self.bucket = bucket
+        self.name = name
+        self.metadata = metadata
+        self._metageneration = metageneration
+
+    @property
+    def metageneration(self):
+        # read-only, as on storage.Blob
+        return self._metageneration
+
+    def upload_from_string(self, data):
+        self.bucket.objects[self.name] = (dict(self.metadata), 1)
+        self._metageneration = 1
+
+    def patch(self, if_metageneration_match=None):
+        if self.name not in self.bucket.objects:
+            raise NotFound(self.name)
+        _, metageneration = self.bucket.objects[self.name]
+        if if_metageneration_match != metageneration:
+            raise PreconditionFailed(self.name)
+        self.bucket.objects[self.name] = (dict(self.metadata), metageneration + 1)
+        self._metageneration = metageneration + 1
+
+
+class FakeBucket:
+    def __init__(self):
+        self.objects = {}
+        self.client = self
+
+    def blob(self, name):
+        return FakeBlob(self, name)
+
+    def list_blobs(self, bucket, prefix):
+        return [
+            FakeBlob(self, name, dict(metadata), metageneration)
+            for name, (metadata, metageneration) in sorted(self.objects.items())
+            if name.startswith(prefix)
+        ]
+
+
+@pytest.fixture
+def gcs_queue(monkeypatch):
+    bucket = FakeBucket()
+    storage_client = MagicMock()
+    storage_client.bucket.return_value = bucket
+    monkeypatch.setattr(
+        "auto_sizing.work_queue.storage.Client", MagicMock(return_value=storage_client)
+    )
+    return lambda **kwargs: GcsWorkQueue("project", "bucket", "queue", **kwargs)
+
+
+def test_gcs_claims_are_conditional(gcs_queue):
+    queue, other = gcs_queue(), gcs_queue()
+    queue.enqueue([WorkItem("argo_target_0", "argo_target_x")])
+    # a listing taken before the item was claimed
+    other._candidates = other._list()
+
+    claim = queue.claim()
+    assert claim.item == WorkItem("argo_target_0", "argo_target_x")
+    # the stale listing's metageneration no longer matches
+    assert other.claim() is None
+
+    assert queue.heartbeat(claim)
+    assert queue.heartbeat(claim)
+    assert not queue.is_drained()
+    queue.complete(claim)
+    assert queue.is_drained()
+
+
+def test_gcs_expired_leases_are_reclaimed(gcs_queue):
+    queue, other = gcs_queue(lease_seconds=0.1), gcs_queue()
+    queue.enqueue([WorkItem("argo_target_0")])
+    claim = queue.claim()
+
+    time.sleep(0.2)
+    reclaimed = other.claim()
+    assert reclaimed.item == claim.item
+    assert not queue.heartbeat(claim)
+    other.complete(reclaimed)
+    assert queue.is_drained()
+
+
+def test_workers_drain_queue(tmp_path):
+    SqliteWorkQueue(tmp_path / "queue.db").enqueue(
+        WorkItem(f"argo_target_{i}", "argo_target_x" if i == 0 else "") for i in range(20)
+    )
+    sized = []
+
+    def run_target(item):
+        # uneven targets are balanced across the workers
+        time.sleep(0.05 if item.slug == "argo_target_0" else 0.001)
+        sized.append(item)
+        return item.slug != "argo_target_3"
+
+    def run_worker(_):
+        return Worker(SqliteWorkQueue(tmp_path / "queue.db"), run_target, poll_interval=0.01).run()
+
+    with ThreadPoolExecutor(max_workers=3) as executor:
+        results = list(executor.map(run_worker, range(3)))
+
+    # the failed target is put back on the queue until its attempts are used up
+    assert sorted(item.slug for item in sized) == sorted(
+        [f"argo_target_{i}" for i in range(20)] + ["argo_target_3"] * 2
+    )
+    assert [item.attempts for item in sized if item.slug == "argo_target_3"] == [0, 1, 2]
+    assert WorkItem("argo_target_0", "argo_target_x") in sized
+    # only the worker that completed the failed target reports a failure
+    assert results.count(False) == 1
+
+
+def test_expired_leases_are_reclaimed(tmp_path):
+    queue = SqliteWorkQueue(tmp_path / "queue.db", lease_seconds=0.1)
+    queue.enqueue([WorkItem("argo_target_0")])
+
+    claim = queue.claim()
+    other = SqliteWorkQueue(tmp_path / "queue.db", lease_seconds=0.1)
+    assert other.claim() is None
+    assert queue.heartbeat(claim)
+    assert not queue.is_drained()
+
+    time.sleep(0.2)
+    reclaimed = other.claim()
+    assert reclaimed.item == claim.item
+    # the worker that lost its lease can't renew it anymore
+    assert not queue.heartbeat(claim)
+    other.complete(reclaimed)
+    assert queue.is_drained()
+
+
+def test_interrupted_targets_are_released(tmp_path):
+    queue = SqliteWorkQueue(tmp_path / "queue.db")
+    queue.enqueue([WorkItem("argo_target_0")])
+
+    def run_target(item):
+        raise RunInterruptedException("SIGTERM")
+
+    with pytest.raises(RunInterruptedException):
+        Worker(queue, run_target).run()
+
+    assert queue.claim().item.slug == "argo_target_0"
+
+
+def test_gcs_failed_targets_are_retried(gcs_queue):
+    queue = gcs_queue()
+    queue.enqueue([WorkItem("argo_target_0"), WorkItem("argo_target_1")])
+    sized = []
+
+    def run_target(item):
+        sized.append(item)
+        if item.slug == "argo_target_1" and item.attempts == 0:
+            raise Exception("Out of memory")
+        return item.slug == "argo_target_1"
+
+    assert not Worker(queue, run_target, poll_interval=0.01, max_attempts=2).run()
+
+    assert sorted((item.slug, item.attempts) for item in sized) == [
+        ("argo_target_0", 0),
+        ("argo_target_0", 1),
+        ("argo_target_1", 0),
+        ("argo_target_1", 1),
+    ]
+    assert queue.is_drained()
+
+
+def test_gcs_interrupted_targets_are_released(gcs_queue):
+    # leases are renewed every 10ms while the target is sized
+    queue = gcs_queue(lease_seconds=0.03)
+    queue.enqueue([WorkItem("argo_target_0")])
+    patch = queue._patch
+
+    def slow_patch(name, metageneration, metadata):
+        # renewals take a while to hand back the new metageneration
+        new_metageneration = patch(name, metageneration, metadata)
+        if metadata["state"] == "claimed":
+            time.sleep(0.05)
+        return new_metageneration
+
+    queue._patch = slow_patch
+
+    def run_target(item):
+        time.sleep(0.1)
+        raise RunInterruptedException("SIGTERM")
+
+    with pytest.raises(RunInterruptedException):
+        Worker(queue, run_target).run()
+
+    assert [blob.metadata["state"] for blob in queue._list()] == ["pending"]
@@ -1,19 +1,47 @@
 import itertools
-from datetime import datetime, timedelta
-from typing import Dict, List, Union
+import logging
+import re
+import time
+from datetime import date, timedelta
+from typing import Any, Callable, Dict, Iterator, List, Tuple, Type, TypeVar, Union
 
+from google.api_core import exceptions
 from google.cloud import bigquery
 
+logger = logging.getLogger(__name__)
 
-def dict_combinations(dictionary: Dict, key: str) -> List[Dict[str, Union[List, Dict]]]:
+T = TypeVar("T")
+
+TRANSIENT_ERRORS: Tuple[Type[Exception], ...] = (
+    exceptions.InternalServerError,
+    exceptions.BadGateway,
+    exceptions.ServiceUnavailable,
+    exceptions.GatewayTimeout,
+    exceptions.TooManyRequests,
+    ConnectionError,
+)
+
+
+def iter_combinations(dictionary: Dict, key: str) -> Iterator[Dict[str, Any]]:
+    """Lazily yields every combination of the values listed under `dictionary[key]`."""
     keys, values = zip(*dictionary[key].items())
-    dictionary_list = [dict(zip(keys, v)) for v in itertools.product(*values)]
+    for v in itertools.product(*values):
+        yield dict(zip(keys, v))
+
+
+def dict_combinations(dictionary: Dict, key: str) -> List[Dict[str, Union[List, Dict]]]:
+    dictionary_list = list(iter_combinations(dictionary, key))
 
     return dictionary_list
 
 
+def normalize_sql(sql: str) -> str:
+    """Collapses whitespace so that formatting differences don't change a query's identity."""
+    return re.sub(r"\s+", " ", sql).strip()
+
+
 def default_dates_dict(
-    current_date: datetime, num_dates_enrollment: int = 7, analysis_length: int = 28
+    current_date: date, num_dates_enrollment: int = 7, analysis_length: int = 28
 ) -> Union[Dict[str, int], Dict[str, str], Dict[str, object]]:
     start_date = current_date - timedelta(num_dates_enrollment + analysis_length + 1)
 
@@ -30,3 +58,28 @@ def delete_bq_table(
 ) -> None:
     client = bigquery.Client(project=project_id)
     client.delete_table(table_id, not_found_ok=True)
+
+
+def retry_with_backoff(
+    func: Callable[[], T],
+    description: str,
+    attempts: int = 3,
+    delay: float = 30.0,
+    factor: float = 2.0,
+    retry_on: Tuple[Type[Exception], ...] = TRANSIENT_ERRORS,
+) -> T:
+    """Calls `func`, retrying with exponential backoff when it raises a transient error."""
+    for attempt in range(1, attempts + 1):
+        try:
+            return func()
+        except retry_on as e:
+            if attempt == attempts:
+                raise
+            logger.warning(
+                f"{description} failed (attempt {attempt}/{attempts}), "
+                f"retrying in {delay:.0f}s: {e}"
+            )
+            time.sleep(delay)
+            delay *= factor
+
+    raise AssertionError("unreachable")
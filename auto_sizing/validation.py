@@ -0,0 +1,217 @@
+import functools
+import json
+import logging
+from concurrent.futures import ProcessPoolExecutor
+from datetime import date
+from pathlib import Path
+from typing import Any, Dict, Iterable, List, Optional, Set
+
+import attr
+import sqlglot
+from google.cloud import bigquery
+from sqlglot import exp
+from sqlglot.errors import ParseError, SqlglotError
+from sqlglot.optimizer.scope import Scope, build_scope, traverse_scope
+
+from .size_calculation import SizeCalculation
+from .targets import SizingConfiguration
+
+logger = logging.getLogger(__name__)
+
+SCHEMA_SNAPSHOT = Path(__file__).parent / "data" / "schemas.json"
+DIALECT = "bigquery"
+
+# lower-cased top-level column names of every table in the snapshot
+Schemas = Dict[str, Set[str]]
+
+
+def load_schemas(path: Path = SCHEMA_SNAPSHOT) -> Schemas:
+    if not path.exists():
+        logger.warning(f"No schema snapshot at {path}; columns won't be checked")
+        return {}
+
+    return {
+        table: {column.lower() for column in columns}
+        for table, columns in json.loads(path.read_text()).items()
+    }
+
+
+def snapshot_schemas(project_id: str, tables: Iterable[str]) -> Dict[str, List[str]]:
+    """Looks up the columns of tables in BigQuery, to refresh the schema snapshot."""
+    client = bigquery.Client(project=project_id)
+    return {
+        table: [field.name for field in client.get_table(table).schema]
+        for table in sorted(set(tables))
+    }
+
+
+def write_schemas(schemas: Dict[str, List[str]], path: Path) -> None:
+    path.write_text(json.dumps(schemas, indent=2, sort_keys=True) + "\n")
+
+
+def _table_name(table: exp.Table) -> str:
+    return ".".join(part.name for part in table.parts)
+
+
+def referenced_tables(expression: exp.Expr) -> List[str]:
+    """Returns the fully qualified tables a query reads, leaving out CTEs."""
+    return sorted(
+        {_table_name(table) for table in expression.find_all(exp.Table) if table.args.get("db")}
+    )
+
+
+def _source_columns(source: Any, schemas: Schemas) -> Optional[Set[str]]:
+    """Returns the columns of a SELECT's source, or None if they can't be known offline."""
+    if isinstance(source, exp.Table) and not source.args.get("pivots"):
+        return schemas.get(_table_name(source))
+    if isinstance(source, Scope):
+        return output_columns(source, schemas)
+    return None
+
+
+def output_columns(scope: Scope, schemas: Schemas) -> Optional[Set[str]]:
+    """Returns the columns a SELECT returns, expanding stars of sources with known columns."""
+    if not isinstance(scope.expression, exp.Select):
+        return None
+
+    columns: Set[str] = set()
+    for select in scope.expression.selects:
+        if isinstance(select, exp.Star) or (
+            isinstance(select, exp.Column) and isinstance(select.this, exp.Star)
+        ):
+            table = select.table if isinstance(select, exp.Column) else ""
+            for alias, (_, source) in scope.selected_sources.items():
+                if table and alias != table:
+                    continue
+                source_columns = _source_columns(source, schemas)
+                if source_columns is None:
+                    return None
+                columns |= source_columns
+        else:
+            columns.add(select.alias_or_name.lower())
+
+    return columns
+
+
+def unknown_columns(expression: exp.Expr, schemas: Schemas) -> List[str]:
+    """
+    Returns the columns a query reads from tables in the snapshot that those
+    tables don't have. Columns qualified with a table's alias are checked
+    against the table; unqualified columns are reported if none of the
+    sources of their SELECT has them, as long as all of those are known.
+    """
+    problems = set()
+    for scope in traverse_scope(expression):
+        # CTEs are sources of every SELECT of the query, even those that don't read them
+        sources = {alias: source for alias, (_, source) in scope.selected_sources.items()}
+        tables = {
+            alias: _table_name(source)
+            for alias, source in sources.items()
+            if isinstance(source, exp.Table) and _table_name(source) in schemas
+        }
+        if not tables or not isinstance(scope.expression, exp.Select):
+            continue
+
+        # BigQuery lets GROUP BY, HAVING and ORDER BY refer to columns by their alias
+        aliases = {select.alias_or_name.lower() for select in scope.expression.selects}
+        for column in scope.columns:
+            # columns of correlated subqueries are checked with their own SELECT
+            if column.find_ancestor(exp.Select) is not scope.expression:
+                continue
+
+            parts = [part.name for part in column.parts]
+            if parts[0] in sources and len(parts) > 1:
+                alias, name = parts[0], parts[1]
+                if alias in tables and name.lower() not in schemas[tables[alias]]:
+                    problems.add(f"{tables[alias]} has no column {name}")
+                continue
+
+            # the first part of a struct field, e.g. `payload` of `payload.processes`
+            name = parts[0]
+            clause = column.find_ancestor(exp.Group, exp.Order, exp.Having, exp.Select)
+            if name == "*" or (clause is not scope.expression and name.lower() in aliases):
+                continue
+            source_columns = [_source_columns(source, schemas) for source in sources.values()]
+            if all(
+                columns is not None and name.lower() not in columns for columns in source_columns
+            ):
+                problems.add(f"{' or '.join(sorted(set(tables.values())))} has no column {name}")
+
+    return sorted(problems)
+
+
+def _parse_error_message(error: SqlglotError) -> str:
+    if not isinstance(error, ParseError) or not error.errors:
+        return str(error)
+    first = error.errors[0]
+    return (
+        f"{first['description']} at line {first['line']}, column {first['col']}"
+        + f" near '{first['highlight']}'"
+    )
+
+
+def validate_target(
+    config: SizingConfiguration,
+    current_date: date,
+    schemas: Schemas,
+    project_id: str,
+    dataset_id: str,
+) -> Dict[str, Any]:
+    """
+    Renders the queries of a target and parses them with BigQuery's dialect,
+    returning errors of rendering, syntax errors and unknown columns.
+    """
+    sizing = SizeCalculation(project_id, dataset_id, "", config)
+    try:
+        queries = sizing.rendered_queries(current_date)
+    except Exception as e:
+        return {"queries": 0, "tables": [], "errors": [f"rendering: {e}"]}
+
+    # later stages read the tables of earlier ones, whose columns follow from their queries
+    known = dict(schemas)
+    errors: List[str] = []
+    tables: Set[str] = set()
+    for stage, destination, sql in queries:
+        try:
+            expression = sqlglot.parse_one(sql, read=DIALECT)
+        except SqlglotError as e:
+            errors.append(f"{stage}: {_parse_error_message(e)}")
+            continue
+
+        tables.update(
+            table
+            for table in referenced_tables(expression)
+            # tables of earlier stages don't exist until the target runs
+            if not table.startswith(f"{project_id}.{dataset_id}.")
+        )
+        errors.extend(f"{stage}: {problem}" for problem in unknown_columns(expression, known))
+        scope = build_scope(expression)
+        columns = output_columns(scope, known) if scope else None
+        if columns is not None:
+            known[destination] = columns
+
+    return {"queries": len(queries), "tables": sorted(tables), "errors": errors}
+
+
+def validate_worklist(
+    worklist: Iterable[SizingConfiguration],
+    current_date: date,
+    schemas: Schemas,
+    project_id: str,
+    dataset_id: str,
+    max_workers: Optional[int] = None,
+) -> Dict[str, Dict[str, Any]]:
+    """Validates every target of a worklist in parallel processes, keyed by target slug."""
+    # open config files can't be sent to other processes and aren't needed to render queries
+    configs = [attr.evolve(config, config_file=None) for config in worklist]
+    validate = functools.partial(
+        validate_target,
+        current_date=current_date,
+        schemas=schemas,
+        project_id=project_id,
+        dataset_id=dataset_id,
+    )
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        results = list(executor.map(validate, configs, chunksize=16))
+
+    return {config.target_slug: result for config, result in zip(configs, results)}
@@ -0,0 +1,333 @@
+import contextlib
+import logging
+import os
+import random
+import sqlite3
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Any, Dict, Iterable, List, Optional, Protocol
+
+import attr
+import google.cloud.storage as storage
+from google.api_core.exceptions import NotFound, PreconditionFailed
+
+from .export_json import SAMPLE_SIZE_PATH
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_LEASE_SECONDS = 600
+
+
+class ItemState:
+    PENDING = "pending"
+    CLAIMED = "claimed"
+    DONE = "done"
+
+
+@attr.s(auto_attribs=True, frozen=True)
+class WorkItem:
+    slug: str
+    # comma-separated slugs of equivalent targets that receive the same results
+    duplicates: str = ""
+    # number of times the item failed and was put back on the queue
+    attempts: int = 0
+
+
+@attr.s(auto_attribs=True)
+class Claim:
+    item: WorkItem
+    # identifies the claim to the queue, e.g. the claimed GCS object's name and metageneration
+    token: Any = None
+
+
+class WorkQueue(Protocol):
+    lease_seconds: float
+
+    def enqueue(self, items: Iterable[WorkItem]) -> int: ...
+
+    def claim(self) -> Optional[Claim]: ...
+
+    def heartbeat(self, claim: Claim) -> bool: ...
+
+    def complete(self, claim: Claim) -> None: ...
+
+    def release(self, claim: Claim) -> None: ...
+
+    def retry(self, claim: Claim) -> None: ...
+
+    def is_drained(self) -> bool: ...
+
+
+def _holder() -> str:
+    return f"{os.uname().nodename}-{uuid.uuid4().hex[:8]}"
+
+
+class SqliteWorkQueue:
+    """
+    Queue in a SQLite database for workers on one machine. Claims run in
+    immediate transactions, so two workers never claim the same item.
+    """
+
+    def __init__(self, path: Path, lease_seconds: float = DEFAULT_LEASE_SECONDS):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.lease_seconds = lease_seconds
+        self.holder = _holder()
+        with contextlib.closing(self._connect()) as connection:
+            connection.execute(
+                """
+                CREATE TABLE IF NOT EXISTS items (
+                    slug TEXT PRIMARY KEY,
+                    duplicates TEXT NOT NULL,
+                    attempts INTEGER NOT NULL DEFAULT 0,
+                    state TEXT NOT NULL,
+                    holder TEXT,
+                    expires_at REAL
+                )
+                """
+            )
+
+    def _connect(self) -> sqlite3.Connection:
+        return sqlite3.connect(self.path, timeout=60, isolation_level=None)
+
+    def enqueue(self, items: Iterable[WorkItem]) -> int:
+        rows = [(item.slug, item.duplicates, item.attempts, ItemState.PENDING) for item in items]
+        with contextlib.closing(self._connect()) as connection:
+            connection.execute("BEGIN IMMEDIATE")
+            connection.executemany(
+                """
+                INSERT OR REPLACE INTO items (slug, duplicates, attempts, state)
+                VALUES (?, ?, ?, ?)
+                """,
+                rows,
+            )
+            connection.execute("COMMIT")
+        return len(rows)
+
+    def claim(self) -> Optional[Claim]:
+        now = time.time()
+        with contextlib.closing(self._connect()) as connection:
+            connection.execute("BEGIN IMMEDIATE")
+            row = connection.execute(
+                """
+                SELECT slug, duplicates, attempts FROM items
+                WHERE state = ? OR (state = ? AND expires_at < ?)
+                ORDER BY rowid LIMIT 1
+                """,
+                (ItemState.PENDING, ItemState.CLAIMED, now),
+            ).fetchone()
+            if row is not None:
+                connection.execute(
+                    "UPDATE items SET state = ?, holder = ?, expires_at = ? WHERE slug = ?",
+                    (ItemState.CLAIMED, self.holder, now + self.lease_seconds, row[0]),
+                )
+            connection.execute("COMMIT")
+
+        return Claim(WorkItem(*row), self.holder) if row is not None else None
+
+    def _update_claimed(self, claim: Claim, state: str, holder: Optional[str], expires_at) -> bool:
+        with contextlib.closing(self._connect()) as connection:
+            cursor = connection.execute(
+                """
+                UPDATE items SET state = ?, holder = ?, expires_at = ?, attempts = ?
+                WHERE slug = ? AND state = ? AND holder = ?
+                """,
+                (
+                    state,
+                    holder,
+                    expires_at,
+                    claim.item.attempts,
+                    claim.item.slug,
+                    ItemState.CLAIMED,
+                    claim.token,
+                ),
+            )
+            return cursor.rowcount == 1
+
+    def heartbeat(self, claim: Claim) -> bool:
+        expires_at = time.time() + self.lease_seconds
+        return self._update_claimed(claim, ItemState.CLAIMED, claim.token, expires_at)
+
+    def complete(self, claim: Claim) -> None:
+        if not self._update_claimed(claim, ItemState.DONE, None, None):
+            logger.warning(f"{claim.item.slug} was claimed by another worker before it completed")
+
+    def release(self, claim: Claim) -> None:
+        self._update_claimed(claim, ItemState.PENDING, None, None)
+
+    def retry(self, claim: Claim) -> None:
+        claim.item = attr.evolve(claim.item, attempts=claim.item.attempts + 1)
+        if not self._update_claimed(claim, ItemState.PENDING, None, None):
+            logger.warning(f"{claim.item.slug} was claimed by another worker before it failed")
+
+    def is_drained(self) -> bool:
+        with contextlib.closing(self._connect()) as connection:
+            row = connection.execute(
+                "SELECT COUNT(*) FROM items WHERE state != ?", (ItemState.DONE,)
+            ).fetchone()
+        return row[0] == 0
+
+
+class GcsWorkQueue:
+    """
+    Queue of one object per item in a GCS bucket, whose metadata holds the
+    item's state and lease, so a single listing shows every claimable item.
+    Items are claimed and their leases renewed by patching the metadata with
+    a metageneration precondition; a worker that loses the race moves on to
+    another item. Listings are reused until none of their items can be claimed.
+    """
+
+    def __init__(
+        self,
+        project_id: str,
+        bucket: str,
+        prefix: str,
+        lease_seconds: float = DEFAULT_LEASE_SECONDS,
+    ):
+        self.bucket = storage.Client(project_id).bucket(bucket)
+        self.prefix = prefix
+        self.lease_seconds = lease_seconds
+        self.holder = _holder()
+        self._candidates: List[storage.Blob] = []
+
+    def _path(self, slug: str) -> str:
+        return f"{self.prefix}/{slug}"
+
+    def _metadata(self, item: WorkItem, state: str, expires_at: float = 0) -> Dict[str, str]:
+        return {
+            "slug": item.slug,
+            "duplicates": item.duplicates,
+            "attempts": str(item.attempts),
+            "state": state,
+            "holder": self.holder if state == ItemState.CLAIMED else "",
+            "expires_at": str(expires_at),
+        }
+
+    def enqueue(self, items: Iterable[WorkItem]) -> int:
+        def upload(item: WorkItem) -> None:
+            blob = self.bucket.blob(self._path(item.slug))
+            blob.metadata = self._metadata(item, ItemState.PENDING)
+            blob.upload_from_string(item.slug)
+
+        items = list(items)
+        with ThreadPoolExecutor(max_workers=32) as executor:
+            list(executor.map(upload, items))
+        return len(items)
+
+    def _list(self) -> List[storage.Blob]:
+        return [
+            blob
+            for blob in self.bucket.client.list_blobs(self.bucket, prefix=f"{self.prefix}/")
+            if blob.metadata and "state" in blob.metadata
+        ]
+
+    @staticmethod
+    def _claimable(blob: storage.Blob, now: float) -> bool:
+        state = blob.metadata["state"]
+        return state == ItemState.PENDING or (
+            state == ItemState.CLAIMED and float(blob.metadata["expires_at"]) < now
+        )
+
+    def _patch(self, name: str, metageneration: int, metadata: Dict[str, str]) -> Optional[int]:
+        """
+        Patches an item's metadata if it's still at the metageneration that was
+        read. Returns the item's new metageneration, or None if it has changed.
+        """
+        blob = self.bucket.blob(name)
+        blob.metadata = metadata
+        try:
+            blob.patch(if_metageneration_match=metageneration)
+        except (NotFound, PreconditionFailed):
+            return None
+        return blob.metageneration
+
+    def claim(self) -> Optional[Claim]:
+        for relisted in [False, True]:
+            if relisted:
+                self._candidates = self._list()
+                random.shuffle(self._candidates)
+            while self._candidates:
+                blob = self._candidates.pop()
+                now = time.time()
+                if not self._claimable(blob, now):
+                    continue
+                item = WorkItem(
+                    blob.metadata["slug"],
+                    blob.metadata["duplicates"],
+                    int(blob.metadata.get("attempts", 0)),
+                )
+                metadata = self._metadata(item, ItemState.CLAIMED, now + self.lease_seconds)
+                metageneration = self._patch(blob.name, blob.metageneration, metadata)
+                if metageneration is not None:
+                    return Claim(item, (blob.name, metageneration))
+
+        return None
+
+    def _update_claimed(self, claim: Claim, state: str, expires_at: float = 0) -> bool:
+        # the token is the claimed object's name and the metageneration of the last patch
+        name, metageneration = claim.token
+        metageneration = self._patch(
+            name, metageneration, self._metadata(claim.item, state, expires_at)
+        )
+        if metageneration is None:
+            return False
+        claim.token = (name, metageneration)
+        return True
+
+    def heartbeat(self, claim: Claim) -> bool:
+        return self._update_claimed(claim, ItemState.CLAIMED, time.time() + self.lease_seconds)
+
+    def complete(self, claim: Claim) -> None:
+        if not self._update_claimed(claim, ItemState.DONE):
+            logger.warning(f"{claim.item.slug} was claimed by another worker before it completed")
+
+    def release(self, claim: Claim) -> None:
+        self._update_claimed(claim, ItemState.PENDING)
+
+    def retry(self, claim: Claim) -> None:
+        claim.item = attr.evolve(claim.item, attempts=claim.item.attempts + 1)
+        if not self._update_claimed(claim, ItemState.PENDING):
+            logger.warning(f"{claim.item.slug} was claimed by another worker before it failed")
+
+    def is_drained(self) -> bool:
+        return all(blob.metadata["state"] == ItemState.DONE for blob in self._list())
+
+
+class Heartbeat:
+    """Renews a claim's lease in the background while its target is sized."""
+
+    def __init__(self, queue: WorkQueue, claim: Claim):
+        self.queue = queue
+        self.claim = claim
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._renew, daemon=True)
+
+    def _renew(self) -> None:
+        while not self._stopped.wait(self.queue.lease_seconds / 3):
+            if not self.queue.heartbeat(self.claim):
+                logger.warning(f"Lost the lease on {self.claim.item.slug}")
+                return
+
+    def __enter__(self) -> "Heartbeat":
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self._stopped.set()
+        self._thread.join()
+
+
+def default_queue_uri(bucket: str, run_date: str) -> str:
+    return f"gs://{bucket}/{SAMPLE_SIZE_PATH}/queue_{run_date}"
+
+
+def queue_from_uri(uri: str, project_id: str) -> WorkQueue:
+    """Returns a GCS queue for gs:// URIs and a SQLite queue for local paths."""
+    if uri.startswith("gs://"):
+        bucket, _, prefix = uri.removeprefix("gs://").partition("/")
+        return GcsWorkQueue(project_id, bucket, prefix.rstrip("/"))
+
+    return SqliteWorkQueue(Path(uri))
@@ -0,0 +1,70 @@
+import logging
+import time
+from typing import Callable
+
+import attr
+
+from .errors import RunInterruptedException
+from .work_queue import Heartbeat, WorkItem, WorkQueue
+
+logger = logging.getLogger(__name__)
+
+
+@attr.s(auto_attribs=True)
+class Worker:
+    """
+    Claims targets from a queue and sizes them one after another until the
+    queue is drained, so that a fixed pool of workers balances uneven targets
+    and pays its startup costs, e.g. loading metric-hub, only once.
+    """
+
+    queue: WorkQueue
+    # sizes a target and returns whether it succeeded
+    run_target: Callable[[WorkItem], bool]
+    # how long to wait for targets claimed by other workers to finish or expire
+    poll_interval: float = 60.0
+    # how many times a target is sized before it is completed as failed
+    max_attempts: int = 3
+
+    def _size(self, item: WorkItem) -> bool:
+        try:
+            return self.run_target(item)
+        except Exception as e:
+            logger.exception(str(e), exc_info=e, extra={"target": item.slug})
+            return False
+
+    def run(self) -> bool:
+        succeeded = True
+        num_targets = 0
+        while True:
+            claim = self.queue.claim()
+            if claim is None:
+                if self.queue.is_drained():
+                    break
+                time.sleep(self.poll_interval)
+                continue
+
+            logger.info(f"Claimed {claim.item.slug}")
+            try:
+                with Heartbeat(self.queue, claim):
+                    success = self._size(claim.item)
+            except RunInterruptedException:
+                # hand the target back so another worker can pick it up right away; the
+                # heartbeat has stopped, so it no longer moves the claim's metageneration
+                self.queue.release(claim)
+                raise
+
+            if not success and claim.item.attempts + 1 < self.max_attempts:
+                logger.warning(
+                    f"Putting {claim.item.slug} back on the queue after attempt "
+                    + f"{claim.item.attempts + 1} of {self.max_attempts} failed"
+                )
+                self.queue.retry(claim)
+                continue
+
+            self.queue.complete(claim)
+            succeeded = succeeded and success
+            num_targets += 1
+
+        logger.info(f"Queue drained after sizing {num_targets} targets")
+        return succeeded
@@ -0,0 +1,87 @@
+#!/usr/bin/env python
+"""
+Benchmarks the memory taken by the metrics of a large target once downloaded,
+comparing `to_dataframe`'s default conversion of every column with the compact
+frame of only the metric columns that sizing reads.
+
+BigQuery isn't queried: the download is replaced by a synthetic Arrow table
+shaped like the metrics table of a preset desktop target.
+"""
+import multiprocessing
+import resource
+import time
+import uuid
+from datetime import date, timedelta
+
+import click
+import db_dtypes
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+
+from auto_sizing.frames import compact_frame, frame_memory
+
+METRICS = ["active_hours", "search_count", "days_of_use"]
+
+
+def metrics_table(num_clients: int) -> pa.Table:
+    rng = np.random.default_rng(0)
+    enrollment_dates = [date(2024, 1, 1) + timedelta(days=int(d)) for d in range(7)]
+    return pa.table(
+        {
+            "client_id": pa.array(
+                str(uuid.UUID(int=int(i))) for i in rng.integers(2**62, size=num_clients)
+            ),
+            "enrollment_date": pa.array(
+                [enrollment_dates[i] for i in rng.integers(7, size=num_clients)], pa.date32()
+            ),
+            "analysis_window_start": pa.array(np.zeros(num_clients, dtype=np.int64)),
+            "analysis_window_end": pa.array(np.full(num_clients, 27, dtype=np.int64)),
+            "active_hours": pa.array(rng.exponential(20, num_clients)),
+            "search_count": pa.array(rng.poisson(30, num_clients).astype(np.int64)),
+            "days_of_use": pa.array(rng.integers(0, 29, num_clients)),
+        }
+    )
+
+
+def measure(compact: bool, num_clients: int, results) -> None:
+    table = metrics_table(num_clients)
+    baseline = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    start = time.perf_counter()
+    if compact:
+        df = compact_frame(table.select(METRICS))
+    else:
+        # what `RowIterator.to_dataframe` does with BigQuery's INT64, BOOL and DATE columns
+        df = table.to_pandas(
+            types_mapper={
+                pa.int64(): pd.Int64Dtype(),
+                pa.bool_(): pd.BooleanDtype(),
+                pa.date32(): db_dtypes.DateDtype(),
+            }.get
+        )
+    seconds = time.perf_counter() - start
+    del table
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    results.put((frame_memory(df), max(0, peak - baseline), seconds))
+
+
+@click.command()
+@click.option("--clients", default=5_000_000, help="Number of clients in the metrics table")
+def main(clients):
+    context = multiprocessing.get_context("spawn")
+    click.echo(f"{clients} clients")
+    for label, compact in [("to_dataframe", False), ("compact metrics", True)]:
+        # every conversion runs in a fresh process so their peaks don't mask each other
+        results = context.Queue()
+        process = context.Process(target=measure, args=(compact, clients, results))
+        process.start()
+        frame_bytes, peak_bytes, seconds = results.get()
+        process.join()
+        click.echo(
+            f"{label:<18}frame {frame_bytes / 2**20:8.0f} MiB"
+            + f"   peak increase {peak_bytes / 2**20:8.0f} MiB   {seconds:6.2f}s"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,86 @@
+#!/usr/bin/env python
+"""
+Benchmarks building, deduplicating and submitting the Argo worklist of a large
+synthetic target list, e.g. 47 locales and 8 countries make 10,152 targets.
+
+metric-hub isn't queried: metrics and segment data sources are replaced by
+synthetic definitions, so only the work done locally is measured.
+"""
+import tempfile
+import time
+from contextlib import contextmanager
+from pathlib import Path
+from unittest.mock import patch
+
+import click
+import toml
+from mozanalysis.metrics import DataSource, Metric
+from mozanalysis.segments import SegmentDataSource
+
+import auto_sizing.cli as cli
+import auto_sizing.targets as targets
+from auto_sizing.ledger import LocalLedgerBackend, RunLedger
+from auto_sizing.manifest import iter_manifest
+from auto_sizing.targets import SizingCollection, deduplicate_worklist
+
+
+@contextmanager
+def timed(label):
+    start = time.perf_counter()
+    yield
+    click.echo(f"{label:<24}{time.perf_counter() - start:8.2f}s")
+
+
+@click.command()
+@click.option("--locales", default=47, help="Number of synthetic locales")
+@click.option("--countries", default=8, help="Number of synthetic countries")
+@click.option("--shard_size", "--shard-size", default=cli.ARGO_SHARD_SIZE)
+def main(locales, countries, shard_size):
+    jobs_dict = toml.load(cli.TARGET_SETTINGS)
+    jobs_dict["targets"]["locale"] = [f"('L{i}')" for i in range(locales)]
+    jobs_dict["targets"]["country"] = [f"C{i}" for i in range(countries)]
+    manifest = dict(iter_manifest(jobs_dict))
+    click.echo(f"{len(manifest)} targets")
+
+    data_source = DataSource(name="clients_daily", from_expr="mozdata.telemetry.clients_daily")
+    segment_data_source = SegmentDataSource(
+        name="clients_daily", from_expr="mozdata.telemetry.clients_daily"
+    )
+    submit_workflow = patch.object(cli, "submit_workflow", return_value=True)
+    with patch.object(
+        targets,
+        "get_metric",
+        lambda metric, app_id: Metric(name=metric, data_source=data_source, select_expr="1"),
+    ), patch.object(
+        targets, "get_segment_data_source", lambda data_source, app_id: segment_data_source
+    ), patch.object(
+        cli.toml, "load", lambda path: jobs_dict if path == cli.TARGET_SETTINGS else manifest
+    ), submit_workflow as submitted:
+        executor = cli.AnalysisExecutor("project", "dataset", "bucket", target_slug=cli.All)
+        executor.run_preset_jobs = True
+
+        with timed("build and deduplicate"):
+            worklist = deduplicate_worklist(executor._target_list_to_analyze(SizingCollection()))
+
+        with tempfile.TemporaryDirectory() as ledger_dir:
+            strategy = cli.ArgoExecutorStrategy(
+                "project",
+                "dataset",
+                "bucket",
+                "zone",
+                "cluster",
+                monitor_status=False,
+                ledger=RunLedger(LocalLedgerBackend(Path(ledger_dir))),
+                shard_size=shard_size,
+            )
+            with timed("check ledger and submit"):
+                strategy.execute(worklist)
+
+    # parameters are passed to Argo as strings
+    sizes = [len(str(call.kwargs["parameters"]["targets"])) for call in submitted.call_args_list]
+    click.echo(f"{len(worklist)} distinct runs in {len(sizes)} workflows")
+    click.echo(f"largest targets parameter: {max(sizes, default=0) / 1024:.1f} KiB")
+
+
+if __name__ == "__main__":
+    main()
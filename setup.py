@@ -66,6 +66,7 @@ setup(
         "PyYAML",
         "requests",
         "smart_open[gcs]",
+        "sqlglot",
         "statsmodels",
         "toml",
     ],